@@ -0,0 +1,137 @@
+"""
+This module compares the steps per second of the LoRA training step in eager mode and with `torch.compile`, as run by
+`train_txt_to_img_lora.py --compile`: noise addition, UNet forward with LoRA attention processors, SNR-weighted
+loss, backward and optimizer step.
+
+The UNet is a randomly initialized miniature of the Stable Diffusion UNet, so the benchmark runs on CPU with the
+inductor backend in a few minutes, without downloading any weights.
+
+Example:
+    python benchmarks/compile_step.py --steps 30 --warmup_steps 5
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import torch
+from diffusers import DDPMScheduler, UNet2DConditionModel
+from diffusers.loaders import AttnProcsLayers
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "diffusion"))
+
+from compile_utils import compile_function, lora_attn_processor_class, report_graph_breaks  # noqa: E402
+from noise_schedule import NoiseScheduleTables  # noqa: E402
+from options import COMPILE_MODES  # noqa: E402
+
+
+def tiny_unet(rank: int) -> UNet2DConditionModel:
+    """
+    Build a miniature Stable Diffusion UNet with LoRA attention processors.
+
+    Args:
+        rank: The dimension of the LoRA update matrices.
+
+    Returns:
+        UNet2DConditionModel: The UNet, with only the LoRA weights trainable.
+    """
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        sample_size=16,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+    )
+    unet.requires_grad_(False)
+    processor_class = lora_attn_processor_class()
+    procs = {}
+    for name in unet.attn_processors.keys():
+        cross_attention_dim = None if name.endswith("attn1.processor") else unet.config.cross_attention_dim
+        if name.startswith("mid_block"):
+            hidden_size = unet.config.block_out_channels[-1]
+        elif name.startswith("up_blocks"):
+            hidden_size = list(reversed(unet.config.block_out_channels))[int(name[len("up_blocks.")])]
+        else:
+            hidden_size = unet.config.block_out_channels[int(name[len("down_blocks.")])]
+        procs[name] = processor_class(hidden_size=hidden_size, cross_attention_dim=cross_attention_dim, rank=rank)
+    unet.set_attn_processor(procs)
+    return unet
+
+
+def steps_per_second(args, use_compile: bool) -> float:
+    """
+    Run training steps and measure their throughput, excluding warm-up steps.
+
+    Args:
+        args: The parsed arguments.
+        use_compile: Whether to compile the UNet forward, the noise addition and the loss.
+
+    Returns:
+        float: The optimization steps per second after warm-up.
+    """
+    unet = tiny_unet(args.rank)
+    lora_layers = AttnProcsLayers(unet.attn_processors)
+    optimizer = torch.optim.AdamW(lora_layers.parameters(), lr=1e-4)
+    # Same noising and loss as the training script with uniform timestep sampling
+    noise_schedule = NoiseScheduleTables(
+        DDPMScheduler(num_train_timesteps=1000), torch.device("cpu"), "epsilon", snr_gamma=args.snr_gamma
+    )
+
+    def add_noise(latents, noise, timesteps):
+        return noise_schedule.add_noise(latents, noise, timesteps)
+
+    def compute_loss(model_pred, target, timesteps):
+        return noise_schedule.sample_losses(model_pred, target, timesteps).mean()
+
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn(args.batch_size, 4, 16, 16, generator=generator)
+    encoder_hidden_states = torch.randn(args.batch_size, 77, 32, generator=generator)
+
+    unet_forward, add_noise_fn, compute_loss_fn = unet, add_noise, compute_loss
+    if use_compile:
+        timesteps = torch.randint(0, 1000, (args.batch_size,), generator=generator)
+        with torch.no_grad():
+            report_graph_breaks("unet", unet, latents, timesteps, encoder_hidden_states)
+        unet_forward, add_noise_fn, compute_loss_fn = (
+            compile_function(fn, backend=args.backend, mode=args.mode) for fn in [unet, add_noise, compute_loss]
+        )
+
+    for step in range(args.warmup_steps + args.steps):
+        if step == args.warmup_steps:
+            start = time.perf_counter()
+        noise = torch.randn(latents.shape, generator=generator)
+        timesteps = torch.randint(0, 1000, (args.batch_size,), generator=generator)
+        noisy_latents, target = add_noise_fn(latents, noise, timesteps)
+        model_pred = unet_forward(noisy_latents, timesteps, encoder_hidden_states).sample
+        loss = compute_loss_fn(model_pred, target, timesteps)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    return args.steps / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare eager and compiled LoRA training steps on a tiny UNet.")
+    parser.add_argument("--steps", type=int, default=30, help="Number of measured steps.")
+    parser.add_argument("--warmup_steps", type=int, default=5, help="Number of steps excluded, including compilation.")
+    parser.add_argument("--batch_size", type=int, default=4, help="Batch size.")
+    parser.add_argument("--rank", type=int, default=4, help="Dimension of the LoRA update matrices.")
+    parser.add_argument("--snr_gamma", type=float, default=5.0, help="SNR weighting gamma.")
+    parser.add_argument("--backend", type=str, default="inductor", help="The `torch.compile` backend.")
+    parser.add_argument("--mode", type=str, default="default", choices=COMPILE_MODES)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+    eager = steps_per_second(args, use_compile=False)
+    print(f"eager: {eager:.2f} steps/sec")
+    compiled = steps_per_second(args, use_compile=True)
+    print(f"compiled ({args.backend}, {args.mode}): {compiled:.2f} steps/sec ({compiled / eager:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+This module measures the startup time of the command line entry points of the diffusion scripts: `--help` and
+`--dry_run` must return without importing torch, diffusers or datasets.
+
+Each command runs in a fresh interpreter, several times, and the median wall-clock time is reported along with the
+slowest top-level imports reported by `python -X importtime`. With `--max_seconds`, the script exits with an error
+when a command is slower, so it can track regressions.
+
+Example:
+    python benchmarks/import_time.py --repeat 5 --max_seconds 0.5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+DIFFUSION_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "diffusion")
+
+
+def commands(work_dir: str) -> dict:
+    """
+    Build the benchmarked commands.
+
+    Args:
+        work_dir: An existing directory, used as output and image directory of the dry runs.
+
+    Returns:
+        dict: The arguments of each command, by name.
+    """
+    train = os.path.join(DIFFUSION_DIR, "train_txt_to_img_lora.py")
+    dataset = os.path.join(DIFFUSION_DIR, "watches_dataset.py")
+    return {
+        "train --help": [train, "--help"],
+        "train --dry_run": [
+            train,
+            "--pretrained_model_name_or_path",
+            "stabilityai/stable-diffusion-2-1",
+            "--train_data_dir",
+            work_dir,
+            "--output_dir",
+            work_dir,
+            "--dry_run",
+        ],
+        "watches_dataset --help": [dataset, "--help"],
+        "watches_dataset --dry_run": [dataset, "--image_dir", work_dir, "--dry_run"],
+    }
+
+
+def run(args: list) -> float:
+    """
+    Run a script in a fresh interpreter.
+
+    Args:
+        args: The script and its arguments.
+
+    Returns:
+        float: The wall-clock time, in seconds.
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *args], check=True, capture_output=True, cwd=DIFFUSION_DIR)
+    return time.perf_counter() - start
+
+
+def slowest_imports(args: list, top: int) -> list:
+    """
+    Find the slowest top-level imports of a script with `python -X importtime`.
+
+    Args:
+        args: The script and its arguments.
+        top: The number of imports to return.
+
+    Returns:
+        list: (cumulative microseconds, module) tuples, slowest first.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args], check=True, capture_output=True, text=True, cwd=DIFFUSION_DIR
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", nested imports are indented
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        if not module.startswith("  "):
+            imports.append((int(cumulative), module.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of the diffusion scripts.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs of each command.")
+    parser.add_argument("--top", type=int, default=5, help="Number of slowest imports to show per command.")
+    parser.add_argument(
+        "--max_seconds", type=float, default=None, help="Fail if the median time of a command is above this value."
+    )
+    args = parser.parse_args()
+
+    failed = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, command in commands(work_dir).items():
+            median = statistics.median(run(command) for _ in range(args.repeat))
+            print(f"{name}: {median * 1000:.0f} ms")
+            for cumulative, module in slowest_imports(command, args.top):
+                print(f"    {cumulative / 1000:8.1f} ms  {module}")
+            if args.max_seconds is not None and median > args.max_seconds:
+                failed.append(name)
+
+    if failed:
+        sys.exit(f"Slower than {args.max_seconds}s: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
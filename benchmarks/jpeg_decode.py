@@ -0,0 +1,112 @@
+"""
+This module compares the CPU time of loading the training images with a full JPEG decode and with the reduced-scale
+decode of `image_decoding.decode_image`, as done by `preprocess_train` in the dataloader workers: decode, then resize
+of the shorter side to the training resolution.
+
+Images are read from a directory of stored images (e.g. `images/full`), or generated as 1000px JPEGs like the ones
+requested by the spider. The time per image is extrapolated to an epoch of the dataset, per dataloader worker.
+libjpeg only scales by 1/2, 1/4 or 1/8, so only the images at least twice as large as the resolution decode faster.
+
+Example:
+    python benchmarks/jpeg_decode.py --image_dir images/full --resolutions 512 768 --epoch_images 20000
+    python benchmarks/jpeg_decode.py --image_size 1600 --resolutions 256 512 768
+"""
+
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "diffusion"))
+
+from image_decoding import decode_image  # noqa: E402
+
+
+def synthetic_images(num_images: int, size: int = 1000, quality: int = 90) -> list:
+    """
+    Generate JPEG images with smooth gradients and noise, of about the size and entropy of watch photos.
+
+    Args:
+        num_images: The number of images.
+        size: The side of the images.
+        quality: The JPEG quality.
+
+    Returns:
+        list: The encoded images.
+    """
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    images = []
+    for _ in range(num_images):
+        red, green = np.meshgrid(gradient * rng.random(), gradient * rng.random())
+        pixels = np.stack([red, green, np.full_like(red, 128)], axis=-1) + rng.normal(0, 20, (size, size, 3))
+        buffer = io.BytesIO()
+        Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=quality)
+        images.append(buffer.getvalue())
+    return images
+
+
+def load_time(images: list, resolution: int, reduced: bool, repeats: int) -> float:
+    """
+    Measure the time of loading an image at a training resolution.
+
+    Args:
+        images: The encoded images.
+        resolution: The training resolution.
+        reduced: Whether to decode the images at a reduced scale.
+        repeats: The number of passes over the images, the fastest is kept.
+
+    Returns:
+        float: The time per image, in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for image_bytes in images:
+            image = decode_image(image_bytes, resolution if reduced else None)
+            scale = resolution / min(image.size)
+            image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR)
+        best = min(best, time.perf_counter() - start)
+    return best / len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare full and reduced-scale JPEG decoding of training images.")
+    parser.add_argument("--image_dir", type=str, default=None, help="Directory of JPEG images. Generated if unset.")
+    parser.add_argument("--num_images", type=int, default=100, help="Number of images measured.")
+    parser.add_argument("--image_size", type=int, default=1000, help="Side of the generated images.")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[512, 768], help="Training resolutions.")
+    parser.add_argument("--epoch_images", type=int, default=20000, help="Number of images of an epoch.")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of passes, the fastest is kept.")
+    args = parser.parse_args()
+
+    if args.image_dir is not None:
+        paths = sorted(glob.glob(os.path.join(args.image_dir, "*.jpg")))[: args.num_images]
+        if not paths:
+            raise ValueError(f"No JPEG images in {args.image_dir}")
+        images = []
+        for path in paths:
+            with open(path, "rb") as f:
+                images.append(f.read())
+    else:
+        images = synthetic_images(args.num_images, args.image_size)
+    with Image.open(io.BytesIO(images[0])) as image:
+        print(f"{len(images)} images, e.g. {image.width}x{image.height}")
+
+    for resolution in args.resolutions:
+        full = load_time(images, resolution, reduced=False, repeats=args.repeats)
+        reduced = load_time(images, resolution, reduced=True, repeats=args.repeats)
+        print(
+            f"resolution {resolution}: full decode {full * 1000:.2f} ms/image "
+            f"({full * args.epoch_images:.0f} s/epoch), reduced decode {reduced * 1000:.2f} ms/image "
+            f"({reduced * args.epoch_images:.0f} s/epoch), {full / reduced:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+This module defines an AdapterRegistry class that switches the LoRA adapter of a resident pipeline without reloading
+the base model, e.g. to compare the final LoRA weights of a run with one of its checkpoints.
+"""
+
+import logging
+import os
+from collections import OrderedDict
+from typing import Optional
+
+import torch
+from safetensors.torch import load_file
+
+logger = logging.getLogger(__name__)
+
+# Files holding LoRA attention processor weights, in order of preference: outputs of `unet.save_attn_procs` and
+# LoRA-only checkpoints of the training script, then checkpoints written by `accelerator.save_state`.
+LORA_WEIGHTS_NAMES = ["pytorch_lora_weights.safetensors", "pytorch_lora_weights.bin", "pytorch_model.bin"]
+
+
+def load_lora_state_dict(path: str) -> dict:
+    """
+    Load LoRA attention processor weights on CPU, memory-mapping the file instead of reading it.
+
+    Args:
+        path: A weights file, or a directory holding one of LORA_WEIGHTS_NAMES.
+
+    Returns:
+        dict: The state dict, with the keys expected by `unet.load_attn_procs`.
+    """
+    if os.path.isdir(path):
+        for name in LORA_WEIGHTS_NAMES:
+            if os.path.isfile(os.path.join(path, name)):
+                path = os.path.join(path, name)
+                break
+        else:
+            raise FileNotFoundError(f"No LoRA weights in {path}, expected one of {LORA_WEIGHTS_NAMES}")
+    if path.endswith(".safetensors"):
+        return load_file(path, device="cpu")
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+
+def state_dict_size(state_dict: dict) -> int:
+    """
+    Compute the size of a state dict.
+
+    Args:
+        state_dict: The state dict.
+
+    Returns:
+        int: The size of the tensors, in bytes.
+    """
+    return sum(tensor.numel() * tensor.element_size() for tensor in state_dict.values())
+
+
+def remove_lora_layers(unet):
+    """
+    Remove the LoRA layers of a UNet. Weights fused with `unet.fuse_lora` are kept.
+
+    Args:
+        unet: The UNet.
+    """
+    for module in unet.modules():
+        if hasattr(module, "set_lora_layer"):
+            module.set_lora_layer(None)
+
+
+class AdapterRegistry:
+    """
+    Registry of LoRA adapters over the UNet of a single resident pipeline.
+
+    Adapters are loaded on demand and the most recently used ones are kept in an LRU cache, bounded by a number of
+    adapters and a memory budget. Activating an adapter only replaces the LoRA layers of the UNet. It can optionally
+    be fused into the base weights, which removes the LoRA matmuls from every denoising step until another adapter
+    is activated.
+
+    Attributes:
+        unet: The UNet of the pipeline.
+        paths: The path of each registered adapter.
+        max_adapters: The maximum number of adapters kept in memory.
+        memory_budget: The maximum size of the adapters kept in memory, in bytes, or None for no limit.
+        active: The name of the active adapter, or None for the base model.
+    """
+
+    def __init__(self, unet, max_adapters: int = 4, memory_budget_mb: Optional[float] = None):
+        """
+        Initialize an empty registry.
+
+        Args:
+            unet: The UNet of the pipeline.
+            max_adapters: The maximum number of adapters kept in memory.
+            memory_budget_mb: The maximum size of the adapters kept in memory, in megabytes, or None for no limit.
+        """
+        self.unet = unet
+        self.paths = {}
+        self.max_adapters = max_adapters
+        self.memory_budget = memory_budget_mb * 2**20 if memory_budget_mb is not None else None
+        self.active = None
+        self.fused = False
+        self.scale = 1.0
+        self._cache = OrderedDict()
+
+    def register(self, name: str, path: str):
+        """
+        Register an adapter, without loading it.
+
+        Args:
+            name: The name of the adapter.
+            path: A weights file, or a directory holding one of LORA_WEIGHTS_NAMES.
+        """
+        self.paths[name] = path
+
+    def _state_dict(self, name: str) -> dict:
+        if name in self._cache:
+            self._cache.move_to_end(name)
+            return self._cache[name]
+        if name not in self.paths:
+            raise KeyError(f"Unknown adapter {name}, registered adapters are {list(self.paths)}")
+
+        state_dict = load_lora_state_dict(self.paths[name])
+        self._cache[name] = state_dict
+        while len(self._cache) > 1 and (
+            len(self._cache) > self.max_adapters
+            or (
+                self.memory_budget is not None
+                and sum(state_dict_size(sd) for sd in self._cache.values()) > self.memory_budget
+            )
+        ):
+            evicted, _ = self._cache.popitem(last=False)
+            logger.info(f"Evicted adapter {evicted}")
+        return state_dict
+
+    def activate(self, name: Optional[str], scale: float = 1.0, fuse: bool = False):
+        """
+        Make an adapter the active one. Does nothing if it is already active with the same scale and fusion.
+
+        Args:
+            name: The name of the adapter, or None for the base model.
+            scale: The LoRA scale. When not fused, pass `cross_attention_kwargs={"scale": registry.scale}` to the
+                pipeline.
+            fuse: Whether to fuse the adapter into the base weights.
+        """
+        if name == self.active and scale == self.scale and (fuse == self.fused or name is None):
+            return
+        was_fused = self.fused
+        if self.fused:
+            self.unet.unfuse_lora()
+            self.fused = False
+        # Fusing drops the LoRA layers, and unfusing only restores the base weights
+        if name != self.active or was_fused:
+            remove_lora_layers(self.unet)
+            if name is not None:
+                self.unet.load_attn_procs(self._state_dict(name))
+        if name is not None and fuse:
+            self.unet.fuse_lora(lora_scale=scale)
+            self.fused = True
+        self.active = name
+        self.scale = scale
+
+    def cross_attention_kwargs(self) -> Optional[dict]:
+        """
+        Get the pipeline arguments applying the scale of the active adapter.
+
+        Returns:
+            Optional[dict]: The `cross_attention_kwargs` of the pipeline call, or None if no unfused adapter is active.
+        """
+        if self.active is None or self.fused:
+            return None
+        return {"scale": self.scale}
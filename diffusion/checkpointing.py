@@ -0,0 +1,337 @@
+"""
+This module defines an AsyncCheckpointWriter class that snapshots the LoRA training state to CPU memory and
+serializes it with safetensors in a background thread, so that checkpointing does not block the training loop.
+"""
+
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+from typing import Optional
+
+import torch
+from safetensors.torch import load_file, save_file
+
+logger = logging.getLogger(__name__)
+
+# Same file name as `unet.save_attn_procs(..., safe_serialization=True)`, so that a checkpoint directory can be
+# loaded directly with `unet.load_attn_procs(checkpoint_dir)`.
+LORA_WEIGHTS_NAME = "pytorch_lora_weights.safetensors"
+OPTIMIZER_NAME = "optimizer.safetensors"
+RANDOM_STATES_NAME = "random_states.safetensors"
+TRAINING_STATE_NAME = "training_state.json"
+# States of the samplers, saved next to the `accelerator.save_state` checkpoints
+EXTRA_STATE_NAME = "extra_state.json"
+
+
+def list_checkpoints(output_dir: str) -> list:
+    """
+    List the checkpoint directories of a training run, sorted by global step.
+
+    Args:
+        output_dir: The output directory of the training run.
+
+    Returns:
+        list: The names of the checkpoint directories, oldest first.
+    """
+    if not os.path.isdir(output_dir):
+        return []
+    checkpoints = [d for d in os.listdir(output_dir) if d.startswith("checkpoint")]
+    return sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
+
+
+def is_lora_checkpoint(checkpoint_dir: str) -> bool:
+    """
+    Tell whether a checkpoint directory was written by AsyncCheckpointWriter (as opposed to `accelerator.save_state`).
+
+    Args:
+        checkpoint_dir: Path of the checkpoint directory.
+
+    Returns:
+        bool: True if the directory contains a training state written by AsyncCheckpointWriter.
+    """
+    return os.path.isfile(os.path.join(checkpoint_dir, TRAINING_STATE_NAME))
+
+
+def save_extra_state(checkpoint_dir: str, extra_state: Optional[dict]):
+    """
+    Save the states that are not registered with `accelerator.register_for_checkpointing` to a checkpoint directory
+    written by `accelerator.save_state`, so that the number of accelerate custom objects does not depend on the
+    training options.
+
+    Args:
+        checkpoint_dir: Path of the checkpoint directory.
+        extra_state: JSON-serializable states, e.g. of the samplers. Nothing is written if None.
+    """
+    if extra_state is None:
+        return
+    with open(os.path.join(checkpoint_dir, EXTRA_STATE_NAME), "w") as f:
+        json.dump(extra_state, f)
+
+
+def load_extra_state(checkpoint_dir: str) -> dict:
+    """
+    Load the states saved by `save_extra_state`.
+
+    Args:
+        checkpoint_dir: Path of the checkpoint directory.
+
+    Returns:
+        dict: The states, empty for the checkpoints written without them (e.g. by older versions of the script).
+    """
+    path = os.path.join(checkpoint_dir, EXTRA_STATE_NAME)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _flatten_optimizer_state(state_dict: dict) -> tuple:
+    """
+    Split an optimizer state dict into a flat dict of tensors and a JSON-serializable remainder.
+
+    Args:
+        state_dict: The optimizer state dict.
+
+    Returns:
+        tuple: The flat tensors dict (keys are 'state.<param index>.<name>') and the remainder dict.
+    """
+    tensors = {}
+    scalars = {}
+    for param_idx, param_state in state_dict["state"].items():
+        for name, value in param_state.items():
+            key = f"state.{param_idx}.{name}"
+            if torch.is_tensor(value):
+                tensors[key] = value
+            else:
+                scalars[key] = value
+    return tensors, {"scalars": scalars, "param_groups": state_dict["param_groups"]}
+
+
+def _unflatten_optimizer_state(tensors: dict, remainder: dict) -> dict:
+    """
+    Rebuild an optimizer state dict from the output of `_flatten_optimizer_state`.
+
+    Args:
+        tensors: The flat tensors dict.
+        remainder: The JSON-serializable remainder.
+
+    Returns:
+        dict: The optimizer state dict, ready for `optimizer.load_state_dict`.
+    """
+    state = {}
+    for key, value in [*tensors.items(), *remainder["scalars"].items()]:
+        _, param_idx, name = key.split(".", 2)
+        state.setdefault(int(param_idx), {})[name] = value
+    return {"state": state, "param_groups": remainder["param_groups"]}
+
+
+class AsyncCheckpointWriter:
+    """
+    Checkpoint writer that copies the training state to CPU memory on the calling thread and leaves serialization
+    and pruning of old checkpoints to a background thread.
+
+    Only the LoRA layers, the learning rate scheduler and the torch RNG states are saved at every checkpoint. The
+    optimizer state, which is twice as large as the LoRA layers with Adam, can be saved less frequently.
+
+    Attributes:
+        output_dir: The directory where checkpoints are written.
+        total_limit: The maximum number of checkpoints to keep, or None to keep them all.
+    """
+
+    def __init__(self, output_dir: str, total_limit: Optional[int] = None, max_pending: int = 1):
+        """
+        Initialize the writer and start its background thread.
+
+        Args:
+            output_dir: The directory where checkpoints are written.
+            total_limit: The maximum number of checkpoints to keep, or None to keep them all.
+            max_pending: The number of snapshots that can wait to be written before `save` blocks.
+        """
+        self.output_dir = output_dir
+        self.total_limit = total_limit
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _snapshot(tensors: dict) -> tuple:
+        """
+        Copy tensors to CPU memory without waiting for the device.
+
+        Args:
+            tensors: The tensors to copy.
+
+        Returns:
+            tuple: The CPU copies and a CUDA event to synchronize on before reading them (None on CPU).
+        """
+        on_cuda = any(t.is_cuda for t in tensors.values())
+        snapshot = {}
+        for name, tensor in tensors.items():
+            tensor = tensor.detach()
+            if tensor.is_cuda:
+                cpu_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+                cpu_tensor.copy_(tensor, non_blocking=True)
+            else:
+                cpu_tensor = tensor.clone()
+            snapshot[name] = cpu_tensor.contiguous()
+        event = None
+        if on_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        return snapshot, event
+
+    def save(
+        self,
+        global_step: int,
+        lora_state_dict: dict,
+        optimizer_state_dict: Optional[dict] = None,
+        lr_scheduler_state_dict: Optional[dict] = None,
+        extra_state: Optional[dict] = None,
+    ) -> str:
+        """
+        Snapshot the training state and queue it for writing to `<output_dir>/checkpoint-<global_step>`.
+
+        Args:
+            global_step: The current optimization step.
+            lora_state_dict: The state dict of the LoRA attention processors.
+            optimizer_state_dict: The optimizer state dict, or None to skip it for this checkpoint.
+            lr_scheduler_state_dict: The learning rate scheduler state dict.
+            extra_state: Additional JSON-serializable state to store with the checkpoint.
+
+        Returns:
+            str: The path of the checkpoint directory once written.
+        """
+        self._raise_if_failed()
+
+        tensors = {f"lora.{k}": v for k, v in lora_state_dict.items()}
+        optimizer_remainder = None
+        if optimizer_state_dict is not None:
+            optimizer_tensors, optimizer_remainder = _flatten_optimizer_state(optimizer_state_dict)
+            tensors.update({f"optimizer.{k}": v for k, v in optimizer_tensors.items()})
+        tensors["rng.torch"] = torch.get_rng_state()
+        if torch.cuda.is_available():
+            for i, rng_state in enumerate(torch.cuda.get_rng_state_all()):
+                tensors[f"rng.cuda.{i}"] = rng_state
+        snapshot, event = self._snapshot(tensors)
+
+        training_state = {
+            "global_step": global_step,
+            "lr_scheduler": lr_scheduler_state_dict,
+            "optimizer": optimizer_remainder,
+            **(extra_state or {}),
+        }
+        save_path = os.path.join(self.output_dir, f"checkpoint-{global_step}")
+        self._queue.put((save_path, snapshot, event, training_state))
+        return save_path
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            try:
+                self._write(*job)
+                self._prune()
+            except Exception as e:  # surfaced to the training loop by the next call to `save` or `close`
+                logger.exception("Failed to write checkpoint")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, save_path: str, snapshot: dict, event, training_state: dict):
+        if event is not None:
+            event.synchronize()
+
+        # Write to a hidden directory first so that an interrupted write is never picked up as the latest checkpoint
+        tmp_path = os.path.join(self.output_dir, f".{os.path.basename(save_path)}.tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        groups = {LORA_WEIGHTS_NAME: "lora.", OPTIMIZER_NAME: "optimizer.", RANDOM_STATES_NAME: "rng."}
+        for file_name, prefix in groups.items():
+            tensors = {k[len(prefix) :]: v for k, v in snapshot.items() if k.startswith(prefix)}
+            if tensors:
+                save_file(tensors, os.path.join(tmp_path, file_name))
+        with open(os.path.join(tmp_path, TRAINING_STATE_NAME), "w") as f:
+            json.dump(training_state, f)
+
+        shutil.rmtree(save_path, ignore_errors=True)
+        os.replace(tmp_path, save_path)
+        logger.info(f"Saved state to {save_path}")
+
+    def _prune(self):
+        if self.total_limit is None:
+            return
+        checkpoints = list_checkpoints(self.output_dir)
+        removing_checkpoints = checkpoints[: max(len(checkpoints) - self.total_limit, 0)]
+        if removing_checkpoints:
+            logger.info(f"removing checkpoints: {', '.join(removing_checkpoints)}")
+        for removing_checkpoint in removing_checkpoints:
+            shutil.rmtree(os.path.join(self.output_dir, removing_checkpoint))
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError("A previous checkpoint could not be written") from self._error
+
+    def wait(self):
+        """
+        Block until every queued checkpoint has been written.
+        """
+        self._queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        """
+        Write the remaining checkpoints and stop the background thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_if_failed()
+
+
+def load_checkpoint(checkpoint_dir: str, lora_layers: torch.nn.Module, optimizer=None, lr_scheduler=None) -> dict:
+    """
+    Restore a checkpoint written by AsyncCheckpointWriter.
+
+    Args:
+        checkpoint_dir: Path of the checkpoint directory.
+        lora_layers: The (unwrapped) LoRA attention processor layers.
+        optimizer: The optimizer to restore, if any. It is left untouched when the checkpoint has no optimizer state.
+        lr_scheduler: The learning rate scheduler to restore, if any.
+
+    Returns:
+        dict: The training state stored with the checkpoint.
+    """
+    with open(os.path.join(checkpoint_dir, TRAINING_STATE_NAME)) as f:
+        training_state = json.load(f)
+
+    lora_layers.load_state_dict(load_file(os.path.join(checkpoint_dir, LORA_WEIGHTS_NAME)))
+
+    optimizer_path = os.path.join(checkpoint_dir, OPTIMIZER_NAME)
+    if optimizer is not None:
+        if training_state["optimizer"] is not None and os.path.isfile(optimizer_path):
+            optimizer.load_state_dict(
+                _unflatten_optimizer_state(load_file(optimizer_path), training_state["optimizer"])
+            )
+        else:
+            logger.warning(f"{checkpoint_dir} has no optimizer state, the optimizer starts from scratch")
+
+    if lr_scheduler is not None and training_state["lr_scheduler"] is not None:
+        lr_scheduler.load_state_dict(training_state["lr_scheduler"])
+
+    random_states_path = os.path.join(checkpoint_dir, RANDOM_STATES_NAME)
+    if os.path.isfile(random_states_path):
+        random_states = load_file(random_states_path)
+        torch.set_rng_state(random_states["torch"])
+        if torch.cuda.is_available():
+            cuda_keys = sorted((k for k in random_states if k.startswith("cuda.")), key=lambda k: int(k.split(".")[1]))
+            cuda_states = [random_states[k] for k in cuda_keys]
+            if len(cuda_states) == torch.cuda.device_count():
+                torch.cuda.set_rng_state_all(cuda_states)
+
+    return training_state
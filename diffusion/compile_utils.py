@@ -0,0 +1,78 @@
+"""
+This module defines the helpers of the `--compile` mode of the training script: compilation of the UNet forward and
+of the loss computation with `torch.compile`, graph-break reporting, and the choice of the attention processor.
+"""
+
+import logging
+from typing import Callable
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+
+def compile_function(fn: Callable, backend: str = "inductor", mode: str = "default") -> Callable:
+    """
+    Compile a module or a function with `torch.compile`.
+
+    Args:
+        fn: The module or function.
+        backend: The `torch.compile` backend, 'inductor' also runs on CPU.
+        mode: The `torch.compile` mode, among COMPILE_MODES. Modes other than 'default' only apply to inductor.
+
+    Returns:
+        Callable: The compiled module or function, compiled lazily at its first call.
+    """
+    if backend != "inductor" and mode != "default":
+        logger.warning(f"The compile mode {mode} only applies to the inductor backend, ignoring it")
+        mode = None
+    return torch.compile(fn, backend=backend, mode=mode)
+
+
+def report_graph_breaks(name: str, fn: Callable, *args, **kwargs) -> int:
+    """
+    Trace a function with TorchDynamo and log its graph breaks, without compiling it.
+
+    `torch._dynamo.explain` resets the compilation caches, so this must be called before the compiled functions
+    run, or they are compiled again.
+
+    Args:
+        name: The name of the function in the logs.
+        fn: The function or module, not compiled.
+        *args: Example positional arguments.
+        **kwargs: Example keyword arguments.
+
+    Returns:
+        int: The number of graph breaks.
+    """
+    explanation = torch._dynamo.explain(fn)(*args, **kwargs)
+    logger.info(f"{name}: {explanation.graph_count} graphs, {explanation.graph_break_count} graph breaks")
+    for reason in explanation.break_reasons:
+        frame = reason.user_stack[-1] if reason.user_stack else None
+        location = f" ({frame.filename}:{frame.lineno})" if frame is not None else ""
+        logger.info(f"    {reason.reason}{location}")
+    return explanation.graph_break_count
+
+
+def lora_attn_processor_class(use_xformers: bool = False):
+    """
+    Choose the LoRA attention processor.
+
+    Both processors have the same LoRA layers, so their weights are interchangeable.
+
+    Args:
+        use_xformers: Whether xformers attention was requested. Without xformers, the processor falls back to
+            PyTorch scaled dot-product attention.
+
+    Returns:
+        type: LoRAAttnProcessor2_0, using PyTorch scaled dot-product attention, if available, else LoRAAttnProcessor.
+    """
+    from diffusers.models.attention_processor import LoRAAttnProcessor, LoRAAttnProcessor2_0
+    from diffusers.utils.import_utils import is_xformers_available
+
+    if use_xformers and not is_xformers_available():
+        logger.warning("xformers is not available, falling back to PyTorch scaled dot-product attention")
+    if hasattr(F, "scaled_dot_product_attention"):
+        return LoRAAttnProcessor2_0
+    return LoRAAttnProcessor
@@ -0,0 +1,281 @@
+"""
+This module defines the near-duplicate rebalancing of the dataset build: the same reference watch is often listed many
+times, with nearly identical specifications and photos, and would otherwise be repeated in every epoch.
+
+Two samples are near-duplicates when the Jaccard similarity of their caption tokens, estimated by MinHash, is above a
+threshold, and the Hamming distance of the difference hashes (dHash) of their images is at most a few bits. The image
+condition keeps apart the different views of a same watch, which share their caption.
+
+Candidates are found in sub-quadratic time with locality-sensitive hashing: each sample is put in one bucket per pair
+of a MinHash band and a dHash band, and is only compared to the first sample of each of its buckets. A pair within
+the Hamming distance shares a dHash band (pigeonhole principle), and a pair above the Jaccard threshold very likely
+shares a MinHash band. The near-duplicate pairs are merged into clusters with a union-find.
+
+Each cluster is then either capped to a number of samples, or kept whole with weights that the training sampler
+uses to draw, in each epoch, about as many samples of the cluster as the cap: epochs are shorter, but every sample is
+seen over the epochs.
+"""
+
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from options import DEDUP_MODES
+
+logger = logging.getLogger(__name__)
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def caption_tokens(caption: str) -> set:
+    """
+    Split a caption into its key:value tokens.
+
+    Args:
+        caption: The caption, as formatted by `watches_dataset.format_caption`.
+
+    Returns:
+        set: The tokens.
+    """
+    return {token.strip() for token in caption.split(",") if token.strip()}
+
+
+class MinHasher:
+    """
+    MinHash signatures of token sets, with the permutations (a * x + b) mod p of 32-bit token hashes.
+
+    Attributes:
+        num_perm: The number of permutations, i.e. the length of the signatures.
+    """
+
+    def __init__(self, num_perm: int = 128, seed: int = 0):
+        """
+        Draw the permutations.
+
+        Args:
+            num_perm: The number of permutations.
+            seed: The seed of the permutations.
+        """
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        # a * x + b stays below 2^64 as a, b and x are below 2^32
+        self.a = rng.integers(1, MAX_HASH, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, MAX_HASH, size=(num_perm, 1), dtype=np.uint64)
+
+    def signature(self, tokens: set) -> np.ndarray:
+        """
+        Compute the signature of a token set.
+
+        Args:
+            tokens: The tokens.
+
+        Returns:
+            np.ndarray: The uint32 signature, of length `num_perm`.
+        """
+        if not tokens:
+            return np.full(self.num_perm, MAX_HASH, dtype=np.uint32)
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(token.encode(), digest_size=4).digest(), "little") for token in tokens],
+            dtype=np.uint64,
+        )
+        permuted = (self.a * hashes[None, :] + self.b) % MERSENNE_PRIME & MAX_HASH
+        return permuted.min(axis=1).astype(np.uint32)
+
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """
+    Compute the difference hash of an image: whether each pixel of a (hash_size + 1) x hash_size grayscale thumbnail
+    is brighter than its right neighbour.
+
+    Args:
+        image: The image.
+        hash_size: The side of the hash, 8 for a 64-bit hash.
+
+    Returns:
+        int: The hash.
+    """
+    # JPEG images are decoded directly at a reduced scale
+    image.draft("L", (4 * hash_size, 4 * hash_size))
+    pixels = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def dhash_file(path: str) -> Optional[int]:
+    """
+    Compute the difference hash of an image file, in a worker process.
+
+    Args:
+        path: The image file.
+
+    Returns:
+        Optional[int]: The 64-bit hash, or None if the image can't be decoded.
+    """
+    try:
+        with Image.open(path) as image:
+            return dhash(image)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+class UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i: int, j: int):
+        self.parent[self.find(i)] = self.find(j)
+
+
+def near_duplicate_clusters(
+    signatures: np.ndarray,
+    image_hashes: list,
+    threshold: float = 0.8,
+    caption_bands: int = 16,
+    max_hamming: int = 7,
+) -> np.ndarray:
+    """
+    Cluster near-duplicate samples.
+
+    Args:
+        signatures: The (num_samples, num_perm) MinHash signatures of the captions.
+        image_hashes: The 64-bit dHash of each image, None for the images that can't be decoded, which are never
+            near-duplicates.
+        threshold: The minimum estimated Jaccard similarity of the captions of near-duplicates.
+        caption_bands: The number of MinHash bands, which must divide the number of permutations. More bands find
+            pairs of lower similarity, at the cost of more comparisons.
+        max_hamming: The maximum Hamming distance of the dHash of near-duplicates.
+
+    Returns:
+        np.ndarray: The cluster of each sample, as the index of a sample of the cluster.
+    """
+    num_samples, num_perm = signatures.shape
+    if num_perm % caption_bands:
+        raise ValueError(f"The number of MinHash bands {caption_bands} must divide the signature length {num_perm}")
+    rows = num_perm // caption_bands
+    # Split the 64-bit dHash in max_hamming + 1 bands, so that hashes within max_hamming bits share one
+    image_bands = max_hamming + 1
+    band_bits = np.array_split(np.arange(64), image_bands)
+    band_masks = [(sum(1 << int(bit) for bit in bits), int(bits[0])) for bits in band_bits]
+
+    clusters = UnionFind(num_samples)
+    representatives = {}
+    for i in range(num_samples):
+        image_hash = image_hashes[i]
+        if image_hash is None:
+            continue
+        caption_keys = [signatures[i, band * rows : (band + 1) * rows].tobytes() for band in range(caption_bands)]
+        image_keys = [(image_hash & mask) >> shift for mask, shift in band_masks]
+        for caption_band, caption_key in enumerate(caption_keys):
+            for image_band, image_key in enumerate(image_keys):
+                key = (caption_band, caption_key, image_band, image_key)
+                j = representatives.setdefault(key, i)
+                if j == i or clusters.find(i) == clusters.find(j):
+                    continue
+                similarity = np.count_nonzero(signatures[i] == signatures[j]) / num_perm
+                if similarity >= threshold and bin(image_hash ^ image_hashes[j]).count("1") <= max_hamming:
+                    clusters.union(i, j)
+    return np.array([clusters.find(i) for i in range(num_samples)])
+
+
+class NearDuplicateRebalancer:
+    """
+    Rebalancing of the clusters of near-duplicate samples of the dataset.
+
+    Attributes:
+        mode: 'cap' to keep at most `max_per_cluster` samples per cluster, or 'weight' to keep every sample with a
+            'weight' column of min(1, max_per_cluster / cluster size), used by the training sampler.
+        max_per_cluster: The number of samples per cluster kept, or drawn per epoch.
+        threshold: The minimum estimated Jaccard similarity of the captions of near-duplicates.
+        max_hamming: The maximum Hamming distance of the dHash of the images of near-duplicates.
+        num_workers: The number of image hashing processes.
+    """
+
+    def __init__(
+        self,
+        mode: str = "weight",
+        max_per_cluster: int = 2,
+        threshold: float = 0.8,
+        max_hamming: int = 7,
+        num_perm: int = 128,
+        num_workers: Optional[int] = None,
+    ):
+        """
+        Initialize the rebalancing.
+
+        Args:
+            mode: 'cap' or 'weight'.
+            max_per_cluster: The number of samples per cluster kept, or drawn per epoch.
+            threshold: The minimum estimated Jaccard similarity of the captions of near-duplicates.
+            max_hamming: The maximum Hamming distance of the dHash of the images of near-duplicates.
+            num_perm: The number of MinHash permutations.
+            num_workers: The number of image hashing processes, the number of CPUs by default.
+        """
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Unknown dedup mode {mode}, choose between {DEDUP_MODES}")
+        self.mode = mode
+        self.max_per_cluster = max_per_cluster
+        self.threshold = threshold
+        self.max_hamming = max_hamming
+        self.minhasher = MinHasher(num_perm)
+        self.num_workers = num_workers or os.cpu_count()
+
+    def apply(self, images: list, texts: list) -> dict:
+        """
+        Cluster the near-duplicate samples and rebalance the clusters.
+
+        Args:
+            images: The image files.
+            texts: The captions.
+
+        Returns:
+            dict: The "image" and "text" columns, and the "weight" column in 'weight' mode.
+        """
+        if not images:
+            return {"image": images, "text": texts, **({"weight": []} if self.mode == "weight" else {})}
+
+        # The images of a watch share their caption, the signature is computed once per caption
+        caption_signatures = {}
+        for text in texts:
+            if text not in caption_signatures:
+                caption_signatures[text] = self.minhasher.signature(caption_tokens(text))
+        signatures = np.stack([caption_signatures[text] for text in texts])
+        with ProcessPoolExecutor(self.num_workers) as executor:
+            image_hashes = list(executor.map(dhash_file, images, chunksize=256))
+
+        clusters = near_duplicate_clusters(signatures, image_hashes, self.threshold, max_hamming=self.max_hamming)
+        _, inverse, sizes = np.unique(clusters, return_inverse=True, return_counts=True)
+        cluster_sizes = sizes[inverse]
+        logger.info(
+            f"Found {np.count_nonzero(sizes > 1)} clusters of near-duplicates, "
+            f"covering {np.count_nonzero(cluster_sizes > 1)} of {len(images)} samples"
+        )
+
+        if self.mode == "weight":
+            weights = np.minimum(1.0, self.max_per_cluster / cluster_sizes)
+            logger.info(f"Expected samples per epoch: {weights.sum():.0f} of {len(images)}")
+            return {"image": images, "text": texts, "weight": weights.tolist()}
+
+        seen = {}
+        keep = []
+        for cluster in clusters:
+            seen[cluster] = seen.get(cluster, 0) + 1
+            keep.append(seen[cluster] <= self.max_per_cluster)
+        logger.info(f"Kept {sum(keep)} of {len(images)} samples")
+        return {
+            "image": [image for image, kept in zip(images, keep) if kept],
+            "text": [text for text, kept in zip(texts, keep) if kept],
+        }
@@ -0,0 +1,313 @@
+"""
+This module defines a command line interface that fuses the trained LoRA weights into the attention projections of
+the base UNet and exports a standalone model for CPU generation hosts:
+
+- a Stable Diffusion pipeline saved as fp16/bf16 safetensors, loadable without the LoRA weights,
+- optionally, the UNet exported to TorchScript or ONNX, with its linear layers dynamically quantized to int8.
+
+Fusing removes the extra LoRA matmuls that `LoRAAttnProcessor` adds to every attention layer at every denoising
+step. The `--benchmark` option compares the seconds per image of the unfused, fused and quantized UNets on CPU.
+
+Example:
+    python diffusion/export.py \\
+        --pretrained_model_name_or_path stabilityai/stable-diffusion-2-1 \\
+        --lora_dir models/lora/stable-diffusion-2-1-chronext \\
+        --output_dir models/fused/stable-diffusion-2-1-chronext \\
+        --export_format torchscript --quantize --benchmark
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import time
+
+import torch
+from diffusers import StableDiffusionPipeline
+
+from adapters import load_lora_state_dict, remove_lora_layers
+
+logger = logging.getLogger(__name__)
+
+DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16, "float32": torch.float32}
+EXPORT_FORMATS = ["onnx", "torchscript"]
+
+
+class PlainLinear(torch.nn.Module):
+    """
+    Stand-in for the LoRA-compatible linear layers of diffusers once their LoRA weights are fused.
+
+    Attention processors call these layers with an extra `scale` argument, which a plain `torch.nn.Linear` (and its
+    quantized version) does not accept. The wrapped layer is a plain `torch.nn.Linear`, so it can be quantized.
+    """
+
+    def __init__(self, linear: torch.nn.Linear):
+        super().__init__()
+        self.linear = torch.nn.Linear(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            device=linear.weight.device,
+            dtype=linear.weight.dtype,
+        )
+        self.linear.weight = linear.weight
+        self.linear.bias = linear.bias
+
+    def forward(self, hidden_states: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        return self.linear(hidden_states)
+
+
+class UNetExportWrapper(torch.nn.Module):
+    """
+    UNet returning a tensor instead of an output dataclass, for tracing.
+    """
+
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(
+        self, sample: torch.Tensor, timestep: torch.Tensor, encoder_hidden_states: torch.Tensor
+    ) -> torch.Tensor:
+        return self.unet(sample, timestep, encoder_hidden_states, return_dict=False)[0]
+
+
+def fuse_lora_weights(unet, lora_path: str, scale: float = 1.0):
+    """
+    Fuse LoRA weights into the attention projections of a UNet, then remove its LoRA layers.
+
+    Args:
+        unet: The UNet.
+        lora_path: A weights file, or a directory holding the weights saved by the training script.
+        scale: The LoRA scale.
+    """
+    if not any(getattr(module, "lora_layer", None) is not None for module in unet.modules()):
+        unet.load_attn_procs(load_lora_state_dict(lora_path))
+    unet.fuse_lora(lora_scale=scale)
+    remove_lora_layers(unet)
+
+
+def quantize_unet(unet) -> torch.nn.Module:
+    """
+    Copy a UNet whose LoRA weights are fused, and dynamically quantize its linear layers to int8.
+
+    Args:
+        unet: The UNet.
+
+    Returns:
+        torch.nn.Module: The quantized float32 UNet, on CPU.
+    """
+    unet = copy.deepcopy(unet).float().cpu()
+    for module in list(unet.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, torch.nn.Linear) and hasattr(child, "set_lora_layer"):
+                setattr(module, name, PlainLinear(child))
+    return torch.ao.quantization.quantize_dynamic(unet, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def export_unet(unet, path: str, export_format: str, sample_size: int):
+    """
+    Export a UNet with dynamic batch size, the timestep being a tensor of one value per sample.
+
+    Args:
+        unet: The UNet, on CPU.
+        path: The output file.
+        export_format: 'onnx' or 'torchscript'.
+        sample_size: The height and width of the example latents.
+    """
+    config = unet.config
+    inputs = (
+        torch.randn(2, config.in_channels, sample_size, sample_size),
+        torch.full((2,), 999, dtype=torch.long),
+        torch.randn(2, 77, config.cross_attention_dim),
+    )
+    wrapper = UNetExportWrapper(unet).eval()
+    with torch.no_grad():
+        if export_format == "torchscript":
+            torch.jit.save(torch.jit.trace(wrapper, inputs, check_trace=False), path)
+        else:
+            torch.onnx.export(
+                wrapper,
+                inputs,
+                path,
+                input_names=["sample", "timestep", "encoder_hidden_states"],
+                output_names=["out_sample"],
+                dynamic_axes={
+                    "sample": {0: "batch", 2: "height", 3: "width"},
+                    "timestep": {0: "batch"},
+                    "encoder_hidden_states": {0: "batch"},
+                    "out_sample": {0: "batch", 2: "height", 3: "width"},
+                },
+                opset_version=17,
+            )
+
+
+def quantize_onnx(path: str, output_path: str):
+    """
+    Dynamically quantize the weights of the matmuls of an ONNX model to int8 with onnxruntime.
+
+    Args:
+        path: The float32 ONNX model.
+        output_path: The quantized ONNX model.
+    """
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+    except ImportError:
+        raise ImportError(
+            "Quantizing ONNX models requires onnxruntime. You can install it with `pip install onnxruntime`"
+        )
+    quantize_dynamic(path, output_path, weight_type=QuantType.QInt8, use_external_data_format=True)
+
+
+@torch.no_grad()
+def seconds_per_image(pipeline, prompt: str, num_images: int, resolution: int, num_inference_steps: int, **kwargs):
+    """
+    Measure the generation time of a pipeline, after a warm-up image.
+
+    Args:
+        pipeline: The pipeline.
+        prompt: The prompt.
+        num_images: The number of timed images.
+        resolution: The height and width of the images.
+        num_inference_steps: The number of denoising steps.
+        **kwargs: Additional arguments of the pipeline call.
+
+    Returns:
+        float: The mean number of seconds per image.
+    """
+    call = dict(prompt=prompt, height=resolution, width=resolution, num_inference_steps=num_inference_steps, **kwargs)
+    pipeline(**call, generator=torch.Generator().manual_seed(0))
+    start = time.perf_counter()
+    for seed in range(num_images):
+        pipeline(**call, generator=torch.Generator().manual_seed(seed))
+    return (time.perf_counter() - start) / num_images
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fuse the trained LoRA weights into the base model and export it.")
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        required=True,
+        help="Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--revision",
+        type=str,
+        default=None,
+        help="Revision of pretrained model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--lora_dir",
+        type=str,
+        required=True,
+        help="Output directory of the training script (or a checkpoint directory) holding the LoRA weights.",
+    )
+    parser.add_argument("--lora_scale", type=float, default=1.0, help="Scale of the fused LoRA weights.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory to write the exported model to.")
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="float16",
+        choices=list(DTYPES),
+        help="Dtype of the saved safetensors pipeline.",
+    )
+    parser.add_argument(
+        "--export_format",
+        type=str,
+        default=None,
+        choices=EXPORT_FORMATS,
+        help="Also export the fused UNet to ONNX or TorchScript, in float32 for CPU inference.",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Dynamically quantize the linear layers of the exported UNet to int8.",
+    )
+    parser.add_argument(
+        "--resolution",
+        type=int,
+        default=512,
+        help="Resolution of the example inputs of the export and of the benchmark images.",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Compare the seconds per image of the unfused, fused and quantized UNets on CPU.",
+    )
+    parser.add_argument("--benchmark_images", type=int, default=3, help="Number of timed images per variant.")
+    parser.add_argument("--benchmark_steps", type=int, default=20, help="Number of denoising steps per image.")
+    parser.add_argument(
+        "--benchmark_prompt", type=str, default="Rolex Submariner, steel case, black dial", help="Benchmark prompt."
+    )
+
+    args = parser.parse_args()
+    if args.quantize and args.export_format is None and not args.benchmark:
+        raise ValueError("--quantize applies to the exported UNet, it requires --export_format or --benchmark.")
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", level=logging.INFO)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Fusion, quantization and the benchmark run in float32 on CPU, the saved pipeline is cast afterwards
+    pipeline = StableDiffusionPipeline.from_pretrained(
+        args.pretrained_model_name_or_path,
+        revision=args.revision,
+        torch_dtype=torch.float32,
+        safety_checker=None,
+        requires_safety_checker=False,
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    pipeline.unet.load_attn_procs(load_lora_state_dict(args.lora_dir))
+
+    results = {}
+    benchmark_args = (args.benchmark_prompt, args.benchmark_images, args.resolution, args.benchmark_steps)
+    if args.benchmark:
+        results["unfused"] = seconds_per_image(
+            pipeline, *benchmark_args, cross_attention_kwargs={"scale": args.lora_scale}
+        )
+
+    fuse_lora_weights(pipeline.unet, args.lora_dir, scale=args.lora_scale)
+    if args.benchmark:
+        results["fused"] = seconds_per_image(pipeline, *benchmark_args)
+
+    quantized_unet = quantize_unet(pipeline.unet) if args.quantize else None
+    if args.benchmark and quantized_unet is not None:
+        fused_unet, pipeline.unet = pipeline.unet, quantized_unet
+        results["quantized"] = seconds_per_image(pipeline, *benchmark_args)
+        pipeline.unet = fused_unet
+
+    if args.export_format is not None:
+        sample_size = args.resolution // pipeline.vae_scale_factor
+        if args.export_format == "torchscript":
+            path = os.path.join(args.output_dir, "unet.pt")
+            export_unet(quantized_unet or pipeline.unet, path, "torchscript", sample_size)
+        else:
+            # Quantized PyTorch modules do not export to ONNX, the float32 graph is quantized by onnxruntime
+            onnx_dir = os.path.join(args.output_dir, "unet_onnx")
+            os.makedirs(onnx_dir, exist_ok=True)
+            path = os.path.join(onnx_dir, "model.onnx")
+            export_unet(pipeline.unet, path, "onnx", sample_size)
+            if args.quantize:
+                quantize_onnx(path, os.path.join(onnx_dir, "model_int8.onnx"))
+        logger.info(f"Exported the UNet to {path}")
+
+    pipeline.to(DTYPES[args.dtype])
+    pipeline.save_pretrained(args.output_dir, safe_serialization=True)
+    with open(os.path.join(args.output_dir, "lora_fusion.json"), "w") as f:
+        json.dump({"lora_dir": args.lora_dir, "lora_scale": args.lora_scale, "dtype": args.dtype}, f, indent=2)
+    logger.info(f"Saved the fused {args.dtype} pipeline to {args.output_dir}")
+
+    if results:
+        for variant, seconds in results.items():
+            logger.info(f"{variant}: {seconds:.2f} s/image ({results['unfused'] / seconds:.2f}x)")
+        with open(os.path.join(args.output_dir, "benchmark.json"), "w") as f:
+            json.dump({"resolution": args.resolution, "steps": args.benchmark_steps, "seconds_per_image": results}, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+This module defines the reduced-resolution decoding of the training images: the stored images are about twice as large
+as the training resolution, and libjpeg can decode a JPEG directly at 1/2, 1/4 or 1/8 of its size by skipping the
+high frequencies of the DCT, several times faster than a full decode followed by a resize.
+
+The scale is the smallest one that keeps the shorter side of the image at least as large as the target size, so the
+resize and crop transforms that follow still downscale the image. Images in other formats are decoded at full size.
+"""
+
+import io
+import math
+from typing import Optional, Union
+
+from PIL import Image
+
+
+def draft_size(size: tuple, min_size: int) -> tuple:
+    """
+    Get the size requested to `Image.draft` so that the shorter side of the decoded image is at least `min_size`.
+
+    Args:
+        size: The (width, height) of the image.
+        min_size: The minimum length of the shorter side.
+
+    Returns:
+        tuple: The (width, height) requested, the image size scaled down to a `min_size` shorter side.
+    """
+    scale = min(1.0, min_size / min(size))
+    return math.ceil(size[0] * scale), math.ceil(size[1] * scale)
+
+
+def open_image(source: Union[bytes, str, dict, Image.Image]) -> Image.Image:
+    """
+    Open an image without decoding it.
+
+    Args:
+        source: The encoded image, its file, an undecoded `datasets.Image` value ({'bytes', 'path'}) or an opened image.
+
+    Returns:
+        Image.Image: The lazily decoded image.
+    """
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, dict):
+        source = source["bytes"] if source.get("bytes") is not None else source["path"]
+    return Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+
+
+def decode_image(
+    source: Union[bytes, str, dict, Image.Image], min_size: Optional[int] = None, mode: str = "RGB"
+) -> Image.Image:
+    """
+    Decode an image, at a reduced scale if it is a JPEG at least twice as large as `min_size`.
+
+    Args:
+        source: The encoded image, its file, an undecoded `datasets.Image` value ({'bytes', 'path'}) or an opened
+            image not loaded yet.
+        min_size: The minimum length of the shorter side of the decoded image. None decodes the image at full size.
+        mode: The mode of the decoded image.
+
+    Returns:
+        Image.Image: The decoded image, in `mode`.
+    """
+    image = open_image(source)
+    if min_size is not None:
+        # No-op for the formats without reduced-scale decoding, and for the images already loaded
+        image.draft(mode, draft_size(image.size, min_size))
+    return image.convert(mode)
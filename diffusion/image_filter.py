@@ -0,0 +1,226 @@
+"""
+This module defines the image-quality filter of the dataset build, that excludes the tiny, blurry, blank or heavily
+letterboxed and corrupted images before they cost decode and compute time in every training epoch.
+
+Images are scored in parallel batches by worker processes, with NumPy metrics computed on a reduced-size decode:
+
+- decode validity: the image decodes entirely,
+- resolution: the smallest side of the image,
+- background ratio: the fraction of pixels of the color of the border, high for blank and letterboxed images,
+- sharpness: the variance of the Laplacian over the other pixels, low for blurry images.
+
+Scores are cached in SQLite by the hash of the image bytes, and the files already scored are recognized by their
+path, size and modification time, so that the images of a rerun are neither read nor decoded again.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Side of the reduced-size decode the metrics are computed on
+SCORE_SIZE = 512
+# Maximum difference (0-255, per channel) between a background pixel and the color of the border
+BACKGROUND_TOLERANCE = 12
+
+DROP_REASONS = ["corrupted", "too_small", "background", "blurry"]
+
+
+def image_scores(image_bytes: bytes) -> dict:
+    """
+    Score an image.
+
+    Args:
+        image_bytes: The encoded image.
+
+    Returns:
+        dict: The 'valid' flag and, for valid images, their 'width', 'height', 'background_ratio' and 'sharpness'.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        width, height = image.size
+        # JPEG images are decoded directly at a reduced scale
+        image.draft("RGB", (SCORE_SIZE, SCORE_SIZE))
+        image = image.convert("RGB")
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return {"valid": False}
+    image.thumbnail((SCORE_SIZE, SCORE_SIZE))
+    pixels = np.asarray(image, dtype=np.int16)
+
+    border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+    background_color = np.median(border, axis=0)
+    background = (np.abs(pixels - background_color) <= BACKGROUND_TOLERANCE).all(axis=-1)
+
+    gray = pixels.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    laplacian = 4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1] - gray[1:-1, :-2] - gray[1:-1, 2:]
+    foreground = ~background[1:-1, 1:-1]
+    sharpness = float(laplacian[foreground].var()) if foreground.any() else 0.0
+    return {
+        "valid": True,
+        "width": width,
+        "height": height,
+        "background_ratio": float(background.mean()),
+        "sharpness": sharpness,
+    }
+
+
+def score_file(path: str) -> tuple:
+    """
+    Hash and score an image file, in a worker process.
+
+    Args:
+        path: The image file.
+
+    Returns:
+        tuple: The hash of the file and its scores.
+    """
+    try:
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+    except OSError:
+        return None, {"valid": False}
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest(), image_scores(image_bytes)
+
+
+class ImageQualityFilter:
+    """
+    Filter of the images below quality thresholds, with a persistent cache of their scores.
+
+    Attributes:
+        cache_path: The SQLite cache of the scores.
+        min_size: The minimum smallest side of an image, in pixels.
+        max_background_ratio: The maximum fraction of background pixels.
+        min_sharpness: The minimum variance of the Laplacian of the foreground.
+        num_workers: The number of worker processes.
+        batch_size: The number of images per batch sent to a worker.
+        report: The number of images dropped by reason, after `filter`.
+    """
+
+    def __init__(
+        self,
+        cache_path: str,
+        min_size: int = 256,
+        max_background_ratio: float = 0.97,
+        min_sharpness: float = 20.0,
+        num_workers: Optional[int] = None,
+        batch_size: int = 64,
+    ):
+        """
+        Initialize the filter.
+
+        Args:
+            cache_path: The SQLite cache of the scores, created if missing.
+            min_size: The minimum smallest side of an image, in pixels.
+            max_background_ratio: The maximum fraction of background pixels.
+            min_sharpness: The minimum variance of the Laplacian of the foreground.
+            num_workers: The number of worker processes, the number of CPUs by default.
+            batch_size: The number of images per batch sent to a worker.
+        """
+        self.cache_path = cache_path
+        self.min_size = min_size
+        self.max_background_ratio = max_background_ratio
+        self.min_sharpness = min_sharpness
+        self.num_workers = num_workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.report = Counter()
+
+    def drop_reason(self, scores: dict) -> Optional[str]:
+        """
+        Check scores against the thresholds.
+
+        Args:
+            scores: The scores of an image.
+
+        Returns:
+            Optional[str]: The first failed check among DROP_REASONS, or None if the image is kept.
+        """
+        if not scores["valid"]:
+            return "corrupted"
+        if min(scores["width"], scores["height"]) < self.min_size:
+            return "too_small"
+        if scores["background_ratio"] > self.max_background_ratio:
+            return "background"
+        if scores["sharpness"] < self.min_sharpness:
+            return "blurry"
+        return None
+
+    def scores(self, paths: list) -> list:
+        """
+        Score images, from the cache or with the worker processes.
+
+        Args:
+            paths: The image files.
+
+        Returns:
+            list: The scores of each image.
+        """
+        connection = sqlite3.connect(self.cache_path)
+        connection.execute("CREATE TABLE IF NOT EXISTS scores (hash TEXT PRIMARY KEY, scores TEXT NOT NULL)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)"
+        )
+        files = {row[0]: row[1:] for row in connection.execute("SELECT path, size, mtime_ns, hash FROM files")}
+        cached = dict(connection.execute("SELECT hash, scores FROM scores"))
+
+        results = [None] * len(paths)
+        stats = {}
+        missing = []
+        for i, path in enumerate(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                results[i] = {"valid": False}
+                continue
+            stats[path] = (stat.st_size, stat.st_mtime_ns)
+            known = files.get(path)
+            if known is not None and known[:2] == stats[path] and known[2] in cached:
+                results[i] = json.loads(cached[known[2]])
+            else:
+                missing.append(i)
+
+        if missing:
+            logger.info(f"Scoring {len(missing)} images ({len(paths) - len(missing)} cached)")
+            with ProcessPoolExecutor(self.num_workers) as executor:
+                scored = executor.map(score_file, [paths[i] for i in missing], chunksize=self.batch_size)
+                for i, (image_hash, scores) in zip(missing, scored):
+                    results[i] = scores
+                    if image_hash is None:
+                        continue
+                    connection.execute("INSERT OR REPLACE INTO scores VALUES (?, ?)", (image_hash, json.dumps(scores)))
+                    connection.execute(
+                        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (paths[i], *stats[paths[i]], image_hash)
+                    )
+            connection.commit()
+        connection.close()
+        return results
+
+    def filter(self, paths: list) -> list:
+        """
+        Select the images above the thresholds, and count the dropped ones in `report`.
+
+        Args:
+            paths: The image files.
+
+        Returns:
+            list: Whether each image is kept.
+        """
+        keep = []
+        self.report = Counter()
+        for scores in self.scores(paths):
+            reason = self.drop_reason(scores)
+            keep.append(reason is None)
+            if reason is not None:
+                self.report[reason] += 1
+        dropped = ", ".join(f"{self.report[reason]} {reason}" for reason in DROP_REASONS if self.report[reason])
+        logger.info(f"Kept {sum(keep)} of {len(paths)} images" + (f", dropped {dropped}" if dropped else ""))
+        return keep
@@ -0,0 +1,329 @@
+"""
+This module defines a WatchGenerator class that generates watch images with a base Stable Diffusion model and the
+LoRA attention processors trained by `train_txt_to_img_lora.py`, and a command line interface to generate images
+for prompts read from a file or built from the watches stored in MongoDB.
+
+Example:
+    python diffusion/inference.py \\
+        --pretrained_model_name_or_path stabilityai/stable-diffusion-2-1 \\
+        --lora_dir models/lora/stable-diffusion-2-1-chronext \\
+        --prompts_file diffusion/validation_prompts.txt \\
+        --output_dir generated
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+import pymongo
+import torch
+from diffusers import StableDiffusionPipeline
+
+from adapters import AdapterRegistry
+from validation import VALIDATION_SCHEDULERS, load_validation_scheduler
+from watches_dataset import FIELDS_TO_IGNORE, format_caption
+
+logger = logging.getLogger(__name__)
+
+# Name of the adapter loaded from `lora_dir`
+DEFAULT_ADAPTER = "default"
+
+
+def load_prompts_file(path: str, seed: int = 0) -> list:
+    """
+    Read prompts from a file.
+
+    A `.jsonl` file holds one {"prompt": ..., "seed": ...} record per line, the seed being optional. Any other file
+    holds one prompt per line; empty lines and lines starting with '#' are skipped.
+
+    Args:
+        path: Path of the prompts file.
+        seed: The seed of the first prompt without an explicit seed, incremented for each prompt.
+
+    Returns:
+        list: (prompt, seed) tuples.
+    """
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = [{"prompt": line.strip()} for line in f if line.strip() and not line.startswith("#")]
+    return [(record["prompt"], record.get("seed", seed + i)) for i, record in enumerate(records)]
+
+
+def load_mongo_prompts(
+    mongo_uri: str, mongo_port: int, mongo_db: str, mongo_collection: str, limit: int = 0, seed: int = 0
+) -> list:
+    """
+    Build prompts from the watches stored in MongoDB, with the same format as the training captions.
+
+    Args:
+        mongo_uri: MongoDB URI.
+        mongo_port: MongoDB port.
+        mongo_db: MongoDB database name.
+        mongo_collection: MongoDB collection name.
+        limit: The maximum number of watches to read, 0 for no limit.
+        seed: The seed of the first prompt, incremented for each prompt.
+
+    Returns:
+        list: (prompt, seed) tuples.
+    """
+    client = pymongo.MongoClient(mongo_uri, mongo_port)
+    try:
+        projection = {field: 0 for field in FIELDS_TO_IGNORE}
+        watches = client[mongo_db][mongo_collection].find({}, projection, limit=limit)
+        return [(format_caption(watch), seed + i) for i, watch in enumerate(watches)]
+    finally:
+        client.close()
+
+
+class ImageWriterPool:
+    """
+    Pool of threads encoding and writing images to disk while the next batch is generated.
+    """
+
+    def __init__(self, output_dir: str, num_workers: int = 4, image_format: str = "png"):
+        """
+        Initialize the pool.
+
+        Args:
+            output_dir: The directory to write images to.
+            num_workers: The number of writer threads.
+            image_format: The image file format, e.g. 'png' or 'jpg'.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.image_format = image_format
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="image-writer")
+        self.futures = []
+
+    def submit(self, image, name: str):
+        """
+        Queue an image for writing.
+
+        Args:
+            image: The PIL image.
+            name: The file name, without extension.
+        """
+        self.futures.append(
+            self.executor.submit(image.save, os.path.join(self.output_dir, f"{name}.{self.image_format}"))
+        )
+
+    def close(self):
+        """
+        Wait for every queued image to be written, and raise the first writing error if any.
+        """
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+
+class WatchGenerator:
+    """
+    Text-to-image generator holding a Stable Diffusion pipeline with the trained LoRA attention processors.
+
+    The pipeline is loaded once. Images are generated in batches whose size is halved when the device runs out of
+    memory, and every image has its own seeded generator, so an image only depends on its prompt and seed.
+
+    Attributes:
+        pipeline: The Stable Diffusion pipeline.
+        adapters: The registry of the LoRA adapters that can be activated on the pipeline.
+        device: The device the pipeline runs on.
+        batch_size: The current maximum number of images per batch.
+        num_inference_steps: The number of denoising steps per image.
+    """
+
+    def __init__(
+        self,
+        pretrained_model_name_or_path: str,
+        lora_dir: Optional[str] = None,
+        device: Optional[str] = None,
+        dtype: Optional[torch.dtype] = None,
+        revision: Optional[str] = None,
+        scheduler: str = "default",
+        num_inference_steps: int = 30,
+        batch_size: int = 8,
+        max_adapters: int = 4,
+        adapter_memory_mb: Optional[float] = None,
+    ):
+        """
+        Load the pipeline and the LoRA attention processors.
+
+        Args:
+            pretrained_model_name_or_path: Path to pretrained model or model identifier from huggingface.co/models.
+            lora_dir: Directory (or file) of the attention processors saved by `unet.save_attn_procs`, if any.
+            device: The device to run on. Defaults to CUDA when available.
+            dtype: The dtype of the weights. Defaults to float16 on CUDA and float32 on CPU.
+            revision: Revision of pretrained model identifier from huggingface.co/models.
+            scheduler: The inference scheduler, among VALIDATION_SCHEDULERS.
+            num_inference_steps: The number of denoising steps per image.
+            batch_size: The maximum number of images per batch.
+            max_adapters: The maximum number of LoRA adapters kept in memory.
+            adapter_memory_mb: The maximum size of the LoRA adapters kept in memory, in megabytes.
+        """
+        self.device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        if dtype is None:
+            dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+        self.pipeline = StableDiffusionPipeline.from_pretrained(
+            pretrained_model_name_or_path,
+            revision=revision,
+            torch_dtype=dtype,
+            safety_checker=None,
+            requires_safety_checker=False,
+        )
+        self.pipeline.scheduler = load_validation_scheduler(
+            pretrained_model_name_or_path, scheduler, revision=revision
+        )
+        self.pipeline.to(self.device)
+        self.adapters = AdapterRegistry(self.pipeline.unet, max_adapters, adapter_memory_mb)
+        if lora_dir is not None:
+            self.adapters.register(DEFAULT_ADAPTER, lora_dir)
+            self.activate_adapter(DEFAULT_ADAPTER)
+        self.pipeline.set_progress_bar_config(disable=True)
+        self.num_inference_steps = num_inference_steps
+        self.batch_size = batch_size
+
+    @torch.no_grad()
+    def activate_adapter(self, name: Optional[str], scale: float = 1.0, fuse: bool = False):
+        """
+        Switch the LoRA adapter of the pipeline, without reloading the base weights.
+
+        Args:
+            name: The name of a registered adapter, or None for the base model.
+            scale: The LoRA scale.
+            fuse: Whether to fuse the adapter into the base weights, which is faster while it stays active.
+        """
+        self.adapters.activate(name, scale=scale, fuse=fuse)
+        # Newly loaded LoRA layers are created on CPU, in float32
+        self.pipeline.unet.to(self.device, self.pipeline.unet.dtype)
+
+    def generate_batch(self, prompts: list, seeds: list, **kwargs) -> list:
+        """
+        Generate one image per prompt in a single batch, with the active adapter.
+
+        Args:
+            prompts: The prompts.
+            seeds: The seed of each image.
+            **kwargs: Additional arguments of the pipeline call, e.g. `prompt_embeds`.
+
+        Returns:
+            list: The generated PIL images.
+        """
+        kwargs.setdefault("cross_attention_kwargs", self.adapters.cross_attention_kwargs())
+        generators = [torch.Generator(device=self.device).manual_seed(seed) for seed in seeds]
+        if "prompt_embeds" not in kwargs:
+            kwargs["prompt"] = prompts
+        return self.pipeline(num_inference_steps=self.num_inference_steps, generator=generators, **kwargs).images
+
+    def generate(self, prompts: list) -> Iterator[tuple]:
+        """
+        Generate one image per (prompt, seed), in batches of at most `batch_size` images.
+
+        Args:
+            prompts: (prompt, seed) tuples.
+
+        Yields:
+            tuple: The index of the prompt and its image, in the order of `prompts`.
+        """
+        start = 0
+        while start < len(prompts):
+            batch = prompts[start : start + self.batch_size]
+            try:
+                images = self.generate_batch([prompt for prompt, _ in batch], [seed for _, seed in batch])
+            except torch.cuda.OutOfMemoryError:
+                if self.batch_size == 1:
+                    raise
+                self.batch_size //= 2
+                torch.cuda.empty_cache()
+                logger.warning(f"Out of memory, reducing the batch size to {self.batch_size}")
+                continue
+            yield from enumerate(images, start=start)
+            start += len(batch)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate watch images with a LoRA fine-tuned Stable Diffusion.")
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        required=True,
+        help="Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--revision",
+        type=str,
+        default=None,
+        help="Revision of pretrained model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--lora_dir",
+        type=str,
+        default=None,
+        help="Output directory of the training script (or a checkpoint directory) holding the LoRA weights.",
+    )
+    parser.add_argument(
+        "--prompts_file",
+        type=str,
+        default=None,
+        help="A text file with one prompt per line, or a .jsonl file of {'prompt', 'seed'} records.",
+    )
+    parser.add_argument("--mongo_uri", type=str, default=None, help="Build prompts from the watches in MongoDB.")
+    parser.add_argument("--mongo_port", type=int, default=27017, help="MongoDB port.")
+    parser.add_argument("--mongo_db", type=str, default="watch_scraping", help="MongoDB database name.")
+    parser.add_argument("--mongo_collection", type=str, default="watches", help="MongoDB collection name.")
+    parser.add_argument("--limit", type=int, default=0, help="Maximum number of watches read from MongoDB.")
+    parser.add_argument("--output_dir", type=str, default="generated", help="Directory to write the images to.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first prompt without an explicit seed.")
+    parser.add_argument("--batch_size", type=int, default=8, help="Maximum number of images per batch.")
+    parser.add_argument("--num_inference_steps", type=int, default=30, help="Number of denoising steps.")
+    parser.add_argument("--scheduler", type=str, default="default", choices=VALIDATION_SCHEDULERS)
+    parser.add_argument("--device", type=str, default=None, help="Device to run on, defaults to CUDA if available.")
+    parser.add_argument("--num_writers", type=int, default=4, help="Number of threads writing images to disk.")
+    parser.add_argument("--image_format", type=str, default="png", help="Format of the written images.")
+
+    args = parser.parse_args()
+    if (args.prompts_file is None) == (args.mongo_uri is None):
+        raise ValueError("Need either a prompts file or a MongoDB URI.")
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", level=logging.INFO)
+
+    if args.prompts_file is not None:
+        prompts = load_prompts_file(args.prompts_file, seed=args.seed)
+    else:
+        prompts = load_mongo_prompts(
+            args.mongo_uri, args.mongo_port, args.mongo_db, args.mongo_collection, limit=args.limit, seed=args.seed
+        )
+
+    generator = WatchGenerator(
+        args.pretrained_model_name_or_path,
+        lora_dir=args.lora_dir,
+        device=args.device,
+        revision=args.revision,
+        scheduler=args.scheduler,
+        num_inference_steps=args.num_inference_steps,
+        batch_size=args.batch_size,
+    )
+    writer = ImageWriterPool(args.output_dir, num_workers=args.num_writers, image_format=args.image_format)
+
+    start_time = time.perf_counter()
+    with open(os.path.join(args.output_dir, "prompts.jsonl"), "w", encoding="utf-8") as f:
+        for i, image in generator.generate(prompts):
+            prompt, seed = prompts[i]
+            writer.submit(image, f"{i:06d}")
+            f.write(json.dumps({"file": f"{i:06d}.{args.image_format}", "prompt": prompt, "seed": seed}) + "\n")
+    writer.close()
+    elapsed = time.perf_counter() - start_time
+
+    logger.info(f"Generated {len(prompts)} images in {elapsed:.1f}s ({len(prompts) / elapsed:.2f} images/sec)")
+
+
+if __name__ == "__main__":
+    main()
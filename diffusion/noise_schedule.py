@@ -0,0 +1,243 @@
+"""
+This module defines the noise-schedule tables of the training loop and the timestep samplers.
+
+NoiseScheduleTables precomputes, once and on the training device, every per-timestep quantity of a training step:
+sqrt(alpha_cumprod), sqrt(1 - alpha_cumprod) and the min-SNR loss weights. Noising, the v-prediction target and the
+loss weighting are then a gather followed by elementwise operations, instead of re-indexing `alphas_cumprod` and
+recomputing the SNR at every step.
+
+The timestep samplers draw the timesteps of each batch: uniformly, as the scheduler was trained, or by importance,
+favouring the timesteps whose loss is the largest (Improved DDPM, https://arxiv.org/abs/2102.09672, Section 3.3).
+"""
+
+from typing import Optional
+
+import torch
+
+from options import TIMESTEP_SAMPLINGS
+
+
+class NoiseScheduleTables:
+    """
+    Per-timestep tables of a DDPM noise schedule, on the training device.
+
+    Attributes:
+        prediction_type: 'epsilon' or 'v_prediction'.
+        sqrt_alpha: sqrt(alpha_cumprod) of each timestep.
+        sqrt_one_minus_alpha: sqrt(1 - alpha_cumprod) of each timestep.
+        loss_weights: The min-SNR loss weight of each timestep, or None without SNR weighting.
+    """
+
+    def __init__(self, noise_scheduler, device: torch.device, prediction_type: str, snr_gamma: Optional[float] = None):
+        """
+        Compute the tables.
+
+        Args:
+            noise_scheduler: The DDPM scheduler of the training.
+            device: The training device.
+            prediction_type: 'epsilon' or 'v_prediction'.
+            snr_gamma: The SNR weighting gamma (https://arxiv.org/abs/2303.09556), or None for an unweighted loss.
+        """
+        if prediction_type not in ["epsilon", "v_prediction"]:
+            raise ValueError(f"Unknown prediction type {prediction_type}")
+        self.prediction_type = prediction_type
+        alphas_cumprod = noise_scheduler.alphas_cumprod.to(device=device, dtype=torch.float32)
+        self.sqrt_alpha = alphas_cumprod.sqrt()
+        self.sqrt_one_minus_alpha = (1.0 - alphas_cumprod).sqrt()
+
+        self.loss_weights = None
+        if snr_gamma is not None:
+            # Same values as `compute_snr` and the min-SNR weighting of the diffusers training scripts. The velocity
+            # objective requires that we add one to SNR values before we divide by them.
+            snr = (self.sqrt_alpha / self.sqrt_one_minus_alpha) ** 2
+            if prediction_type == "v_prediction":
+                snr = snr + 1
+            self.loss_weights = snr.clamp(max=snr_gamma) / snr
+
+    @property
+    def num_timesteps(self) -> int:
+        return len(self.sqrt_alpha)
+
+    def _gather(self, table: torch.Tensor, timesteps: torch.Tensor, like: torch.Tensor) -> torch.Tensor:
+        return table[timesteps].to(like.dtype).view(-1, *([1] * (like.ndim - 1)))
+
+    def add_noise(self, latents: torch.Tensor, noise: torch.Tensor, timesteps: torch.Tensor) -> tuple:
+        """
+        Noise latents (forward diffusion process) and compute the target of the prediction.
+
+        Args:
+            latents: The clean latents.
+            noise: The noise, of the same shape.
+            timesteps: The timestep of each sample.
+
+        Returns:
+            tuple: The noisy latents and the target, the noise or the velocity depending on the prediction type.
+        """
+        sqrt_alpha = self._gather(self.sqrt_alpha, timesteps, latents)
+        sqrt_one_minus_alpha = self._gather(self.sqrt_one_minus_alpha, timesteps, latents)
+        noisy_latents = sqrt_alpha * latents + sqrt_one_minus_alpha * noise
+        if self.prediction_type == "epsilon":
+            return noisy_latents, noise
+        return noisy_latents, sqrt_alpha * noise - sqrt_one_minus_alpha * latents
+
+    def sample_losses(self, model_pred: torch.Tensor, target: torch.Tensor, timesteps: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the mean squared error of each sample, weighted by its min-SNR weight if any.
+
+        Args:
+            model_pred: The prediction of the UNet.
+            target: The target.
+            timesteps: The timestep of each sample.
+
+        Returns:
+            torch.Tensor: The float32 loss of each sample.
+        """
+        losses = (model_pred.float() - target.float()).square().mean(dim=list(range(1, model_pred.ndim)))
+        if self.loss_weights is not None:
+            losses = losses * self.loss_weights[timesteps]
+        return losses
+
+
+class UniformTimestepSampler:
+    """
+    Draw timesteps uniformly.
+    """
+
+    def __init__(self, num_timesteps: int):
+        self.num_timesteps = num_timesteps
+
+    def sample(self, batch_size: int, device: torch.device) -> tuple:
+        """
+        Draw the timesteps of a batch.
+
+        Args:
+            batch_size: The number of timesteps.
+            device: The training device.
+
+        Returns:
+            tuple: The timesteps, and their loss weights (None, all the weights are 1).
+        """
+        return torch.randint(0, self.num_timesteps, (batch_size,), device=device), None
+
+    def update(self, timesteps: torch.Tensor, losses: torch.Tensor):
+        pass
+
+
+class LossImportanceSampler:
+    """
+    Draw timesteps with a probability proportional to the root mean square of their recent losses.
+
+    The loss of each sample is multiplied by 1 / (num_timesteps * p(t)), so that the expected loss, and its gradient,
+    are the same as with uniform sampling, with less variance. Timesteps are drawn uniformly until every timestep has
+    been seen `min_observations` times, and a fraction `uniform_mix` of the probability mass always stays uniform, so
+    that the loss estimates of the unlikely timesteps keep being updated.
+
+    Everything stays on the device: sampling and updates never synchronize with the host.
+
+    Attributes:
+        num_timesteps: The number of timesteps of the schedule.
+        decay: The decay of the exponential moving average of the squared losses.
+        min_observations: The number of losses of every timestep required before importance sampling starts.
+        uniform_mix: The fraction of uniform probability mixed in.
+    """
+
+    def __init__(
+        self,
+        num_timesteps: int,
+        device: torch.device,
+        decay: float = 0.9,
+        min_observations: int = 10,
+        uniform_mix: float = 0.1,
+    ):
+        """
+        Initialize the sampler, without loss estimates.
+
+        Args:
+            num_timesteps: The number of timesteps of the schedule.
+            device: The training device.
+            decay: The decay of the exponential moving average of the squared losses.
+            min_observations: The number of losses of every timestep required before importance sampling starts.
+            uniform_mix: The fraction of uniform probability mixed in.
+        """
+        self.num_timesteps = num_timesteps
+        self.decay = decay
+        self.min_observations = min_observations
+        self.uniform_mix = uniform_mix
+        self.mean_square_losses = torch.zeros(num_timesteps, device=device)
+        self.counts = torch.zeros(num_timesteps, dtype=torch.long, device=device)
+
+    def probabilities(self) -> torch.Tensor:
+        """
+        Get the current sampling probabilities.
+
+        Returns:
+            torch.Tensor: The probability of each timestep.
+        """
+        uniform = torch.full_like(self.mean_square_losses, 1.0 / self.num_timesteps)
+        rms = self.mean_square_losses.sqrt().clamp(min=1e-12)
+        probabilities = (1 - self.uniform_mix) * rms / rms.sum() + self.uniform_mix * uniform
+        return torch.where((self.counts >= self.min_observations).all(), probabilities, uniform)
+
+    def sample(self, batch_size: int, device: torch.device) -> tuple:
+        """
+        Draw the timesteps of a batch.
+
+        Args:
+            batch_size: The number of timesteps.
+            device: The training device.
+
+        Returns:
+            tuple: The timesteps, and the weights that keep the expected loss unbiased.
+        """
+        probabilities = self.probabilities().to(device)
+        timesteps = torch.multinomial(probabilities, batch_size, replacement=True)
+        weights = 1.0 / (self.num_timesteps * probabilities[timesteps])
+        return timesteps, weights
+
+    def update(self, timesteps: torch.Tensor, losses: torch.Tensor):
+        """
+        Update the loss estimates with the losses of a batch, gathered from every process so that all processes keep
+        the same estimates.
+
+        Args:
+            timesteps: The timestep of each sample.
+            losses: The unweighted (by importance) loss of each sample.
+        """
+        timesteps = timesteps.to(self.counts.device)
+        batch_counts = torch.bincount(timesteps, minlength=self.num_timesteps)
+        batch_sums = torch.zeros_like(self.mean_square_losses).index_add_(
+            0, timesteps, losses.detach().float().square().to(self.counts.device)
+        )
+        batch_means = batch_sums / batch_counts.clamp(min=1)
+        # The first observation of a timestep replaces its estimate, the next ones are averaged in
+        decay = torch.where(self.counts > 0, self.decay, 0.0)
+        updated = decay * self.mean_square_losses + (1 - decay) * batch_means
+        self.mean_square_losses = torch.where(batch_counts > 0, updated, self.mean_square_losses)
+        self.counts += batch_counts
+
+    def state_dict(self) -> dict:
+        return {"mean_square_losses": self.mean_square_losses.tolist(), "counts": self.counts.tolist()}
+
+    def load_state_dict(self, state_dict: dict):
+        device = self.counts.device
+        self.mean_square_losses = torch.tensor(state_dict["mean_square_losses"], device=device)
+        self.counts = torch.tensor(state_dict["counts"], dtype=torch.long, device=device)
+
+
+def make_timestep_sampler(name: str, num_timesteps: int, device: torch.device):
+    """
+    Create a timestep sampler.
+
+    Args:
+        name: The sampling strategy, among TIMESTEP_SAMPLINGS.
+        num_timesteps: The number of timesteps of the schedule.
+        device: The training device.
+
+    Returns:
+        The sampler, with `sample(batch_size, device)` and `update(timesteps, losses)` methods.
+    """
+    if name == "uniform":
+        return UniformTimestepSampler(num_timesteps)
+    if name == "importance":
+        return LossImportanceSampler(num_timesteps, device)
+    raise ValueError(f"Unknown timestep sampling {name}, choose between {TIMESTEP_SAMPLINGS}")
@@ -0,0 +1,25 @@
+"""
+This module defines the choices of the command line options shared by the diffusion scripts.
+
+It must not import any heavy dependency (torch, diffusers, datasets, ...): the scripts import it before parsing their
+arguments, so that `--help` and invalid arguments are handled without loading them.
+"""
+
+# Inference schedulers of the validation and inference pipelines, see `validation.load_validation_scheduler`
+VALIDATION_SCHEDULERS = ["default", "dpm_solver"]
+
+# Image-quality metrics computed on validation images, see `validation_metrics.ValidationMetrics`
+VALIDATION_METRICS = ["clip_score", "fid", "kid"]
+
+# Formats of the shards of the streaming dataset, and name of their manifest, see `streaming_dataset.write_shards`
+SHARD_FORMATS = ["parquet", "tar"]
+INDEX_NAME = "index.json"
+
+# Modes of `torch.compile` for the `--compile` mode of the training script
+COMPILE_MODES = ["default", "reduce-overhead", "max-autotune"]
+
+# Strategies of the timestep sampling of the training loop, see `noise_schedule.make_timestep_sampler`
+TIMESTEP_SAMPLINGS = ["uniform", "importance"]
+
+# Rebalancing of the clusters of near-duplicate samples of the dataset, see `dedup.NearDuplicateRebalancer`
+DEDUP_MODES = ["cap", "weight"]
@@ -0,0 +1,412 @@
+"""
+This module defines a distributed data-preparation entry point, which builds the shards of the streaming dataset
+(`--train_shards` of the training script) from the MongoDB collection, optionally with precomputed VAE latents.
+
+The coordinator (rank 0) splits the collection into `_id` ranges of about the same number of watches, one per worker
+of every rank, and shares them with the other ranks in the `ranges.json` file of the output directory. The ranges of
+an existing file are reused, e.g. to resume an interrupted preparation; remove it to split the current collection
+again. Each worker independently reads its range, decodes and resizes its images, optionally encodes them with the
+VAE, and writes its own shards in a `part-XXXXX` directory. The coordinator then merges the manifests of the parts
+into the top-level manifest.
+
+Ranks are given with `--rank` and `--world_size`, or read from the RANK/WORLD_SIZE (torchrun) or
+SLURM_PROCID/SLURM_NTASKS environment variables. Every rank runs `--num_workers` local processes.
+
+Example, on 2 machines with 8 processes each:
+    python diffusion/prepare_data.py --output_dir datasets/watches_shards --image_dir images \\
+        --rank 0 --world_size 2 --num_workers 8
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from options import INDEX_NAME, SHARD_FORMATS
+
+logger = logging.getLogger(__name__)
+
+PART_NAME = "part-{:05d}"
+RANGES_NAME = "ranges.json"
+
+
+def compute_id_ranges(collection, num_ranges: int) -> list:
+    """
+    Split a collection into contiguous `_id` ranges of about the same number of documents.
+
+    The ranges are pinned to the largest `_id` at the time they are computed: together they cover every document up to
+    it exactly once, even if watches are inserted meanwhile, and the watches inserted later are left out.
+
+    Args:
+        collection: The pymongo collection.
+        num_ranges: The number of ranges.
+
+    Returns:
+        list: The MongoDB filter of each range, fewer than `num_ranges` if the collection is small.
+    """
+    last = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    if last is None:
+        return []
+    snapshot = {"_id": {"$lte": last["_id"]}}
+    count = collection.count_documents(snapshot)
+    num_ranges = min(num_ranges, count)
+
+    # The first `_id` of every range but the first one, read from the `_id` index
+    bounds = []
+    for i in range(1, num_ranges):
+        cursor = collection.find(snapshot, {"_id": 1}).sort("_id", 1).skip(i * count // num_ranges).limit(1)
+        document = next(cursor, None)
+        if document is None:
+            # Watches were deleted since the count
+            break
+        bounds.append(document["_id"])
+
+    queries = []
+    for lower, upper in zip([None, *bounds], [*bounds, None]):
+        query = {"$lte": last["_id"]} if upper is None else {"$lt": upper}
+        if lower is not None:
+            query["$gte"] = lower
+        queries.append({"_id": query})
+    return queries
+
+
+def save_id_ranges(queries: list, output_dir: str) -> str:
+    """
+    Save the `_id` ranges computed by the coordinator, for the other ranks.
+
+    Args:
+        queries: The MongoDB filter of each range.
+        output_dir: The output directory of the parts.
+
+    Returns:
+        str: The path of the ranges file.
+    """
+    from bson import json_util
+
+    path = os.path.join(output_dir, RANGES_NAME)
+    # The file only appears once complete, which is what the other ranks wait for
+    with open(path + ".tmp", "w") as f:
+        f.write(json_util.dumps(queries, indent=2))
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def load_id_ranges(output_dir: str, timeout: float = 0, poll_interval: float = 5) -> list:
+    """
+    Load the `_id` ranges saved by the coordinator, waiting for them if needed.
+
+    Args:
+        output_dir: The output directory of the parts.
+        timeout: The maximum time to wait for the ranges file, in seconds.
+        poll_interval: The time between two checks for the ranges file, in seconds.
+
+    Returns:
+        list: The MongoDB filter of each range.
+    """
+    from bson import json_util
+
+    path = os.path.join(output_dir, RANGES_NAME)
+    deadline = time.monotonic() + timeout
+    while not os.path.isfile(path):
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"The ranges of {output_dir} are not ready")
+        time.sleep(poll_interval)
+    with open(path) as f:
+        return json_util.loads(f.read())
+
+
+def resize_image(image, resolution: int, center_crop: bool = False):
+    """
+    Resize an image so that its shorter side is `resolution`, and optionally crop its center to a square.
+
+    Args:
+        image: The PIL image, decoded at a reduced scale if it is a JPEG not loaded yet.
+        resolution: The length of the shorter side.
+        center_crop: Whether to crop the image to a `resolution` square.
+
+    Returns:
+        The RGB PIL image.
+    """
+    from PIL import Image
+
+    from image_decoding import decode_image
+
+    image = decode_image(image, resolution)
+    scale = resolution / min(image.size)
+    size = (max(resolution, round(image.width * scale)), max(resolution, round(image.height * scale)))
+    image = image.resize(size, Image.BICUBIC)
+    if center_crop:
+        left = (image.width - resolution) // 2
+        top = (image.height - resolution) // 2
+        image = image.crop((left, top, left + resolution, top + resolution))
+    return image
+
+
+class LatentEncoder:
+    """
+    Encode batches of images with the VAE of a Stable Diffusion model, on CPU or GPU.
+    """
+
+    def __init__(self, pretrained_model_name_or_path: str, revision: str = None, device: str = None):
+        """
+        Load the VAE.
+
+        Args:
+            pretrained_model_name_or_path: Path to pretrained model or model identifier from huggingface.co/models.
+            revision: Revision of pretrained model identifier from huggingface.co/models.
+            device: The device to run on. Defaults to CUDA when available.
+        """
+        import torch
+        from diffusers import AutoencoderKL
+
+        self.torch = torch
+        self.device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.vae = AutoencoderKL.from_pretrained(pretrained_model_name_or_path, subfolder="vae", revision=revision)
+        self.vae.requires_grad_(False).eval().to(self.device)
+
+    def __call__(self, images: list) -> list:
+        """
+        Encode images of the same size.
+
+        Args:
+            images: The RGB PIL images.
+
+        Returns:
+            list: The float16 parameters (mean and log-variance) of the latent distribution of each image, serialized
+                with `numpy.save`, so that training can still sample the latents.
+        """
+        import numpy as np
+
+        torch = self.torch
+        pixels = torch.stack([torch.from_numpy(np.asarray(image)) for image in images]).permute(0, 3, 1, 2)
+        pixels = pixels.to(self.device, torch.float32) / 127.5 - 1
+        with torch.no_grad():
+            parameters = self.vae.encode(pixels).latent_dist.parameters.half().cpu().numpy()
+        serialized = []
+        for latents in parameters:
+            buffer = io.BytesIO()
+            np.save(buffer, latents)
+            serialized.append(buffer.getvalue())
+        return serialized
+
+
+def prepare_part(args: argparse.Namespace, part: int, query: dict) -> dict:
+    """
+    Prepare the shards of one `_id` range.
+
+    Args:
+        args: The parsed arguments.
+        part: The index of the range.
+        query: The MongoDB filter of the range.
+
+    Returns:
+        dict: The manifest of the part.
+    """
+    import pymongo
+    from PIL import Image
+
+    from streaming_dataset import write_shards
+    from watches_dataset import iter_watch_images
+
+    encoder = None
+    if args.encode_latents:
+        encoder = LatentEncoder(args.pretrained_model_name_or_path, revision=args.revision, device=args.device)
+
+    stats = {"images": 0, "skipped": 0}
+
+    def samples(records):
+        batch = []
+        for image_path, caption in records:
+            try:
+                with Image.open(os.path.join(args.image_dir, image_path)) as image:
+                    image = resize_image(image, args.resolution, center_crop=args.center_crop or encoder is not None)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping {image_path}: {e}")
+                stats["skipped"] += 1
+                continue
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=args.jpeg_quality)
+            stats["images"] += 1
+            if encoder is None:
+                yield buffer.getvalue(), caption
+                continue
+            batch.append((image, buffer.getvalue(), caption))
+            if len(batch) == args.encode_batch_size:
+                yield from encode(batch)
+                batch = []
+        if batch:
+            yield from encode(batch)
+
+    def encode(batch):
+        latents = encoder([image for image, _, _ in batch])
+        for (_, image_bytes, caption), sample_latents in zip(batch, latents):
+            yield image_bytes, caption, sample_latents
+
+    part_dir = os.path.join(args.output_dir, PART_NAME.format(part))
+    tmp_dir = part_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    start = time.perf_counter()
+    with pymongo.MongoClient(args.mongo_uri, args.mongo_port) as client:
+        records = iter_watch_images(
+            client[args.mongo_db][args.mongo_collection],
+            query,
+            aggregate=args.aggregate,
+            batch_size=args.cursor_batch_size,
+        )
+        manifest = write_shards(samples(records), tmp_dir, args.samples_per_shard, args.shard_format)
+    # The part directory only appears once complete, which is what the coordinator waits for
+    shutil.rmtree(part_dir, ignore_errors=True)
+    os.replace(tmp_dir, part_dir)
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Part {part}: {stats['images']} images ({stats['skipped']} skipped) in {elapsed:.1f}s"
+        f" ({stats['images'] / elapsed:.1f} images/sec)"
+    )
+    return manifest
+
+
+def merge_manifests(output_dir: str, num_parts: int, timeout: float = 0, poll_interval: float = 5) -> dict:
+    """
+    Merge the manifests of the parts into the manifest of the dataset, waiting for the parts of the other ranks.
+
+    Args:
+        output_dir: The output directory of the parts.
+        num_parts: The number of parts.
+        timeout: The maximum time to wait for missing parts, in seconds.
+        poll_interval: The time between two checks for missing parts, in seconds.
+
+    Returns:
+        dict: The manifest of the dataset.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        missing = [
+            part for part in range(num_parts) if not os.path.isdir(os.path.join(output_dir, PART_NAME.format(part)))
+        ]
+        if not missing:
+            break
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Parts {missing} of {output_dir} are not ready")
+        time.sleep(poll_interval)
+
+    manifest = {"format": None, "shards": [], "num_samples": 0, "parts": num_parts}
+    for part in range(num_parts):
+        name = PART_NAME.format(part)
+        with open(os.path.join(output_dir, name, INDEX_NAME)) as f:
+            part_manifest = json.load(f)
+        manifest["format"] = manifest["format"] or part_manifest["format"]
+        if part_manifest["format"] != manifest["format"]:
+            raise ValueError(f"{name} has {part_manifest['format']} shards, not {manifest['format']}")
+        for shard in part_manifest["shards"]:
+            manifest["shards"].append({**shard, "path": f"{name}/{shard['path']}"})
+        manifest["num_samples"] += part_manifest["num_samples"]
+
+    with open(os.path.join(output_dir, INDEX_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prepare the shards of the watches dataset on several processes.")
+    parser.add_argument("--mongo_uri", type=str, default="localhost", help="MongoDB URI.")
+    parser.add_argument("--mongo_port", type=int, default=27017, help="MongoDB port.")
+    parser.add_argument("--mongo_db", type=str, default="watch_scraping", help="MongoDB database name.")
+    parser.add_argument("--mongo_collection", type=str, default="watches", help="MongoDB collection name.")
+    parser.add_argument("--image_dir", type=str, default="images", help="Directory of the downloaded images.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory of the shards and manifests.")
+    parser.add_argument("--shard_format", type=str, default="parquet", choices=SHARD_FORMATS)
+    parser.add_argument("--samples_per_shard", type=int, default=1000, help="Number of samples per shard.")
+    parser.add_argument(
+        "--aggregate",
+        action="store_true",
+        help="Project and unwind the documents on the server (one row per image), with an aggregation pipeline.",
+    )
+    parser.add_argument("--cursor_batch_size", type=int, default=1000, help="Number of rows per cursor batch.")
+    parser.add_argument("--resolution", type=int, default=512, help="Length of the shorter side of the images.")
+    parser.add_argument("--center_crop", action="store_true", help="Crop the images to a square.")
+    parser.add_argument("--jpeg_quality", type=int, default=95, help="JPEG quality of the stored images.")
+    parser.add_argument(
+        "--encode_latents",
+        action="store_true",
+        help="Also store the VAE latent distribution of each (center-cropped) image.",
+    )
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default=None,
+        help="Model whose VAE encodes the latents, required with `--encode_latents`.",
+    )
+    parser.add_argument("--revision", type=str, default=None, help="Revision of the pretrained model.")
+    parser.add_argument("--encode_batch_size", type=int, default=16, help="Number of images per VAE batch.")
+    parser.add_argument("--device", type=str, default=None, help="Device of the VAE, defaults to CUDA if available.")
+    parser.add_argument("--rank", type=int, default=None, help="Index of this machine or process.")
+    parser.add_argument("--world_size", type=int, default=None, help="Number of machines or processes.")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of local worker processes per rank.")
+    parser.add_argument(
+        "--merge_timeout",
+        type=float,
+        default=3600,
+        help=(
+            "Maximum time the coordinator waits for the parts of the other ranks, and the other ranks wait for the"
+            " ranges of the coordinator, in seconds."
+        ),
+    )
+    parser.add_argument(
+        "--merge_only", action="store_true", help="Only merge the manifests of already prepared parts."
+    )
+
+    args = parser.parse_args()
+    if args.rank is None:
+        args.rank = int(os.environ.get("RANK", os.environ.get("SLURM_PROCID", 0)))
+    if args.world_size is None:
+        args.world_size = int(os.environ.get("WORLD_SIZE", os.environ.get("SLURM_NTASKS", 1)))
+    if not 0 <= args.rank < args.world_size:
+        raise ValueError(f"Invalid rank {args.rank} for a world size of {args.world_size}")
+    if args.encode_latents and args.pretrained_model_name_or_path is None:
+        raise ValueError("`--encode_latents` requires `--pretrained_model_name_or_path`.")
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", level=logging.INFO)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # The coordinator splits the collection once, so that every rank works on the same ranges
+    if args.rank == 0 and not os.path.isfile(os.path.join(args.output_dir, RANGES_NAME)):
+        import pymongo
+
+        with pymongo.MongoClient(args.mongo_uri, args.mongo_port) as client:
+            queries = compute_id_ranges(
+                client[args.mongo_db][args.mongo_collection], args.world_size * args.num_workers
+            )
+        save_id_ranges(queries, args.output_dir)
+    queries = load_id_ranges(args.output_dir, timeout=args.merge_timeout)
+
+    if not args.merge_only:
+        # Parts are assigned round-robin to ranks, then to the local workers
+        parts = list(range(args.rank, len(queries), args.world_size))
+        logger.info(f"Rank {args.rank}/{args.world_size}: preparing parts {parts} with {args.num_workers} workers")
+        if args.num_workers > 1:
+            with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+                futures = [executor.submit(prepare_part, args, part, queries[part]) for part in parts]
+                for future in futures:
+                    future.result()
+        else:
+            for part in parts:
+                prepare_part(args, part, queries[part])
+
+    if args.rank == 0:
+        manifest = merge_manifests(args.output_dir, len(queries), timeout=args.merge_timeout)
+        logger.info(
+            f"Merged {len(queries)} parts: {len(manifest['shards'])} shards, {manifest['num_samples']} samples"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+This module defines a ResumableRandomSampler class that can start an epoch at any position of its permutation, so
+that a training run resumed mid-epoch goes straight to the next unseen sample.
+"""
+
+from typing import Optional
+
+import torch
+
+
+class ResumableRandomSampler(torch.utils.data.Sampler):
+    """
+    Random sampler whose permutation only depends on a seed and the epoch.
+
+    Its state (seed, epoch and position in the epoch) is saved with the checkpoints, by
+    `checkpointing.save_extra_state` or AsyncCheckpointWriter, so a resumed run replays the same permutation from the
+    first sample that was not consumed, without loading the skipped samples.
+
+    With sample weights, such as the weights of the near-duplicates computed by `dedup.NearDuplicateRebalancer`,
+    each epoch draws round(sum(weights)) distinct samples with probabilities proportional to their weights, instead of
+    a permutation of the whole dataset.
+
+    Attributes:
+        num_samples: The number of samples of an epoch.
+        seed: The seed of the permutations.
+        epoch: The current epoch.
+        position: The number of samples of the permutation consumed in the current epoch.
+    """
+
+    def __init__(self, num_samples: int, seed: int = 0, weights: Optional[list] = None):
+        """
+        Initialize the sampler.
+
+        Args:
+            num_samples: The size of the dataset.
+            seed: The seed of the permutations.
+            weights: The weight, between 0 and 1, of each sample. All the samples are drawn in every epoch by default.
+        """
+        self.weights = None
+        if weights is not None:
+            self.weights = torch.as_tensor(weights, dtype=torch.float64)
+            num_samples = max(1, round(self.weights.sum().item()))
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.position = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch: int):
+        """
+        Set the epoch, which determines the permutation. A new epoch starts from its first sample.
+
+        Accelerate calls it with the epoch of the dataloader every time the dataloader is iterated, so setting the
+        current epoch again keeps the position set by `seek`.
+
+        Args:
+            epoch: The epoch.
+        """
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.seek(0)
+
+    def seek(self, start_index: int):
+        """
+        Set the position to start the current epoch from.
+
+        Must be called before the dataloader iterator of the epoch is created.
+
+        Args:
+            start_index: The number of samples of the permutation to skip.
+        """
+        self.start_index = start_index
+        self.position = start_index
+
+    def set_position(self, position: int):
+        """
+        Record how many samples of the current epoch were consumed by the training loop.
+
+        The sampler cannot track it by itself since the dataloader prefetches indices ahead of training.
+
+        Args:
+            position: The number of samples consumed in the current epoch, across all processes.
+        """
+        self.position = position
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        if self.weights is None:
+            permutation = torch.randperm(self.num_samples, generator=generator)
+        else:
+            permutation = torch.multinomial(self.weights, self.num_samples, replacement=False, generator=generator)
+        yield from permutation[self.start_index :].tolist()
+
+    def __len__(self) -> int:
+        return self.num_samples - self.start_index
+
+    def state_dict(self) -> dict:
+        return {"seed": self.seed, "epoch": self.epoch, "position": self.position}
+
+    def load_state_dict(self, state_dict: dict):
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+        self.seek(state_dict["position"])
@@ -0,0 +1,416 @@
+"""
+This module defines a local HTTP server generating watch images with a resident WatchGenerator.
+
+Concurrent requests are merged into micro-batches: the batcher waits at most `max_wait_ms` after the first pending
+image for other images to fill a batch. Prompt embeddings are kept in an LRU cache, and images are streamed back as
+soon as their batch is done, as newline-delimited JSON.
+
+Several LoRA adapters (e.g. the final weights and checkpoints of a run) can be served over the same base model. A
+batch only holds images of a single adapter, and the adapter is switched between batches without reloading the base
+weights; images of other adapters wait for the next batches, in order.
+
+Endpoints:
+    POST /generate: {"prompt": str, "num_images": int = 1, "seed": int = 0, "adapter": str = "default"} -> one JSON
+        line per image {"index": int, "seed": int, "image": base64 PNG}. The adapter "none" is the base model, and
+        num_images is at most --max_images.
+    GET /metrics: queue depth, number of requests and images, and latency percentiles.
+
+Example:
+    python diffusion/server.py --pretrained_model_name_or_path stabilityai/stable-diffusion-2-1 \\
+        --lora_dir models/lora/stable-diffusion-2-1-chronext \\
+        --adapter step-13500=models/lora/stable-diffusion-2-1-chronext/checkpoint-13500 --port 8000
+"""
+
+import argparse
+import base64
+import io
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import numpy as np
+import torch
+
+from inference import DEFAULT_ADAPTER, WatchGenerator
+from validation import VALIDATION_SCHEDULERS
+
+logger = logging.getLogger(__name__)
+
+# Adapter name of requests to the base model
+BASE_MODEL = "none"
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of the conditional and unconditional embeddings of prompts.
+    """
+
+    def __init__(self, pipeline, device: torch.device, max_size: int = 1024):
+        """
+        Initialize the cache.
+
+        Args:
+            pipeline: The Stable Diffusion pipeline whose text encoder computes the embeddings.
+            device: The device of the pipeline.
+            max_size: The maximum number of cached prompts.
+        """
+        self.pipeline = pipeline
+        self.device = device
+        self.max_size = max_size
+        self._cache = OrderedDict()
+
+    @torch.no_grad()
+    def __call__(self, prompt: str) -> tuple:
+        """
+        Get the embeddings of a prompt.
+
+        Args:
+            prompt: The prompt.
+
+        Returns:
+            tuple: The prompt embeddings and the negative prompt embeddings, for one image.
+        """
+        if prompt in self._cache:
+            self._cache.move_to_end(prompt)
+            return self._cache[prompt]
+        embeds = self.pipeline.encode_prompt(
+            prompt, self.device, num_images_per_prompt=1, do_classifier_free_guidance=True
+        )
+        self._cache[prompt] = embeds
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return embeds
+
+
+class GenerationRequest:
+    """
+    A client request, whose images are put in `results` as they are generated.
+
+    Attributes:
+        prompt: The prompt.
+        seeds: The seed of each requested image.
+        adapter: The name of the LoRA adapter, or None for the base model.
+        results: Queue of (index, seed, image) tuples, followed by None once all images are done, or by an exception.
+        submitted_at: The time the request was received.
+    """
+
+    def __init__(self, prompt: str, num_images: int, seed: int, adapter: Optional[str] = None):
+        self.prompt = prompt
+        self.seeds = [seed + i for i in range(num_images)]
+        self.adapter = adapter
+        self.results = queue.Queue()
+        self.submitted_at = time.perf_counter()
+        self.remaining = num_images
+
+
+class MicroBatcher:
+    """
+    Background thread merging the images of concurrent requests into batches of a single adapter.
+
+    Attributes:
+        generator: The WatchGenerator.
+        max_batch_size: The maximum number of images per batch.
+        max_wait: The maximum time, in seconds, to wait for a batch to fill after its first image.
+        lora_scale: The LoRA scale of the adapters.
+        fuse_adapters: Whether to fuse the adapter of each batch into the base weights.
+    """
+
+    def __init__(
+        self,
+        generator: WatchGenerator,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 50,
+        cache_size: int = 1024,
+        lora_scale: float = 1.0,
+        fuse_adapters: bool = False,
+    ):
+        """
+        Initialize the batcher and start its thread.
+
+        Args:
+            generator: The WatchGenerator.
+            max_batch_size: The maximum number of images per batch.
+            max_wait_ms: The maximum time, in milliseconds, to wait for a batch to fill after its first image.
+            cache_size: The maximum number of prompts in the embeddings cache.
+            lora_scale: The LoRA scale of the adapters.
+            fuse_adapters: Whether to fuse the adapter of each batch into the base weights. Fusing costs a pass over
+                the attention weights at each switch, and makes batches of the same adapter faster.
+        """
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.lora_scale = lora_scale
+        self.fuse_adapters = fuse_adapters
+        self.embeddings = PromptEmbeddingCache(generator.pipeline, generator.device, max_size=cache_size)
+        self._jobs = queue.Queue()
+        # Jobs taken from the queue while filling a batch of another adapter, served first
+        self._deferred = deque()
+        self._latencies = deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_images = 0
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, request: GenerationRequest):
+        """
+        Queue the images of a request.
+
+        Args:
+            request: The request.
+        """
+        for index, seed in enumerate(request.seeds):
+            self._jobs.put((request, index, seed))
+
+    def _next_batch(self) -> list:
+        pending = list(self._deferred) if self._deferred else [self._jobs.get()]
+        self._deferred.clear()
+        adapter = pending[0][0].adapter
+        batch = []
+        for job in pending:
+            if job[0].adapter == adapter and len(batch) < self.max_batch_size:
+                batch.append(job)
+            else:
+                self._deferred.append(job)
+
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                job = self._jobs.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job[0].adapter == adapter:
+                batch.append(job)
+            else:
+                self._deferred.append(job)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.generator.activate_adapter(batch[0][0].adapter, scale=self.lora_scale, fuse=self.fuse_adapters)
+                embeds = [self.embeddings(request.prompt) for request, _, _ in batch]
+                images = self.generator.generate_batch(
+                    None,
+                    [seed for _, _, seed in batch],
+                    prompt_embeds=torch.cat([prompt_embeds for prompt_embeds, _ in embeds]),
+                    negative_prompt_embeds=torch.cat([negative_embeds for _, negative_embeds in embeds]),
+                )
+            except Exception as e:
+                logger.exception("Generation failed")
+                for request in {request for request, _, _ in batch}:
+                    request.results.put(e)
+                continue
+
+            for (request, index, seed), image in zip(batch, images):
+                request.results.put((index, seed, image))
+                request.remaining -= 1
+                if request.remaining == 0:
+                    request.results.put(None)
+                    with self._lock:
+                        self._latencies.append(time.perf_counter() - request.submitted_at)
+                        self.num_requests += 1
+            with self._lock:
+                self.num_images += len(batch)
+
+    def metrics(self) -> dict:
+        """
+        Get the serving metrics.
+
+        Returns:
+            dict: The queue depth, the number of completed requests and images, and request latency percentiles in
+                milliseconds over the last 1000 requests.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            metrics = {
+                "queue_depth": self._jobs.qsize() + len(self._deferred),
+                "requests": self.num_requests,
+                "images": self.num_images,
+                "active_adapter": self.generator.adapters.active,
+            }
+        if len(latencies):
+            for p in [50, 90, 95, 99]:
+                metrics[f"latency_p{p}_ms"] = float(np.percentile(latencies, p))
+        return metrics
+
+
+class GenerationHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    batcher: MicroBatcher = None
+    default_adapter: str = BASE_MODEL
+    max_images: int = 16
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send_json(200, self.batcher.metrics())
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(body, dict):
+                raise TypeError("the body must be a JSON object")
+            if not isinstance(body["prompt"], str):
+                raise TypeError("the prompt must be a string")
+            num_images = int(body.get("num_images", 1))
+            if not 1 <= num_images <= self.max_images:
+                raise ValueError(f"num_images must be between 1 and {self.max_images}")
+            adapter = body.get("adapter", self.default_adapter)
+            if adapter == BASE_MODEL:
+                adapter = None
+            elif adapter not in self.batcher.generator.adapters.paths:
+                raise ValueError(f"unknown adapter {adapter}")
+            request = GenerationRequest(body["prompt"], num_images, int(body.get("seed", 0)), adapter=adapter)
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        self.batcher.submit(request)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        while True:
+            result = request.results.get()
+            if result is None:
+                break
+            if isinstance(result, Exception):
+                self._write_chunk(json.dumps({"error": str(result)}).encode("utf-8") + b"\n")
+                break
+            index, seed, image = result
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            line = {"index": index, "seed": seed, "image": base64.b64encode(buffer.getvalue()).decode("ascii")}
+            self._write_chunk(json.dumps(line).encode("utf-8") + b"\n")
+        self._write_chunk(b"")
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve watch images generated with a LoRA fine-tuned Stable Diffusion."
+    )
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        required=True,
+        help="Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--revision",
+        type=str,
+        default=None,
+        help="Revision of pretrained model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--lora_dir",
+        type=str,
+        default=None,
+        help=f"Directory holding the trained LoRA weights, served as the '{DEFAULT_ADAPTER}' adapter.",
+    )
+    parser.add_argument(
+        "--adapter",
+        type=str,
+        action="append",
+        default=[],
+        metavar="NAME=PATH",
+        help="An additional LoRA adapter, e.g. a checkpoint directory. Can be given several times.",
+    )
+    parser.add_argument("--max_adapters", type=int, default=4, help="Maximum number of adapters kept in memory.")
+    parser.add_argument(
+        "--adapter_memory_mb", type=float, default=None, help="Maximum size of the adapters kept in memory."
+    )
+    parser.add_argument("--lora_scale", type=float, default=1.0, help="Scale of the LoRA adapters.")
+    parser.add_argument(
+        "--fuse_adapters",
+        action="store_true",
+        help="Fuse the adapter of each batch into the base weights. Faster when batches rarely switch adapters.",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Maximum number of images per batch.")
+    parser.add_argument(
+        "--max_wait_ms", type=float, default=50, help="Maximum time to wait for a batch to fill after its first image."
+    )
+    parser.add_argument("--max_images", type=int, default=16, help="Maximum number of images per request.")
+    parser.add_argument("--cache_size", type=int, default=1024, help="Number of prompts in the embeddings cache.")
+    parser.add_argument("--num_inference_steps", type=int, default=30, help="Number of denoising steps.")
+    parser.add_argument("--scheduler", type=str, default="default", choices=VALIDATION_SCHEDULERS)
+    parser.add_argument("--device", type=str, default=None, help="Device to run on, defaults to CUDA if available.")
+
+    args = parser.parse_args()
+    for adapter in args.adapter:
+        name, sep, _ = adapter.partition("=")
+        if not sep or name in [DEFAULT_ADAPTER, BASE_MODEL]:
+            raise ValueError(f"Invalid adapter {adapter}, expected NAME=PATH with a name other than the reserved ones")
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", level=logging.INFO)
+
+    generator = WatchGenerator(
+        args.pretrained_model_name_or_path,
+        lora_dir=args.lora_dir,
+        device=args.device,
+        revision=args.revision,
+        scheduler=args.scheduler,
+        num_inference_steps=args.num_inference_steps,
+        batch_size=args.max_batch_size,
+        max_adapters=args.max_adapters,
+        adapter_memory_mb=args.adapter_memory_mb,
+    )
+    for adapter in args.adapter:
+        name, _, path = adapter.partition("=")
+        generator.adapters.register(name, path)
+    GenerationHandler.batcher = MicroBatcher(
+        generator,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        cache_size=args.cache_size,
+        lora_scale=args.lora_scale,
+        fuse_adapters=args.fuse_adapters,
+    )
+    GenerationHandler.max_images = args.max_images
+    if args.lora_dir is not None:
+        GenerationHandler.default_adapter = DEFAULT_ADAPTER
+
+    server = ThreadingHTTPServer((args.host, args.port), GenerationHandler)
+    logger.info(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
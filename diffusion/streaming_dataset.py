@@ -0,0 +1,240 @@
+"""
+This module defines a sharded, streaming version of the watches dataset, for training on datasets that do not fit in
+RAM or in the local disk cache.
+
+Samples are stored in shards (Parquet files or webdataset-style tar files) listed in an `index.json` manifest. Shards
+are read sequentially, shuffled at the shard level and through a bounded shuffle buffer, and split between training
+processes and dataloader workers.
+"""
+
+import io
+import json
+import os
+import random
+import tarfile
+from typing import Callable, Iterable, Iterator
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+from PIL import Image
+
+from options import INDEX_NAME, SHARD_FORMATS
+
+IMAGE_EXTENSIONS = ["jpg", "jpeg", "png", "webp"]
+
+
+def write_shards(
+    samples: Iterable, output_dir: str, samples_per_shard: int = 1000, shard_format: str = "parquet"
+) -> dict:
+    """
+    Write (image bytes, text) samples to shards and write the manifest.
+
+    Args:
+        samples: The samples, as (encoded image bytes, caption) tuples, or (encoded image bytes, caption, latents)
+            tuples, the latents being serialized with `numpy.save`. Latents are stored in a `latents` column, or as
+            `<key>.npy` members of tar shards, and ignored by ShardedWatchesDataset.
+        output_dir: The directory to write the shards and the manifest to.
+        samples_per_shard: The number of samples per shard.
+        shard_format: 'parquet' or 'tar' (webdataset layout, one `<key>.jpg` and one `<key>.txt` per sample).
+
+    Returns:
+        dict: The manifest.
+    """
+    if shard_format not in SHARD_FORMATS:
+        raise ValueError(f"Unknown shard format {shard_format}, choose between {SHARD_FORMATS}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    shards = []
+    buffer = []
+
+    def flush():
+        name = f"shard-{len(shards):05d}.{shard_format}"
+        if shard_format == "parquet":
+            columns = {"image": [sample[0] for sample in buffer], "text": [sample[1] for sample in buffer]}
+            if len(buffer[0]) > 2:
+                columns["latents"] = [sample[2] for sample in buffer]
+            pq.write_table(pa.table(columns), os.path.join(output_dir, name))
+        else:
+            with tarfile.open(os.path.join(output_dir, name), "w") as tar:
+                for i, (image_bytes, text, *latents) in enumerate(buffer):
+                    key = f"{len(shards):05d}{i:06d}"
+                    members = [("jpg", image_bytes), ("txt", text.encode("utf-8"))] + [
+                        ("npy", array) for array in latents
+                    ]
+                    for suffix, data in members:
+                        info = tarfile.TarInfo(f"{key}.{suffix}")
+                        info.size = len(data)
+                        tar.addfile(info, io.BytesIO(data))
+        shards.append({"path": name, "num_samples": len(buffer)})
+        buffer.clear()
+
+    for sample in samples:
+        buffer.append(sample)
+        if len(buffer) == samples_per_shard:
+            flush()
+    if buffer:
+        flush()
+
+    manifest = {"format": shard_format, "shards": shards, "num_samples": sum(s["num_samples"] for s in shards)}
+    with open(os.path.join(output_dir, INDEX_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def read_manifest(path: str) -> dict:
+    """
+    Read the manifest of a sharded dataset.
+
+    Args:
+        path: The directory containing the shards and the manifest.
+
+    Returns:
+        dict: The manifest.
+    """
+    with open(os.path.join(path, INDEX_NAME)) as f:
+        return json.load(f)
+
+
+def _iter_parquet(path: str) -> Iterator[tuple]:
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=256, columns=["image", "text"]):
+        yield from zip(batch.column("image").to_pylist(), batch.column("text").to_pylist())
+
+
+def _iter_tar(path: str) -> Iterator[tuple]:
+    # Members of a sample are consecutive in the tar file and share the same key
+    key, sample = None, {}
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, _, suffix = member.name.rpartition(".")
+            if member_key != key and sample:
+                yield _tar_sample(sample)
+                sample = {}
+            key = member_key
+            sample[suffix.lower()] = tar.extractfile(member).read()
+    if sample:
+        yield _tar_sample(sample)
+
+
+def _tar_sample(sample: dict) -> tuple:
+    image_bytes = next(sample[ext] for ext in IMAGE_EXTENSIONS if ext in sample)
+    return image_bytes, sample["txt"].decode("utf-8")
+
+
+class ShardedWatchesDataset(torch.utils.data.IterableDataset):
+    """
+    Iterable dataset streaming samples from shards.
+
+    Every epoch, shards are permuted with a seed shared by all processes, then assigned round-robin to processes
+    (by rank) and to the dataloader workers of each process. Each worker reads its shards sequentially through a
+    bounded shuffle buffer. The order of the samples only depends on the seed and the epoch, so a run can resume at
+    any step by skipping records, which does not decode images.
+
+    Attributes:
+        path: The directory containing the shards and the manifest.
+        transform: The function applied to each {'image', 'text'} example, e.g. to tokenize and create pixel values.
+        shuffle_buffer_size: The number of samples in the shuffle buffer of each worker. 0 disables shuffling.
+        seed: The seed of the shard permutation and of the shuffle buffers.
+        rank: The index of the training process.
+        world_size: The number of training processes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        transform: Callable,
+        shuffle_buffer_size: int = 1000,
+        seed: int = 0,
+        rank: int = 0,
+        world_size: int = 1,
+    ):
+        """
+        Initialize the dataset from the manifest.
+
+        Args:
+            path: The directory containing the shards and the manifest.
+            transform: The function applied to each {'image', 'text'} example.
+            shuffle_buffer_size: The number of samples in the shuffle buffer of each worker. 0 disables shuffling.
+            seed: The seed of the shard permutation and of the shuffle buffers.
+            rank: The index of the training process.
+            world_size: The number of training processes.
+        """
+        self.path = path
+        self.manifest = read_manifest(path)
+        self.transform = transform
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.skip_batches = 0
+        self.batch_size = 1
+        if len(self.manifest["shards"]) < world_size:
+            raise ValueError(
+                f"{path} has {len(self.manifest['shards'])} shards, fewer than the {world_size} processes"
+            )
+
+    def __len__(self) -> int:
+        # Ranks get different shards every epoch: the length is the fewest samples a rank can get, so that all
+        # processes can run the same number of steps per epoch.
+        sizes = sorted(s["num_samples"] for s in self.manifest["shards"])
+        return sum(sizes[: len(sizes) // self.world_size])
+
+    def set_epoch(self, epoch: int, skip_batches: int = 0, batch_size: int = 1):
+        """
+        Set the epoch, which determines the order of the samples, and the position to start from in that epoch.
+
+        Must be called before the dataloader iterator of the epoch is created.
+
+        Args:
+            epoch: The epoch.
+            skip_batches: The number of batches of this process already consumed in this epoch.
+            batch_size: The batch size of the dataloader.
+        """
+        self.epoch = epoch
+        self.skip_batches = skip_batches
+        self.batch_size = batch_size
+
+    def _worker_shards(self, worker_id: int, num_workers: int) -> list:
+        shards = list(self.manifest["shards"])
+        random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[self.rank :: self.world_size][worker_id::num_workers]
+
+    def _iter_records(self, shards: list) -> Iterator[tuple]:
+        read = _iter_parquet if self.manifest["format"] == "parquet" else _iter_tar
+        for shard in shards:
+            yield from read(os.path.join(self.path, shard["path"]))
+
+    def _shuffle(self, records: Iterator[tuple], rng: random.Random) -> Iterator[tuple]:
+        if self.shuffle_buffer_size <= 0:
+            yield from records
+            return
+        buffer = []
+        for record in records:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(record)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = record
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self) -> Iterator[dict]:
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        rng = random.Random(f"{self.seed}-{self.epoch}-{self.rank}-{worker_id}")
+
+        # The dataloader takes batches from its workers in turn: this worker produced batches
+        # worker_id, worker_id + num_workers, ... of the batches already consumed.
+        skip_samples = len(range(worker_id, self.skip_batches, num_workers)) * self.batch_size
+
+        records = self._shuffle(self._iter_records(self._worker_shards(worker_id, num_workers)), rng)
+        for i, (image_bytes, text) in enumerate(records):
+            if i < skip_samples:
+                continue
+            # The image is opened lazily, so that the transform can decode it at a reduced scale
+            yield self.transform({"image": Image.open(io.BytesIO(image_bytes)), "text": text})
@@ -15,6 +15,7 @@
 """Fine-tuning script for Stable Diffusion for text2image with support for LoRA."""
 
 import argparse
+import json
 import logging
 import math
 import os
@@ -22,36 +23,11 @@ import random
 import shutil
 from pathlib import Path
 
-import datasets
-import numpy as np
-import torch
-import torch.nn.functional as F
-import torch.utils.checkpoint
-import transformers
-from accelerate import Accelerator
-from accelerate.logging import get_logger
-from accelerate.utils import ProjectConfiguration, set_seed
-from datasets import load_dataset, Dataset
-from huggingface_hub import create_repo, upload_folder
-from packaging import version
-from torchvision import transforms
-from tqdm.auto import tqdm
-from transformers import CLIPTextModel, CLIPTokenizer
-
-import diffusers
-from diffusers import AutoencoderKL, DDPMScheduler, DiffusionPipeline, UNet2DConditionModel
-from diffusers.loaders import AttnProcsLayers
-from diffusers.models.attention_processor import LoRAAttnProcessor
-from diffusers.optimization import get_scheduler
-from diffusers.training_utils import compute_snr
-from diffusers.utils import check_min_version, is_wandb_available
-from diffusers.utils.import_utils import is_xformers_available
-
-
-# Will error if the minimal version of diffusers is not installed. Remove at your own risks.
-check_min_version("0.23.0.dev0")
-
-logger = get_logger(__name__, log_level="INFO")
+from options import COMPILE_MODES, INDEX_NAME, TIMESTEP_SAMPLINGS, VALIDATION_METRICS, VALIDATION_SCHEDULERS
+
+# torch, diffusers, datasets and the other heavy modules are imported in `main`, once the arguments are parsed, so
+# that `--help`, invalid arguments and `--dry_run` return immediately. `logger` becomes an accelerate logger there.
+logger = logging.getLogger(__name__)
 
 
 def save_model_card(repo_id: str, images=None, base_model=str, dataset_name=str, repo_folder=None):
@@ -124,6 +100,23 @@ def parse_args():
             " must exist to provide the captions for the images. Ignored if `dataset_name` is specified."
         ),
     )
+    parser.add_argument(
+        "--train_shards",
+        type=str,
+        default=None,
+        help=(
+            "A directory of Parquet or tar shards written by `WatchesDataset.save_shards`. Enables the streaming mode:"
+            " shards are read sequentially, shuffled at the shard level and through a bounded shuffle buffer, and"
+            " split between processes and dataloader workers. Use at least `num_processes * dataloader_num_workers`"
+            " shards."
+        ),
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        type=int,
+        default=1000,
+        help="Number of samples in the shuffle buffer of each dataloader worker in streaming mode.",
+    )
     parser.add_argument(
         "--image_column", type=str, default="image", help="The column of the dataset containing an image."
     )
@@ -136,11 +129,53 @@ def parse_args():
     parser.add_argument(
         "--validation_prompt", type=str, default=None, help="A prompt that is sampled during training for inference."
     )
+    parser.add_argument(
+        "--validation_suite",
+        type=str,
+        default=None,
+        help=(
+            "A text file with one validation prompt per line (see `diffusion/validation_prompts.txt`, or"
+            " `validation_prompts_legacy.txt` for LoRA weights trained on the captions stored before the typed"
+            " schema). Overrides `--validation_prompt`."
+        ),
+    )
     parser.add_argument(
         "--num_validation_images",
         type=int,
         default=4,
-        help="Number of images that should be generated during validation with `validation_prompt`.",
+        help="Number of images that should be generated during validation with each validation prompt.",
+    )
+    parser.add_argument(
+        "--validation_max_batch_size",
+        type=int,
+        default=8,
+        help="Maximum number of validation images generated in one batch, across prompts. Bounds the memory used.",
+    )
+    parser.add_argument(
+        "--validation_metrics",
+        type=str,
+        nargs="*",
+        default=[],
+        choices=VALIDATION_METRICS,
+        help=(
+            "Image-quality metrics computed on validation images and logged to the trackers. FID and KID are"
+            " computed against `--validation_reference_samples` images held out from the training dataset."
+        ),
+    )
+    parser.add_argument(
+        "--validation_reference_samples",
+        type=int,
+        default=256,
+        help="Number of dataset images held out from training as reference for FID and KID.",
+    )
+    parser.add_argument(
+        "--validation_reference_stats",
+        type=str,
+        default=None,
+        help=(
+            "Path of the .npz file caching the Inception features of the reference images. Defaults to"
+            " `output_dir/reference_stats.npz`. Use the same `--seed` when sharing it between runs."
+        ),
     )
     parser.add_argument(
         "--validation_epochs",
@@ -151,6 +186,22 @@ def parse_args():
             " `args.validation_prompt` multiple times: `args.num_validation_images`."
         ),
     )
+    parser.add_argument(
+        "--validation_scheduler",
+        type=str,
+        default="default",
+        choices=VALIDATION_SCHEDULERS,
+        help=(
+            "The scheduler used to generate validation images: the one the pretrained model was released with, or"
+            " `dpm_solver` (DPM-Solver++) which needs fewer `--validation_inference_steps`."
+        ),
+    )
+    parser.add_argument(
+        "--validation_inference_steps",
+        type=int,
+        default=30,
+        help="Number of denoising steps used to generate validation images.",
+    )
     parser.add_argument(
         "--max_train_samples",
         type=int,
@@ -248,6 +299,16 @@ def parse_args():
         help="SNR weighting gamma to be used if rebalancing the loss. Recommended value is 5.0. "
         "More details here: https://arxiv.org/abs/2303.09556.",
     )
+    parser.add_argument(
+        "--timestep_sampling",
+        type=str,
+        default="uniform",
+        choices=TIMESTEP_SAMPLINGS,
+        help=(
+            "How to draw the timesteps of each batch. 'importance' favours the timesteps with the largest recent"
+            " losses and reweights the loss so that it stays unbiased (https://arxiv.org/abs/2102.09672)."
+        ),
+    )
     parser.add_argument(
         "--use_8bit_adam", action="store_true", help="Whether or not to use 8-bit Adam from bitsandbytes."
     )
@@ -315,6 +376,20 @@ def parse_args():
             ' (default), `"wandb"` and `"comet_ml"`. Use `"all"` to report to all integrations.'
         ),
     )
+    parser.add_argument(
+        "--logging_steps",
+        type=int,
+        default=10,
+        help=(
+            "Reduce the training loss across processes and log it every X updates. The loss of every update is still"
+            " logged at its own step, without a device sync per batch."
+        ),
+    )
+    parser.add_argument(
+        "--exact_loss_logging",
+        action="store_true",
+        help="Gather and log the training loss at every update, with a device sync per batch. Useful for debugging.",
+    )
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
     parser.add_argument(
         "--checkpointing_steps",
@@ -331,6 +406,31 @@ def parse_args():
         default=None,
         help=("Max number of checkpoints to store."),
     )
+    parser.add_argument(
+        "--async_checkpointing",
+        action="store_true",
+        help=(
+            "Whether or not to write checkpoints in a background thread. The training state is copied to CPU memory"
+            " and serialized with safetensors while training goes on; old checkpoints are pruned in the background."
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint_lora_only",
+        action="store_true",
+        help=(
+            "Only save the LoRA attention processor weights (and the lr scheduler and RNG states) in asynchronous"
+            " checkpoints. The optimizer state is then only saved every `--optimizer_checkpointing_steps`."
+        ),
+    )
+    parser.add_argument(
+        "--optimizer_checkpointing_steps",
+        type=int,
+        default=None,
+        help=(
+            "Save the optimizer state every X updates when using `--checkpoint_lora_only`. Should be a multiple of"
+            " `--checkpointing_steps`. If not set, the optimizer state is never saved."
+        ),
+    )
     parser.add_argument(
         "--resume_from_checkpoint",
         type=str,
@@ -341,7 +441,30 @@ def parse_args():
         ),
     )
     parser.add_argument(
-        "--enable_xformers_memory_efficient_attention", action="store_true", help="Whether or not to use xformers."
+        "--enable_xformers_memory_efficient_attention",
+        action="store_true",
+        help="Whether or not to use xformers. Falls back to PyTorch scaled dot-product attention if not installed.",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help=(
+            "Compile the UNet forward, the noise addition and the loss computation with `torch.compile`. Graph breaks"
+            " are logged at the first step."
+        ),
+    )
+    parser.add_argument(
+        "--compile_backend",
+        type=str,
+        default="inductor",
+        help="The `torch.compile` backend. 'inductor' also works on CPU.",
+    )
+    parser.add_argument("--compile_mode", type=str, default="default", choices=COMPILE_MODES)
+    parser.add_argument(
+        "--throughput_warmup_steps",
+        type=int,
+        default=5,
+        help="Number of first optimization steps (including compilation) excluded from the logged steps/sec.",
     )
     parser.add_argument("--noise_offset", type=float, default=0, help="The scale of noise offset.")
     parser.add_argument(
@@ -350,6 +473,14 @@ def parse_args():
         default=4,
         help=("The dimension of the LoRA update matrices."),
     )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help=(
+            "Check the configuration (arguments and input paths) and exit, without importing torch or loading any"
+            " model."
+        ),
+    )
 
     args = parser.parse_args()
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
@@ -357,12 +488,69 @@ def parse_args():
         args.local_rank = env_local_rank
 
     # Sanity checks
-    if args.dataset_name is None and args.train_data_dir is None:
-        raise ValueError("Need either a dataset name or a training folder.")
+    if args.dataset_name is None and args.train_data_dir is None and args.train_shards is None:
+        raise ValueError("Need either a dataset name, a training folder or training shards.")
+    if args.checkpoint_lora_only and not args.async_checkpointing:
+        raise ValueError("`--checkpoint_lora_only` requires `--async_checkpointing`.")
+    if args.logging_steps < 1:
+        raise ValueError("`--logging_steps` must be at least 1.")
 
     return args
 
 
+def check_config(args) -> list:
+    """
+    Check the input and output paths of the configuration, without loading anything.
+
+    Args:
+        args: The parsed arguments.
+
+    Returns:
+        list: The problems found, empty if the configuration is valid.
+    """
+    problems = []
+    if os.path.isdir(args.pretrained_model_name_or_path):
+        for subfolder in ["scheduler", "tokenizer", "text_encoder", "vae", "unet"]:
+            if not os.path.isdir(os.path.join(args.pretrained_model_name_or_path, subfolder)):
+                problems.append(f"{args.pretrained_model_name_or_path} has no {subfolder} subfolder")
+    if args.train_shards is not None:
+        if not os.path.isfile(os.path.join(args.train_shards, INDEX_NAME)):
+            problems.append(f"{args.train_shards} has no {INDEX_NAME} manifest")
+    elif args.dataset_name is not None and not os.path.isdir(args.dataset_name):
+        problems.append(f"The dataset {args.dataset_name} does not exist")
+    for name in ["train_data_dir", "validation_suite"]:
+        path = getattr(args, name)
+        if path is not None and not os.path.exists(path):
+            problems.append(f"--{name} {path} does not exist")
+    if args.resume_from_checkpoint not in [None, "latest"]:
+        checkpoint_dir = os.path.join(args.output_dir, os.path.basename(args.resume_from_checkpoint))
+        if not os.path.isdir(checkpoint_dir):
+            problems.append(f"The checkpoint {checkpoint_dir} does not exist")
+
+    # The output directory is created by the training run: its closest existing parent must be writable
+    output_dir = os.path.abspath(args.output_dir)
+    while not os.path.exists(output_dir):
+        output_dir = os.path.dirname(output_dir)
+    if not os.access(output_dir, os.W_OK):
+        problems.append(f"{output_dir} is not writable")
+    return problems
+
+
+def dry_run(args):
+    """
+    Log the configuration and the result of its checks, and raise an error if any check fails.
+
+    Args:
+        args: The parsed arguments.
+    """
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", level=logging.INFO)
+    logger.info(f"Configuration:\n{json.dumps(vars(args), indent=2, default=str)}")
+    problems = check_config(args)
+    if problems:
+        raise ValueError("Invalid configuration:\n" + "\n".join(f"- {problem}" for problem in problems))
+    logger.info("The configuration is valid")
+
+
 DATASET_NAME_MAPPING = {
     "lambdalabs/pokemon-blip-captions": ("image", "text"),
 }
@@ -370,6 +558,55 @@ DATASET_NAME_MAPPING = {
 
 def main():
     args = parse_args()
+    if args.dry_run:
+        dry_run(args)
+        return
+
+    import datasets
+    import numpy as np
+    import torch
+    import torch.utils.checkpoint
+    import transformers
+    from accelerate import Accelerator
+    from accelerate.logging import get_logger
+    from accelerate.utils import ProjectConfiguration, set_seed
+    from datasets import Dataset
+    from datasets import Image as DatasetImage
+    from packaging import version
+    from torchvision import transforms
+    from tqdm.auto import tqdm
+    from transformers import CLIPTextModel, CLIPTokenizer
+
+    import diffusers
+    from diffusers import AutoencoderKL, DDPMScheduler, UNet2DConditionModel
+    from diffusers.loaders import AttnProcsLayers
+    from diffusers.optimization import get_scheduler
+    from diffusers.utils import check_min_version, is_wandb_available
+    from diffusers.utils.import_utils import is_xformers_available
+
+    from checkpointing import (
+        AsyncCheckpointWriter,
+        is_lora_checkpoint,
+        list_checkpoints,
+        load_checkpoint,
+        load_extra_state,
+        save_extra_state,
+    )
+    from compile_utils import compile_function, lora_attn_processor_class, report_graph_breaks
+    from image_decoding import decode_image
+    from training_metrics import DeferredLossLogger, ThroughputMeter
+    from noise_schedule import NoiseScheduleTables, make_timestep_sampler
+    from samplers import ResumableRandomSampler
+    from streaming_dataset import ShardedWatchesDataset
+    from validation import ValidationEngine, load_validation_scheduler, load_validation_suite
+    from validation_metrics import ValidationMetrics
+
+    # Will error if the minimal version of diffusers is not installed. Remove at your own risks.
+    check_min_version("0.23.0.dev0")
+
+    global logger
+    logger = get_logger(__name__, log_level="INFO")
+
     logging_dir = Path(args.output_dir, args.logging_dir)
 
     accelerator_project_config = ProjectConfiguration(project_dir=args.output_dir, logging_dir=logging_dir)
@@ -411,6 +648,8 @@ def main():
             os.makedirs(args.output_dir, exist_ok=True)
 
         if args.push_to_hub:
+            from huggingface_hub import create_repo
+
             repo_id = create_repo(
                 repo_id=args.hub_model_id or Path(args.output_dir).name, exist_ok=True, token=args.hub_token
             ).repo_id
@@ -458,6 +697,7 @@ def main():
     # => 32 layers
 
     # Set correct lora layers
+    attn_processor_class = lora_attn_processor_class(args.enable_xformers_memory_efficient_attention)
     lora_attn_procs = {}
     for name in unet.attn_processors.keys():
         cross_attention_dim = None if name.endswith("attn1.processor") else unet.config.cross_attention_dim
@@ -470,7 +710,7 @@ def main():
             block_id = int(name[len("down_blocks.")])
             hidden_size = unet.config.block_out_channels[block_id]
 
-        lora_attn_procs[name] = LoRAAttnProcessor(
+        lora_attn_procs[name] = attn_processor_class(
             hidden_size=hidden_size,
             cross_attention_dim=cross_attention_dim,
             rank=args.rank,
@@ -478,18 +718,15 @@ def main():
 
     unet.set_attn_processor(lora_attn_procs)
 
-    if args.enable_xformers_memory_efficient_attention:
-        if is_xformers_available():
-            import xformers
+    if args.enable_xformers_memory_efficient_attention and is_xformers_available():
+        import xformers
 
-            xformers_version = version.parse(xformers.__version__)
-            if xformers_version == version.parse("0.0.16"):
-                logger.warn(
-                    "xFormers 0.0.16 cannot be used for training in some GPUs. If you observe problems during training, please update xFormers to at least 0.0.17. See https://huggingface.co/docs/diffusers/main/en/optimization/xformers for more details."
-                )
-            unet.enable_xformers_memory_efficient_attention()
-        else:
-            raise ValueError("xformers is not available. Make sure it is installed correctly")
+        xformers_version = version.parse(xformers.__version__)
+        if xformers_version == version.parse("0.0.16"):
+            logger.warn(
+                "xFormers 0.0.16 cannot be used for training in some GPUs. If you observe problems during training, please update xFormers to at least 0.0.17. See https://huggingface.co/docs/diffusers/main/en/optimization/xformers for more details."
+            )
+        unet.enable_xformers_memory_efficient_attention()
 
     lora_layers = AttnProcsLayers(unet.attn_processors)
 
@@ -549,11 +786,16 @@ def main():
     #     # See more about loading custom images at
     #     # https://huggingface.co/docs/datasets/v2.4.0/en/image_load#imagefolder
 
-    dataset = Dataset.load_from_disk(args.dataset_name)
+    if args.train_shards is not None:
+        # Streaming mode: samples are read sequentially from the shards written by `WatchesDataset.save_shards`
+        dataset = None
+        column_names = ["image", "text"]
+    else:
+        dataset = Dataset.load_from_disk(args.dataset_name)
 
-    # Preprocessing the datasets.
-    # We need to tokenize inputs and targets.
-    column_names = dataset.column_names
+        # Preprocessing the datasets.
+        # We need to tokenize inputs and targets.
+        column_names = dataset.column_names
 
     # 6. Get the column names for input/target.
     dataset_columns = DATASET_NAME_MAPPING.get(args.dataset_name, None)
@@ -605,16 +847,38 @@ def main():
     )
 
     def preprocess_train(examples):
-        images = [image.convert("RGB") for image in examples[image_column]]
+        # Runs in the dataloader workers: JPEG images are decoded directly at a reduced scale, down to the resolution
+        images = [decode_image(image, args.resolution) for image in examples[image_column]]
         examples["pixel_values"] = [train_transforms(image) for image in images]
         examples["input_ids"] = tokenize_captions(examples)
         return examples
 
-    with accelerator.main_process_first():
-        if args.max_train_samples is not None:
-            dataset = dataset.shuffle(seed=args.seed).select(range(args.max_train_samples))
-        # Set the training transforms
-        train_dataset = dataset.with_transform(preprocess_train)
+    def preprocess_example(example):
+        examples = preprocess_train({key: [value] for key, value in example.items()})
+        return {"pixel_values": examples["pixel_values"][0], "input_ids": examples["input_ids"][0]}
+
+    reference_dataset = None
+    if args.train_shards is not None:
+        train_dataset = ShardedWatchesDataset(
+            args.train_shards,
+            preprocess_example,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+            seed=args.seed if args.seed is not None else 0,
+            rank=accelerator.process_index,
+            world_size=accelerator.num_processes,
+        )
+    else:
+        with accelerator.main_process_first():
+            if {"fid", "kid"} & set(args.validation_metrics):
+                # Hold out a sample of the dataset as reference images for FID/KID
+                split = dataset.train_test_split(test_size=args.validation_reference_samples, seed=args.seed)
+                dataset, reference_dataset = split["train"], split["test"]
+            if args.max_train_samples is not None:
+                dataset = dataset.shuffle(seed=args.seed).select(range(args.max_train_samples))
+            # Set the training transforms. Images are decoded by `preprocess_train` rather than by the dataset
+            train_dataset = dataset.cast_column(image_column, DatasetImage(decode=False)).with_transform(
+                preprocess_train
+            )
 
     def collate_fn(examples):
         pixel_values = torch.stack([example["pixel_values"] for example in examples])
@@ -622,13 +886,34 @@ def main():
         input_ids = torch.stack([example["input_ids"] for example in examples])
         return {"pixel_values": pixel_values, "input_ids": input_ids}
 
+    # The streaming dataset shuffles shards and samples itself. Otherwise, the sampler state is saved in checkpoints
+    # so that a resumed run starts from the first sample not seen in its epoch.
+    train_sampler = None
+    if args.train_shards is None:
+        # Near-duplicates are down-weighted by the dataset build (`watches_dataset.py --dedup weight`)
+        sample_weights = dataset["weight"] if "weight" in column_names else None
+        train_sampler = ResumableRandomSampler(
+            len(train_dataset), seed=args.seed if args.seed is not None else 0, weights=sample_weights
+        )
+
+    if args.prediction_type is not None:
+        # set prediction_type of scheduler if defined
+        noise_scheduler.register_to_config(prediction_type=args.prediction_type)
+    # Per-timestep noising coefficients and loss weights, computed once on the device
+    noise_schedule = NoiseScheduleTables(
+        noise_scheduler, accelerator.device, noise_scheduler.config.prediction_type, snr_gamma=args.snr_gamma
+    )
+    # Its state, if any, is saved with the checkpoints by `extra_checkpoint_state`
+    timestep_sampler = make_timestep_sampler(args.timestep_sampling, noise_schedule.num_timesteps, accelerator.device)
+
     # DataLoaders creation:
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
-        shuffle=True,
+        sampler=train_sampler,
         collate_fn=collate_fn,
         batch_size=args.train_batch_size,
         num_workers=args.dataloader_num_workers,
+        pin_memory=args.train_shards is not None,
     )
 
     # Scheduler and math around the number of training steps.
@@ -646,9 +931,13 @@ def main():
     )
 
     # Prepare everything with our `accelerator`.
-    lora_layers, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        lora_layers, optimizer, train_dataloader, lr_scheduler
-    )
+    if args.train_shards is not None:
+        # The streaming dataset already splits shards between processes: its dataloader is not sharded by accelerate
+        lora_layers, optimizer, lr_scheduler = accelerator.prepare(lora_layers, optimizer, lr_scheduler)
+    else:
+        lora_layers, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
+            lora_layers, optimizer, train_dataloader, lr_scheduler
+        )
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
@@ -674,6 +963,7 @@ def main():
     logger.info(f"  Total optimization steps = {args.max_train_steps}")
     global_step = 0
     first_epoch = 0
+    resume_step = 0
 
     # Potentially load in the weights and states from a previous save
     if args.resume_from_checkpoint:
@@ -681,9 +971,7 @@ def main():
             path = os.path.basename(args.resume_from_checkpoint)
         else:
             # Get the most recent checkpoint
-            dirs = os.listdir(args.output_dir)
-            dirs = [d for d in dirs if d.startswith("checkpoint")]
-            dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
+            dirs = list_checkpoints(args.output_dir)
             path = dirs[-1] if len(dirs) > 0 else None
 
         if path is None:
@@ -694,14 +982,100 @@ def main():
             initial_global_step = 0
         else:
             accelerator.print(f"Resuming from checkpoint {path}")
-            accelerator.load_state(os.path.join(args.output_dir, path))
+            if is_lora_checkpoint(os.path.join(args.output_dir, path)):
+                training_state = load_checkpoint(
+                    os.path.join(args.output_dir, path),
+                    accelerator.unwrap_model(lora_layers),
+                    optimizer=optimizer,
+                    lr_scheduler=lr_scheduler,
+                )
+            else:
+                accelerator.load_state(os.path.join(args.output_dir, path))
+                # The sampler states are not registered with accelerate, and missing from older checkpoints
+                training_state = load_extra_state(os.path.join(args.output_dir, path))
+            if args.timestep_sampling != "uniform" and "timestep_sampler" in training_state:
+                timestep_sampler.load_state_dict(training_state["timestep_sampler"])
             global_step = int(path.split("-")[1])
 
             initial_global_step = global_step
             first_epoch = global_step // num_update_steps_per_epoch
+            # Number of batches of this process already consumed in the first epoch
+            resume_step = (global_step % num_update_steps_per_epoch) * args.gradient_accumulation_steps
+            if train_sampler is not None and "sampler" in training_state:
+                train_sampler.load_state_dict(training_state["sampler"])
+                if train_sampler.epoch != first_epoch:
+                    # The checkpoint was saved at the end of an epoch
+                    train_sampler.set_epoch(first_epoch)
+                    resume_step = 0
+            elif train_sampler is not None:
+                # Checkpoint of an older version of this script, whose permutation is lost: only the number of
+                # samples consumed in the epoch is skipped
+                train_sampler.set_epoch(first_epoch)
+                train_sampler.set_position(resume_step * args.train_batch_size * accelerator.num_processes)
     else:
         initial_global_step = 0
 
+    validation_engine = None
+    validation_metrics = None
+    if args.validation_suite is not None:
+        validation_prompts = load_validation_suite(args.validation_suite)
+    else:
+        validation_prompts = [args.validation_prompt] if args.validation_prompt is not None else []
+    loss_logger = DeferredLossLogger(accelerator, args.logging_steps, args.gradient_accumulation_steps)
+
+    checkpoint_writer = None
+    if args.async_checkpointing:
+        checkpoint_writer = AsyncCheckpointWriter(args.output_dir, total_limit=args.checkpoints_total_limit)
+
+    def build_validation_engine():
+        # Inference pipeline shared by the periodic validations and the final inference
+        return ValidationEngine(
+            vae=vae,
+            text_encoder=text_encoder,
+            tokenizer=tokenizer,
+            unet=accelerator.unwrap_model(unet),
+            scheduler=load_validation_scheduler(
+                args.pretrained_model_name_or_path, args.validation_scheduler, revision=args.revision
+            ),
+            device=accelerator.device,
+            num_inference_steps=args.validation_inference_steps,
+            # Fixed seeds make validations comparable across epochs and runs
+            seed=args.seed if args.seed is not None else 0,
+        )
+
+    def add_noise(latents, noise, timesteps):
+        # Add noise to the latents according to the noise magnitude at each timestep
+        # (this is the forward diffusion process), and get the target for loss depending on the prediction type
+        return noise_schedule.add_noise(latents, noise, timesteps)
+
+    def compute_loss(model_pred, target, timesteps, timestep_weights):
+        # Per-sample losses, with the min-SNR weights of https://arxiv.org/abs/2303.09556 if `--snr_gamma` is set
+        sample_losses = noise_schedule.sample_losses(model_pred, target, timesteps)
+        if timestep_weights is None:
+            return sample_losses.mean(), sample_losses
+        # Keep the loss unbiased when timesteps are not drawn uniformly
+        return (sample_losses * timestep_weights).mean(), sample_losses
+
+    # The eager UNet is kept for validation and saving, only the training forward is compiled
+    unet_forward, add_noise_fn, compute_loss_fn = unet, add_noise, compute_loss
+    if args.compile:
+        unet_forward, add_noise_fn, compute_loss_fn = (
+            compile_function(fn, backend=args.compile_backend, mode=args.compile_mode)
+            for fn in [unet, add_noise, compute_loss]
+        )
+
+    def extra_checkpoint_state():
+        # States saved with the LoRA-only checkpoints of the asynchronous writer, and next to the accelerate ones
+        state = {}
+        if train_sampler is not None:
+            state["sampler"] = train_sampler.state_dict()
+        if args.timestep_sampling != "uniform":
+            state["timestep_sampler"] = timestep_sampler.state_dict()
+        return state or None
+
+    throughput = ThroughputMeter(warmup_steps=args.throughput_warmup_steps)
+    report_compilation = args.compile
+
     progress_bar = tqdm(
         range(0, args.max_train_steps),
         initial=initial_global_step,
@@ -713,7 +1087,22 @@ def main():
     for epoch in range(first_epoch, args.num_train_epochs):
         unet.train()
         train_loss = 0.0
-        for step, batch in enumerate(train_dataloader):
+        skip_batches = resume_step if epoch == first_epoch else 0
+        if args.train_shards is not None:
+            train_dataset.set_epoch(epoch, skip_batches=skip_batches, batch_size=args.train_batch_size)
+        else:
+            # The prepared dataloader sets the epoch of the sampler every time it is iterated, from its own counter
+            train_dataloader.set_epoch(epoch)
+            if epoch == first_epoch and resume_step:
+                # Seek the sampler directly to the first sample not consumed before the checkpoint
+                accelerator.print(f"Skipping {train_sampler.position} samples already seen in epoch {epoch}")
+                train_sampler.seek(train_sampler.position)
+        for step, batch in enumerate(train_dataloader, start=skip_batches):
+            if args.train_shards is not None:
+                # Every process runs the same number of steps, whatever the size of its shards
+                if step >= len(train_dataloader):
+                    break
+                batch = {key: value.to(accelerator.device, non_blocking=True) for key, value in batch.items()}
             with accelerator.accumulate(unet):
                 # Convert images to latent space
                 latents = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist.sample()
@@ -729,52 +1118,36 @@ def main():
 
                 bsz = latents.shape[0]
                 # Sample a random timestep for each image
-                timesteps = torch.randint(0, noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device)
-                timesteps = timesteps.long()
-
-                # Add noise to the latents according to the noise magnitude at each timestep
-                # (this is the forward diffusion process)
-                noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
+                timesteps, timestep_weights = timestep_sampler.sample(bsz, latents.device)
 
                 # Get the text embedding for conditioning
                 encoder_hidden_states = text_encoder(batch["input_ids"])[0]
 
-                # Get the target for loss depending on the prediction type
-                if args.prediction_type is not None:
-                    # set prediction_type of scheduler if defined
-                    noise_scheduler.register_to_config(prediction_type=args.prediction_type)
+                if report_compilation:
+                    # Before any compiled call, since tracing resets the compilation caches
+                    with torch.no_grad():
+                        report_graph_breaks("add_noise", add_noise, latents, noise, timesteps)
+                        example_latents, example_target = add_noise(latents, noise, timesteps)
+                        report_graph_breaks("unet", unet, example_latents, timesteps, encoder_hidden_states)
+                        report_graph_breaks(
+                            "compute_loss", compute_loss, example_target, example_target, timesteps, timestep_weights
+                        )
+                    report_compilation = False
 
-                if noise_scheduler.config.prediction_type == "epsilon":
-                    target = noise
-                elif noise_scheduler.config.prediction_type == "v_prediction":
-                    target = noise_scheduler.get_velocity(latents, noise, timesteps)
-                else:
-                    raise ValueError(f"Unknown prediction type {noise_scheduler.config.prediction_type}")
+                noisy_latents, target = add_noise_fn(latents, noise, timesteps)
 
                 # Predict the noise residual and compute loss
-                model_pred = unet(noisy_latents, timesteps, encoder_hidden_states).sample
-
-                if args.snr_gamma is None:
-                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+                model_pred = unet_forward(noisy_latents, timesteps, encoder_hidden_states).sample
+                loss, sample_losses = compute_loss_fn(model_pred, target, timesteps, timestep_weights)
+                if args.timestep_sampling != "uniform":
+                    timestep_sampler.update(accelerator.gather(timesteps), accelerator.gather(sample_losses.detach()))
+
+                if args.exact_loss_logging:
+                    # Gather the losses across all processes for logging (if we use distributed training).
+                    avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
+                    train_loss += avg_loss.item() / args.gradient_accumulation_steps
                 else:
-                    # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
-                    # Since we predict the noise instead of x_0, the original formulation is slightly changed.
-                    # This is discussed in Section 4.2 of the same paper.
-                    snr = compute_snr(noise_scheduler, timesteps)
-                    if noise_scheduler.config.prediction_type == "v_prediction":
-                        # Velocity objective requires that we add one to SNR values before we divide by them.
-                        snr = snr + 1
-                    mse_loss_weights = (
-                        torch.stack([snr, args.snr_gamma * torch.ones_like(timesteps)], dim=1).min(dim=1)[0] / snr
-                    )
-
-                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
-                    loss = loss.mean(dim=list(range(1, len(loss.shape)))) * mse_loss_weights
-                    loss = loss.mean()
-
-                # Gather the losses across all processes for logging (if we use distributed training).
-                avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
-                train_loss += avg_loss.item() / args.gradient_accumulation_steps
+                    loss_logger.add(loss)
 
                 # Backpropagate
                 accelerator.backward(loss)
@@ -789,16 +1162,39 @@ def main():
             if accelerator.sync_gradients:
                 progress_bar.update(1)
                 global_step += 1
-                accelerator.log({"train_loss": train_loss}, step=global_step)
-                train_loss = 0.0
+                throughput.step()
+                if global_step % args.logging_steps == 0 and throughput.steps_per_second() is not None:
+                    accelerator.log({"train/steps_per_sec": throughput.steps_per_second()}, step=global_step)
+                if args.exact_loss_logging:
+                    accelerator.log({"train_loss": train_loss}, step=global_step)
+                    train_loss = 0.0
+                else:
+                    logged_loss = loss_logger.step(global_step)
+                    if logged_loss is not None:
+                        progress_bar.set_postfix(step_loss=logged_loss, lr=lr_scheduler.get_last_lr()[0])
 
-                if global_step % args.checkpointing_steps == 0:
+                if global_step % args.checkpointing_steps == 0 and train_sampler is not None:
+                    # Samples consumed in this epoch by all processes, including the ones skipped when resuming
+                    train_sampler.set_position((step + 1) * args.train_batch_size * accelerator.num_processes)
+
+                if global_step % args.checkpointing_steps == 0 and checkpoint_writer is not None:
+                    if accelerator.is_main_process:
+                        save_optimizer = not args.checkpoint_lora_only or (
+                            args.optimizer_checkpointing_steps is not None
+                            and global_step % args.optimizer_checkpointing_steps == 0
+                        )
+                        checkpoint_writer.save(
+                            global_step,
+                            accelerator.unwrap_model(lora_layers).state_dict(),
+                            optimizer_state_dict=optimizer.state_dict() if save_optimizer else None,
+                            lr_scheduler_state_dict=lr_scheduler.state_dict(),
+                            extra_state=extra_checkpoint_state(),
+                        )
+                elif global_step % args.checkpointing_steps == 0:
                     if accelerator.is_main_process:
                         # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
                         if args.checkpoints_total_limit is not None:
-                            checkpoints = os.listdir(args.output_dir)
-                            checkpoints = [d for d in checkpoints if d.startswith("checkpoint")]
-                            checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
+                            checkpoints = list_checkpoints(args.output_dir)
 
                             # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
                             if len(checkpoints) >= args.checkpoints_total_limit:
@@ -816,39 +1212,45 @@ def main():
 
                         save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
                         accelerator.save_state(save_path)
+                        save_extra_state(save_path, extra_checkpoint_state())
                         logger.info(f"Saved state to {save_path}")
 
-            logs = {"step_loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
-            progress_bar.set_postfix(**logs)
+            if args.exact_loss_logging:
+                logs = {"step_loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
+                progress_bar.set_postfix(**logs)
 
             if global_step >= args.max_train_steps:
                 break
 
         if accelerator.is_main_process:
-            if args.validation_prompt is not None and epoch % args.validation_epochs == 0:
+            if validation_prompts and epoch % args.validation_epochs == 0:
                 logger.info(
-                    f"Running validation... \n Generating {args.num_validation_images} images with prompt:"
-                    f" {args.validation_prompt}."
-                )
-                # create pipeline
-                pipeline = DiffusionPipeline.from_pretrained(
-                    args.pretrained_model_name_or_path,
-                    unet=accelerator.unwrap_model(unet),
-                    revision=args.revision,
-                    torch_dtype=weight_dtype,
+                    f"Running validation... \n Generating {args.num_validation_images} images with prompts:"
+                    f" {', '.join(validation_prompts)}."
                 )
-                pipeline = pipeline.to(accelerator.device)
-                pipeline.set_progress_bar_config(disable=True)
+                # create the pipeline once, from the modules already in memory
+                if validation_engine is None:
+                    validation_engine = build_validation_engine()
+                if args.validation_metrics and validation_metrics is None:
+                    validation_metrics = ValidationMetrics(
+                        args.validation_metrics,
+                        accelerator.device,
+                        reference_stats_path=args.validation_reference_stats
+                        or os.path.join(args.output_dir, "reference_stats.npz"),
+                    )
+                    if reference_dataset is not None:
+                        validation_metrics.prepare_reference(example[image_column] for example in reference_dataset)
 
                 # run inference
-                generator = torch.Generator(device=accelerator.device)
-                if args.seed is not None:
-                    generator = generator.manual_seed(args.seed)
-                images = []
-                for _ in range(args.num_validation_images):
-                    images.append(
-                        pipeline(args.validation_prompt, num_inference_steps=30, generator=generator).images[0]
-                    )
+                images = validation_engine.generate(
+                    validation_prompts, args.num_validation_images, args.validation_max_batch_size
+                )
+                image_prompts = [prompt for prompt in validation_prompts for _ in range(args.num_validation_images)]
+
+                if validation_metrics is not None:
+                    metrics = validation_metrics(images, image_prompts)
+                    logger.info(f"Validation metrics: {metrics}")
+                    accelerator.log({f"validation/{k}": v for k, v in metrics.items()}, step=global_step)
 
                 for tracker in accelerator.trackers:
                     if tracker.name == "tensorboard":
@@ -858,15 +1260,28 @@ def main():
                         tracker.log(
                             {
                                 "validation": [
-                                    wandb.Image(image, caption=f"{i}: {args.validation_prompt}")
-                                    for i, image in enumerate(images)
+                                    wandb.Image(image, caption=f"{i}: {prompt}")
+                                    for i, (image, prompt) in enumerate(zip(images, image_prompts))
                                 ]
                             }
                         )
 
-                del pipeline
                 torch.cuda.empty_cache()
 
+    # Log the losses of the last steps
+    if not args.exact_loss_logging:
+        loss_logger.flush()
+
+    if throughput.steps_per_second() is not None:
+        logger.info(
+            f"Throughput: {throughput.steps_per_second():.3f} steps/sec over {throughput.num_steps} steps"
+            f" ({'compiled' if args.compile else 'eager'}, excluding {args.throughput_warmup_steps} warm-up steps)"
+        )
+
+    # Finish writing the pending checkpoints
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+
     # Save the lora layers
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
@@ -881,6 +1296,8 @@ def main():
                 dataset_name=args.dataset_name,
                 repo_folder=args.output_dir,
             )
+            from huggingface_hub import upload_folder
+
             upload_folder(
                 repo_id=repo_id,
                 folder_path=args.output_dir,
@@ -889,22 +1306,17 @@ def main():
             )
 
     # Final inference
-    # Load previous pipeline
-    pipeline = DiffusionPipeline.from_pretrained(
-        args.pretrained_model_name_or_path, revision=args.revision, torch_dtype=weight_dtype
-    )
-    pipeline = pipeline.to(accelerator.device)
-
-    # load attention processors
-    pipeline.unet.load_attn_procs(args.output_dir)
-
-    # run inference
-    generator = torch.Generator(device=accelerator.device)
-    if args.seed is not None:
-        generator = generator.manual_seed(args.seed)
+    # Reuse the validation pipeline, with the trained weights cast back like a pipeline loaded with `weight_dtype`
     images = []
-    for _ in range(args.num_validation_images):
-        images.append(pipeline(args.validation_prompt, num_inference_steps=30, generator=generator).images[0])
+    if accelerator.is_main_process and validation_prompts:
+        unet.to(dtype=weight_dtype)
+        # No periodic validation may have run, e.g. with `--validation_epochs` larger than the number of epochs
+        if validation_engine is None:
+            validation_engine = build_validation_engine()
+        images = validation_engine.generate(
+            validation_prompts, args.num_validation_images, args.validation_max_batch_size
+        )
+        image_prompts = [prompt for prompt in validation_prompts for _ in range(args.num_validation_images)]
 
     if accelerator.is_main_process:
         for tracker in accelerator.trackers:
@@ -916,8 +1328,8 @@ def main():
                     tracker.log(
                         {
                             "test": [
-                                wandb.Image(image, caption=f"{i}: {args.validation_prompt}")
-                                for i, image in enumerate(images)
+                                wandb.Image(image, caption=f"{i}: {prompt}")
+                                for i, (image, prompt) in enumerate(zip(images, image_prompts))
                             ]
                         }
                     )
@@ -926,4 +1338,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
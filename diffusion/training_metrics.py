@@ -0,0 +1,123 @@
+"""
+This module defines a DeferredLossLogger class that accumulates the training loss on the device and only
+synchronizes with the host and the other processes every few optimization steps, and a ThroughputMeter class that
+measures optimization steps per second.
+"""
+
+import time
+from typing import Optional
+
+import torch
+
+
+class DeferredLossLogger:
+    """
+    Running sums of the training loss kept on the device, reduced across processes at a logging interval.
+
+    Every optimization step gets its own slot in a device buffer, so the values logged to the trackers are the same
+    per-step averages as with an immediate `accelerator.gather(...).mean().item()`, only logged in bursts.
+
+    Attributes:
+        accelerator: The Accelerator used for training.
+        logging_steps: The number of optimization steps between two reductions.
+        gradient_accumulation_steps: The number of micro-steps per optimization step.
+    """
+
+    def __init__(self, accelerator, logging_steps: int, gradient_accumulation_steps: int = 1):
+        """
+        Initialize the logger with an empty buffer.
+
+        Args:
+            accelerator: The Accelerator used for training.
+            logging_steps: The number of optimization steps between two reductions.
+            gradient_accumulation_steps: The number of micro-steps per optimization step.
+        """
+        self.accelerator = accelerator
+        self.logging_steps = logging_steps
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.buffer = torch.zeros(logging_steps, device=accelerator.device)
+        self.global_steps = []
+
+    def add(self, loss: torch.Tensor):
+        """
+        Add the loss of a micro-step to the current optimization step, without synchronizing.
+
+        Args:
+            loss: The (scalar) loss of the micro-step on this process.
+        """
+        self.buffer[len(self.global_steps)] += loss.detach().float() / self.gradient_accumulation_steps
+
+    def step(self, global_step: int) -> Optional[float]:
+        """
+        Close the current optimization step, and log the buffered steps if the logging interval is reached.
+
+        Args:
+            global_step: The optimization step that was just completed.
+
+        Returns:
+            Optional[float]: The loss of the last logged step, or None if nothing was logged.
+        """
+        self.global_steps.append(global_step)
+        if len(self.global_steps) < self.logging_steps:
+            return None
+        return self.flush()
+
+    def flush(self) -> Optional[float]:
+        """
+        Reduce the buffered losses across processes and log them at their own global step.
+
+        Returns:
+            Optional[float]: The loss of the last logged step, or None if the buffer was empty.
+        """
+        if not self.global_steps:
+            return None
+        n = len(self.global_steps)
+        losses = self.accelerator.reduce(self.buffer[:n], reduction="mean").tolist()
+        for global_step, loss in zip(self.global_steps, losses):
+            self.accelerator.log({"train_loss": loss}, step=global_step)
+        self.buffer.zero_()
+        self.global_steps = []
+        return losses[-1]
+
+
+class ThroughputMeter:
+    """
+    Optimization steps per second, excluding the first steps, which include compilation and allocator warm-up.
+
+    Attributes:
+        warmup_steps: The number of first steps excluded from the measure.
+        num_steps: The number of steps measured so far.
+    """
+
+    def __init__(self, warmup_steps: int = 0):
+        """
+        Initialize the meter. Without warm-up, the measure starts now.
+
+        Args:
+            warmup_steps: The number of first steps excluded from the measure.
+        """
+        self.warmup_steps = warmup_steps
+        self.num_steps = 0
+        self._seen_steps = 0
+        self._start = time.perf_counter() if warmup_steps == 0 else None
+
+    def step(self):
+        """
+        Mark the end of an optimization step.
+        """
+        self._seen_steps += 1
+        if self._seen_steps == self.warmup_steps:
+            self._start = time.perf_counter()
+        elif self._seen_steps > self.warmup_steps:
+            self.num_steps += 1
+
+    def steps_per_second(self) -> Optional[float]:
+        """
+        Get the throughput. Pending device work is not waited for, which is negligible over many steps.
+
+        Returns:
+            Optional[float]: The measured steps per second, or None while warming up.
+        """
+        if not self.num_steps:
+            return None
+        return self.num_steps / (time.perf_counter() - self._start)
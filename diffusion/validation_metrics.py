@@ -0,0 +1,257 @@
+"""
+This module defines the image-quality metrics computed on validation images: CLIP score between the images and their
+prompts, and FID/KID between the images and a held-out sample of the training dataset.
+
+Inception features come from the torchvision InceptionV3 weights, so FID and KID values are comparable between
+training runs of this project, but not with values published with the reference TensorFlow implementation.
+"""
+
+import logging
+import os
+from typing import Iterable, Optional
+
+import numpy as np
+import torch
+from torchvision import transforms
+from torchvision.models import Inception_V3_Weights, inception_v3
+from transformers import CLIPModel, CLIPProcessor
+
+from options import VALIDATION_METRICS
+
+logger = logging.getLogger(__name__)
+
+
+def frechet_distance(mu1: np.ndarray, sigma1: np.ndarray, mu2: np.ndarray, sigma2: np.ndarray) -> float:
+    """
+    Compute the Fréchet distance between two Gaussians.
+
+    The trace of the square root of `sigma1 @ sigma2` is computed from the eigenvalues of the product, which avoids a
+    dependency on scipy and is stable for the rank-deficient covariances of small validation sets.
+
+    Args:
+        mu1: Mean of the first distribution.
+        sigma1: Covariance of the first distribution.
+        mu2: Mean of the second distribution.
+        sigma2: Covariance of the second distribution.
+
+    Returns:
+        float: The Fréchet distance.
+    """
+    eigenvalues = np.linalg.eigvals(sigma1 @ sigma2)
+    tr_covmean = np.sqrt(np.clip(eigenvalues.real, 0, None)).sum()
+    diff = mu1 - mu2
+    return float(diff @ diff + np.trace(sigma1) + np.trace(sigma2) - 2 * tr_covmean)
+
+
+def kernel_inception_distance(
+    features1: np.ndarray, features2: np.ndarray, num_subsets: int = 10, subset_size: int = 100, seed: int = 0
+) -> float:
+    """
+    Compute the Kernel Inception Distance, the unbiased MMD with a cubic polynomial kernel averaged over subsets.
+
+    Args:
+        features1: Inception features of the first set of images.
+        features2: Inception features of the second set of images.
+        num_subsets: The number of random subsets to average over.
+        subset_size: The size of the subsets, capped to the size of the smallest set.
+        seed: The seed used to draw the subsets.
+
+    Returns:
+        float: The Kernel Inception Distance, NaN if a set has fewer than 2 images.
+    """
+    rng = np.random.default_rng(seed)
+    m = min(subset_size, len(features1), len(features2))
+    if m < 2:
+        # The unbiased estimator needs pairs of distinct images of each set
+        logger.warning(f"KID needs at least 2 images per set, got {len(features1)} and {len(features2)}")
+        return float("nan")
+    dim = features1.shape[1]
+    mmds = []
+    for _ in range(num_subsets):
+        x = features1[rng.choice(len(features1), m, replace=False)]
+        y = features2[rng.choice(len(features2), m, replace=False)]
+        k_xx = (x @ x.T / dim + 1) ** 3
+        k_yy = (y @ y.T / dim + 1) ** 3
+        k_xy = (x @ y.T / dim + 1) ** 3
+        mmd = (k_xx.sum() - np.trace(k_xx) + k_yy.sum() - np.trace(k_yy)) / (m * (m - 1)) - 2 * k_xy.mean()
+        mmds.append(mmd)
+    return float(np.mean(mmds))
+
+
+class InceptionFeatureExtractor:
+    """
+    Extract the 2048-dimensional pool features of InceptionV3 from PIL images.
+    """
+
+    def __init__(self, device: torch.device):
+        """
+        Initialize the extractor.
+
+        Args:
+            device: The device to run InceptionV3 on.
+        """
+        self.device = device
+        self.model = inception_v3(weights=Inception_V3_Weights.DEFAULT, aux_logits=True)
+        self.model.fc = torch.nn.Identity()
+        self.model.eval().requires_grad_(False).to(device)
+        self.transform = transforms.Compose(
+            [
+                transforms.Resize((299, 299), interpolation=transforms.InterpolationMode.BILINEAR),
+                transforms.ToTensor(),
+                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+            ]
+        )
+
+    @torch.no_grad()
+    def __call__(self, images: Iterable, batch_size: int = 32) -> np.ndarray:
+        """
+        Extract features.
+
+        Args:
+            images: The PIL images.
+            batch_size: The number of images per forward pass.
+
+        Returns:
+            np.ndarray: The features, one row per image.
+        """
+        features = []
+        batch = []
+        for image in images:
+            batch.append(self.transform(image.convert("RGB")))
+            if len(batch) == batch_size:
+                features.append(self.model(torch.stack(batch).to(self.device)).double().cpu().numpy())
+                batch = []
+        if batch:
+            features.append(self.model(torch.stack(batch).to(self.device)).double().cpu().numpy())
+        return np.concatenate(features)
+
+
+class ClipScorer:
+    """
+    Compute the CLIP score, 100 times the cosine similarity between image and prompt embeddings, floored at 0.
+    """
+
+    def __init__(self, device: torch.device, model_name: str = "openai/clip-vit-base-patch32"):
+        """
+        Initialize the scorer.
+
+        Args:
+            device: The device to run CLIP on.
+            model_name: The CLIP model identifier from huggingface.co/models.
+        """
+        self.device = device
+        self.model = CLIPModel.from_pretrained(model_name).eval().requires_grad_(False).to(device)
+        self.processor = CLIPProcessor.from_pretrained(model_name)
+
+    @torch.no_grad()
+    def __call__(self, images: list, prompts: list) -> float:
+        """
+        Compute the mean CLIP score of images and their prompts.
+
+        Args:
+            images: The PIL images.
+            prompts: The prompt of each image.
+
+        Returns:
+            float: The mean CLIP score.
+        """
+        inputs = self.processor(text=prompts, images=images, return_tensors="pt", padding=True, truncation=True)
+        outputs = self.model(**inputs.to(self.device))
+        image_embeds = torch.nn.functional.normalize(outputs.image_embeds, dim=-1)
+        text_embeds = torch.nn.functional.normalize(outputs.text_embeds, dim=-1)
+        scores = 100 * (image_embeds * text_embeds).sum(dim=-1).clamp(min=0)
+        return scores.mean().item()
+
+
+class ValidationMetrics:
+    """
+    Compute the requested metrics on a set of validation images.
+
+    The Inception features of the reference images are computed once and stored in `reference_stats_path`, so
+    that later validations and later runs on the same held-out sample skip them.
+
+    Attributes:
+        metrics: The names of the metrics to compute, among VALIDATION_METRICS.
+        reference_stats_path: The .npz file holding the reference Inception features and statistics.
+    """
+
+    def __init__(self, metrics: list, device: torch.device, reference_stats_path: Optional[str] = None):
+        """
+        Initialize the metrics and load their models.
+
+        Args:
+            metrics: The names of the metrics to compute, among VALIDATION_METRICS.
+            device: The device to run the metric models on.
+            reference_stats_path: The .npz file holding the reference statistics. Required for FID and KID.
+        """
+        unknown_metrics = set(metrics) - set(VALIDATION_METRICS)
+        if unknown_metrics:
+            raise ValueError(f"Unknown validation metrics {unknown_metrics}, choose between {VALIDATION_METRICS}")
+        self.metrics = metrics
+        self.reference_stats_path = reference_stats_path
+        self.needs_reference = "fid" in metrics or "kid" in metrics
+        if self.needs_reference and reference_stats_path is None:
+            raise ValueError("FID and KID need a path to store the reference statistics")
+
+        self.clip_scorer = ClipScorer(device) if "clip_score" in metrics else None
+        self.inception = InceptionFeatureExtractor(device) if self.needs_reference else None
+        self.reference = None
+
+    def has_reference(self) -> bool:
+        """
+        Tell whether reference statistics are already available on disk.
+
+        Returns:
+            bool: True if the reference statistics file exists.
+        """
+        return self.reference_stats_path is not None and os.path.isfile(self.reference_stats_path)
+
+    def prepare_reference(self, images: Optional[Iterable] = None):
+        """
+        Load the reference statistics, computing them from `images` if they are not on disk yet.
+
+        Args:
+            images: The reference PIL images, only read if the statistics are not on disk.
+        """
+        if not self.needs_reference or self.reference is not None:
+            return
+        if not self.has_reference():
+            if images is None:
+                raise ValueError(f"{self.reference_stats_path} does not exist and no reference images were given")
+            features = self.inception(images)
+            np.savez(
+                self.reference_stats_path,
+                features=features,
+                mu=features.mean(axis=0),
+                sigma=np.cov(features, rowvar=False),
+            )
+        with np.load(self.reference_stats_path) as reference:
+            self.reference = {key: reference[key] for key in reference.files}
+
+    def __call__(self, images: list, prompts: list) -> dict:
+        """
+        Compute the metrics.
+
+        Args:
+            images: The generated PIL images.
+            prompts: The prompt of each image.
+
+        Returns:
+            dict: The value of each metric.
+        """
+        results = {}
+        if self.clip_scorer is not None:
+            results["clip_score"] = self.clip_scorer(images, prompts)
+        if self.needs_reference:
+            self.prepare_reference()
+            features = self.inception(images)
+            if "fid" in self.metrics:
+                results["fid"] = frechet_distance(
+                    features.mean(axis=0),
+                    np.cov(features, rowvar=False),
+                    self.reference["mu"],
+                    self.reference["sigma"],
+                )
+            if "kid" in self.metrics:
+                results["kid"] = kernel_inception_distance(features, self.reference["features"])
+        return results
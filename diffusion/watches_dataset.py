@@ -1,12 +1,96 @@
 """
 This module defines a WatchesDataset class that loads data from a MongoDB collection,
 prepares it for use with the Hugging Face 'datasets' library, and saves the resulting dataset to disk.
+
+pymongo, datasets and the streaming dataset module (torch) are only imported when the dataset is built, so that the
+captions helpers and the command line interface load instantly.
 """
 
-import pymongo
-from datasets import Dataset, Image
+import argparse
+import json
+import os
 from os import path
 
+from options import DEDUP_MODES, SHARD_FORMATS
+
+# Fields to ignore during dataset creation
+FIELDS_TO_IGNORE = ["_id", "url", "image_urls", "image_paths", "thumb_paths", "sku"]
+
+
+def format_caption(watch: dict, fields_to_ignore: list = FIELDS_TO_IGNORE) -> str:
+    """
+    Create the text description of a watch, as used for training and inference prompts.
+
+    Parameters:
+        watch: The watch document from the MongoDB collection.
+        fields_to_ignore: Fields of the document that are not part of the description.
+
+    Returns:
+        The description, as comma-separated key:value pairs. The sub-documents of the typed schema are flattened: the
+        'functions' booleans are listed by name when true, and the overflow 'specs' are key:value pairs.
+    """
+    pairs = []
+    for key, value in watch.items():
+        if key in fields_to_ignore:
+            continue
+        if isinstance(value, dict):
+            pairs.extend(
+                sub_key if sub_value is True else f"{sub_key}:{sub_value}"
+                for sub_key, sub_value in value.items()
+                if sub_value is not False
+            )
+        else:
+            pairs.append(f"{key}:{value}")
+    return ",".join(pairs)
+
+
+def aggregation_pipeline(query: dict = None, fields_to_ignore: list = FIELDS_TO_IGNORE) -> list:
+    """
+    Build the aggregation pipeline returning one row per image, with only the fields of the caption.
+
+    Parameters:
+        query: The filter of the watches. All the watches by default.
+        fields_to_ignore: Fields of the documents that are not part of the caption.
+
+    Returns:
+        The pipeline stages.
+    """
+    # `_id` is kept to format the caption once per watch, `image_paths` becomes a single path per row
+    projection = {field: 0 for field in fields_to_ignore if field not in ["_id", "image_paths"]}
+    stages = [{"$match": query}] if query else []
+    return stages + [{"$project": projection}, {"$unwind": "$image_paths"}]
+
+
+def iter_watch_images(collection, query: dict = None, aggregate: bool = False, batch_size: int = 1000):
+    """
+    Iterate over the images of the watches of a MongoDB collection, with their caption.
+
+    Parameters:
+        collection: The pymongo collection.
+        query: The filter of the watches, e.g. an `_id` range. All the watches by default.
+        aggregate: Whether to project and unwind the documents on the server, with an aggregation pipeline, so that
+            the ignored fields do not cross the wire.
+        batch_size: The number of documents (or rows) per cursor batch.
+
+    Yields:
+        (image path relative to the image directory, caption) tuples.
+    """
+    if aggregate:
+        rows = collection.aggregate(aggregation_pipeline(query), allowDiskUse=True, batchSize=batch_size)
+        watch_id, caption = None, None
+        for row in rows:
+            # The rows of a watch are consecutive
+            if row["_id"] != watch_id:
+                watch_id, caption = row["_id"], format_caption(row)
+            yield row["image_paths"], caption
+        return
+
+    for watch in collection.find(query or {}, batch_size=batch_size):
+        # Create text description for the watch
+        caption = format_caption(watch)
+        for img in watch["image_paths"]:
+            yield img, caption
+
 
 class WatchesDataset:
     def __init__(
@@ -16,9 +100,13 @@ class WatchesDataset:
         mongo_db: str,
         mongo_collection: str,
         image_dir: str,
+        aggregate: bool = False,
+        batch_size: int = 1000,
+        quality_filter=None,
+        rebalancer=None,
     ) -> None:
         """
-        Initialize the WatchesDataset object.
+        Initialize the WatchesDataset object. MongoDB is only queried when the dataset is first used.
 
         Parameters:
         - mongo_uri: MongoDB URI.
@@ -26,40 +114,57 @@ class WatchesDataset:
         - mongo_db: MongoDB database name.
         - mongo_collection: MongoDB collection name.
         - image_dir: Directory path containing images.
+        - aggregate: Whether to project and unwind the documents on the server, see `iter_watch_images`.
+        - batch_size: Number of documents (or rows) per cursor batch.
+        - quality_filter: An `image_filter.ImageQualityFilter` excluding the images below its thresholds, if any.
+        - rebalancer: A `dedup.NearDuplicateRebalancer` capping or down-weighting the near-duplicates, if any.
         """
-        self.client = pymongo.MongoClient(mongo_uri, mongo_port)
-        self.db = self.client[mongo_db]
-        self.collection = self.db[mongo_collection]
+        self.mongo_uri = mongo_uri
+        self.mongo_port = mongo_port
+        self.mongo_db = mongo_db
+        self.mongo_collection = mongo_collection
         self.image_dir = image_dir
-        self.ds = Dataset.from_dict(self.load()).cast_column("image", Image())
-        self.client.close()
+        self.aggregate = aggregate
+        self.batch_size = batch_size
+        self.quality_filter = quality_filter
+        self.rebalancer = rebalancer
+        self._ds = None
+
+    @property
+    def ds(self):
+        """
+        The Hugging Face dataset, built from MongoDB on first access.
+        """
+        if self._ds is None:
+            from datasets import Dataset, Image
+
+            self._ds = Dataset.from_dict(self.load()).cast_column("image", Image())
+        return self._ds
 
     def load(self) -> dict:
         """
         Load data from MongoDB collection and prepare it for the dataset.
 
         Returns:
-            Dictionary containing "image" and "text" fields.
+            Dictionary containing "image" and "text" fields, and a "weight" field if near-duplicates are down-weighted.
         """
+        import pymongo
+
         images = []
         texts = []
 
-        # Fields to ignore during dataset creation
-        fields_to_ignore = ["_id", "image_urls", "image_paths", "thumb_paths", "sku"]
-
-        for watch in self.collection.find({}):
-            for img in watch["image_paths"]:
+        with pymongo.MongoClient(self.mongo_uri, self.mongo_port) as client:
+            collection = client[self.mongo_db][self.mongo_collection]
+            for img, caption in iter_watch_images(collection, aggregate=self.aggregate, batch_size=self.batch_size):
                 images.append(path.join(self.image_dir, img))
-                # Create text description for the watch
-                texts.append(
-                    ",".join(
-                        [
-                            f"{key}:{value}"
-                            for key, value in watch.items()
-                            if key not in fields_to_ignore
-                        ]
-                    )
-                )
+                texts.append(caption)
+
+        if self.quality_filter is not None:
+            keep = self.quality_filter.filter(images)
+            images = [image for image, kept in zip(images, keep) if kept]
+            texts = [text for text, kept in zip(texts, keep) if kept]
+        if self.rebalancer is not None:
+            return self.rebalancer.apply(images, texts)
         return {"image": images, "text": texts}
 
     def save(self, path: str) -> None:
@@ -71,13 +176,161 @@ class WatchesDataset:
         """
         self.ds.save_to_disk(path)
 
+    def save_shards(self, path: str, samples_per_shard: int = 1000, shard_format: str = "parquet") -> None:
+        """
+        Save the dataset to disk as shards, for the streaming mode of the training script (`--train_shards`).
+
+        Parameters:
+            path: Path to save the shards and their manifest.
+            samples_per_shard: Number of samples per shard.
+            shard_format: 'parquet' or 'tar' (webdataset layout).
+        """
+        from datasets import Image
+
+        from streaming_dataset import write_shards
+
+        def samples():
+            for row in self.ds.cast_column("image", Image(decode=False)):
+                image_bytes = row["image"]["bytes"]
+                if image_bytes is None:
+                    with open(row["image"]["path"], "rb") as f:
+                        image_bytes = f.read()
+                yield image_bytes, row["text"]
+
+        write_shards(samples(), path, samples_per_shard=samples_per_shard, shard_format=shard_format)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the watches dataset from the scraped MongoDB collection.")
+    parser.add_argument("--mongo_uri", type=str, default="localhost", help="MongoDB URI.")
+    parser.add_argument("--mongo_port", type=int, default=27017, help="MongoDB port.")
+    parser.add_argument("--mongo_db", type=str, default="watch_scraping", help="MongoDB database name.")
+    parser.add_argument("--mongo_collection", type=str, default="watches", help="MongoDB collection name.")
+    parser.add_argument("--image_dir", type=str, default="images", help="Directory of the downloaded images.")
+    parser.add_argument("--output_dir", type=str, default="datasets/watches_dataset", help="Output directory.")
+    parser.add_argument(
+        "--shard_format",
+        type=str,
+        default=None,
+        choices=SHARD_FORMATS,
+        help="Save shards for the streaming mode of the training script instead of a Hugging Face dataset.",
+    )
+    parser.add_argument("--samples_per_shard", type=int, default=1000, help="Number of samples per shard.")
+    parser.add_argument(
+        "--aggregate",
+        action="store_true",
+        help="Project and unwind the documents on the server (one row per image), with an aggregation pipeline.",
+    )
+    parser.add_argument("--cursor_batch_size", type=int, default=1000, help="Number of rows per cursor batch.")
+    parser.add_argument(
+        "--filter_images",
+        action="store_true",
+        help="Exclude the corrupted, small, blank or letterboxed, and blurry images, see `image_filter.py`.",
+    )
+    parser.add_argument("--min_image_size", type=int, default=256, help="Minimum smallest side of an image.")
+    parser.add_argument(
+        "--max_background_ratio", type=float, default=0.97, help="Maximum fraction of background pixels of an image."
+    )
+    parser.add_argument(
+        "--min_sharpness", type=float, default=20.0, help="Minimum variance of the Laplacian of the image foreground."
+    )
+    parser.add_argument(
+        "--quality_cache",
+        type=str,
+        default="image_quality.sqlite",
+        help="SQLite cache of the image scores, by image hash, so that reruns do not score the images again.",
+    )
+    parser.add_argument(
+        "--filter_workers", type=int, default=None, help="Number of image scoring and hashing processes."
+    )
+    parser.add_argument(
+        "--filter_report", type=str, default=None, help="JSON file to write the number of dropped images by reason to."
+    )
+    parser.add_argument(
+        "--dedup",
+        type=str,
+        default=None,
+        choices=DEDUP_MODES,
+        help=(
+            "Cap the clusters of near-duplicate samples to --max_per_cluster samples, or keep them with a 'weight'"
+            " column so that the training script draws about --max_per_cluster samples per cluster and epoch."
+        ),
+    )
+    parser.add_argument(
+        "--max_per_cluster", type=int, default=2, help="Number of samples per cluster of near-duplicates."
+    )
+    parser.add_argument(
+        "--dedup_threshold",
+        type=float,
+        default=0.8,
+        help="Minimum Jaccard similarity of the caption tokens of near-duplicates.",
+    )
+    parser.add_argument(
+        "--dedup_max_hamming",
+        type=int,
+        default=7,
+        help="Maximum Hamming distance of the 64-bit image difference hashes of near-duplicates.",
+    )
+    parser.add_argument(
+        "--dry_run", action="store_true", help="Check the configuration and exit, without connecting to MongoDB."
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.dedup == "weight" and args.shard_format is not None:
+        raise ValueError("The streaming mode does not use sample weights, use --dedup cap with --shard_format.")
+    if args.dry_run:
+        if not os.path.isdir(args.image_dir):
+            raise ValueError(f"The image directory {args.image_dir} does not exist")
+        print(f"The configuration is valid: {vars(args)}")
+        return
+
+    quality_filter = None
+    if args.filter_images:
+        from image_filter import ImageQualityFilter
+
+        quality_filter = ImageQualityFilter(
+            args.quality_cache,
+            min_size=args.min_image_size,
+            max_background_ratio=args.max_background_ratio,
+            min_sharpness=args.min_sharpness,
+            num_workers=args.filter_workers,
+        )
+
+    rebalancer = None
+    if args.dedup is not None:
+        from dedup import NearDuplicateRebalancer
+
+        rebalancer = NearDuplicateRebalancer(
+            mode=args.dedup,
+            max_per_cluster=args.max_per_cluster,
+            threshold=args.dedup_threshold,
+            max_hamming=args.dedup_max_hamming,
+            num_workers=args.filter_workers,
+        )
 
-if __name__ == "__main__":
     d = WatchesDataset(
-        mongo_uri="localhost",
-        mongo_port=27017,
-        mongo_db="watch_scraping",
-        mongo_collection="watches",
-        image_dir="images",
+        mongo_uri=args.mongo_uri,
+        mongo_port=args.mongo_port,
+        mongo_db=args.mongo_db,
+        mongo_collection=args.mongo_collection,
+        image_dir=args.image_dir,
+        aggregate=args.aggregate,
+        batch_size=args.cursor_batch_size,
+        quality_filter=quality_filter,
+        rebalancer=rebalancer,
     )
-    d.save("datasets/watches_dataset")
+    if args.shard_format is not None:
+        d.save_shards(args.output_dir, samples_per_shard=args.samples_per_shard, shard_format=args.shard_format)
+    else:
+        d.save(args.output_dir)
+
+    if quality_filter is not None and args.filter_report is not None:
+        with open(args.filter_report, "w") as f:
+            json.dump(dict(quality_filter.report), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
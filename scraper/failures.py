@@ -0,0 +1,178 @@
+"""
+This module defines the persistent store of the failed requests of a crawl, so that a crawl can be finished by
+replaying only them (`scrapy crawl chronext -a retry_failed=1`), instead of the whole catalogue.
+
+A request is stored when its download fails after the retries of Scrapy (timeout, DNS error, 5xx response, ...), or
+when its callback raises (e.g. a product page whose layout changed), with the reason, the status and a compressed
+snapshot of the response. It is removed as soon as it gets a successful response, and stored again if its callback
+fails again.
+"""
+
+import sqlite3
+import time
+import zlib
+from typing import Iterator, Optional
+
+import scrapy
+from scrapy import signals
+from scrapy.spidermiddlewares.httperror import HttpError
+
+# Signal sent by the errbacks of the spiders, with `failure` and `spider` arguments
+request_failed = object()
+
+# Maximum number of bytes of the response bodies kept in the snapshots
+SNAPSHOT_BYTES = 64 * 1024
+
+
+class FailureStore:
+    """
+    SQLite store of the failed requests, by URL.
+
+    Attributes:
+        path: The SQLite database file.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open the store, created if missing.
+
+        Args:
+            path: The SQLite database file.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS failures ("
+            "url TEXT PRIMARY KEY, method TEXT, callback TEXT, reason TEXT, status INTEGER, "
+            "snapshot BLOB, failed_at REAL, attempts INTEGER)"
+        )
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM failures").fetchone()[0]
+
+    def add(self, request: scrapy.Request, reason: str, response: Optional[scrapy.http.Response] = None):
+        """
+        Store a failed request, or update it if it already failed.
+
+        Args:
+            request: The request.
+            reason: The reason of the failure.
+            response: The response, if the request was downloaded.
+        """
+        callback = request.callback.__name__ if request.callback is not None else None
+        status = response.status if response is not None else None
+        snapshot = zlib.compress(response.body[:SNAPSHOT_BYTES]) if response is not None else None
+        self.connection.execute(
+            "INSERT INTO failures VALUES (?, ?, ?, ?, ?, ?, ?, 1) ON CONFLICT(url) DO UPDATE SET "
+            "reason = excluded.reason, status = excluded.status, snapshot = excluded.snapshot, "
+            "failed_at = excluded.failed_at, attempts = attempts + 1",
+            (request.url, request.method, callback, reason, status, snapshot, time.time()),
+        )
+        self.connection.commit()
+
+    def remove(self, url: str):
+        """
+        Remove a request that succeeded.
+
+        Args:
+            url: The URL of the request.
+        """
+        if self.connection.execute("DELETE FROM failures WHERE url = ?", (url,)).rowcount:
+            self.connection.commit()
+
+    def entries(self) -> Iterator[dict]:
+        """
+        Iterate over the stored requests, oldest failure first.
+
+        Yields:
+            dict: The url, method, callback name, reason, status, failed_at and attempts of a request.
+        """
+        rows = self.connection.execute(
+            "SELECT url, method, callback, reason, status, failed_at, attempts FROM failures ORDER BY failed_at"
+        )
+        for url, method, callback, reason, status, failed_at, attempts in rows.fetchall():
+            yield {
+                "url": url,
+                "method": method,
+                "callback": callback,
+                "reason": reason,
+                "status": status,
+                "failed_at": failed_at,
+                "attempts": attempts,
+            }
+
+    def snapshot(self, url: str) -> Optional[bytes]:
+        """
+        Get the response snapshot of a stored request.
+
+        Args:
+            url: The URL of the request.
+
+        Returns:
+            Optional[bytes]: The beginning of the response body, or None if the request was not downloaded.
+        """
+        row = self.connection.execute("SELECT snapshot FROM failures WHERE url = ?", (url,)).fetchone()
+        return zlib.decompress(row[0]) if row is not None and row[0] is not None else None
+
+    def close(self):
+        self.connection.close()
+
+
+class FailedRequestsExtension:
+    """
+    Scrapy extension storing the failed requests and the callback errors of the spiders in a FailureStore.
+
+    Download failures are reported by the errbacks of the spiders through the `request_failed` signal, callback errors
+    by the `spider_error` signal of Scrapy.
+    """
+
+    def __init__(self, store: FailureStore, stats):
+        """
+        Initialize the extension.
+
+        Args:
+            store: The store of the failed requests.
+            stats: The stats collector of the crawler.
+        """
+        self.store = store
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler: scrapy.crawler.Crawler):
+        """
+        Create an extension instance with settings from the Scrapy crawler.
+
+        If not set in the settings, the store of the failed requests, FAILED_REQUESTS_DB, is 'failed_requests.sqlite'.
+
+        Args:
+            crawler: The Scrapy crawler instance.
+
+        Returns:
+            FailedRequestsExtension: An instance of the extension, connected to the signals.
+        """
+        extension = cls(
+            FailureStore(crawler.settings.get("FAILED_REQUESTS_DB", "failed_requests.sqlite")), crawler.stats
+        )
+        crawler.signals.connect(extension.request_failed, signal=request_failed)
+        crawler.signals.connect(extension.spider_error, signal=signals.spider_error)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def request_failed(self, failure, spider: scrapy.Spider):
+        response = failure.value.response if failure.check(HttpError) else None
+        self.store.add(failure.request, f"{failure.type.__name__}: {failure.value}", response)
+        self.stats.inc_value("failed_requests/download", spider=spider)
+
+    def spider_error(self, failure, response: scrapy.http.Response, spider: scrapy.Spider):
+        self.store.add(response.request, f"{failure.type.__name__}: {failure.value}", response)
+        self.stats.inc_value("failed_requests/callback", spider=spider)
+
+    def response_received(self, response: scrapy.http.Response, request: scrapy.Request, spider: scrapy.Spider):
+        # Fired before the callback, which stores the request again if it fails
+        if 200 <= response.status < 300:
+            self.store.remove(request.url)
+
+    def spider_closed(self, spider: scrapy.Spider):
+        self.stats.set_value("failed_requests/stored", len(self.store), spider=spider)
+        self.store.close()
@@ -0,0 +1,50 @@
+"""
+This module defines an HTTP/2 connection pool that reports the connection events of the image requests in the Scrapy
+stats. It requires the optional h2 package, and is only imported by the image download handler.
+"""
+
+from scrapy.core.http2.agent import H2ConnectionPool
+
+
+class CountingH2ConnectionPool(H2ConnectionPool):
+    """
+    HTTP/2 connection pool counting, by host, the connections established and lost, and the requests multiplexed over
+    a connection opened for earlier requests.
+
+    The following stats are reported:
+        images_h2/connections_opened/<host>: The connections established, including reconnections after a GOAWAY
+            frame or an idle close.
+        images_h2/connections_reused/<host>: The requests sent over a connection established, or being established,
+            for an earlier request.
+        images_h2/connections_lost/<host>: The connections closed, by either side.
+    """
+
+    def __init__(self, reactor, settings, stats):
+        """
+        Initialize the pool.
+
+        Args:
+            reactor: The Twisted reactor.
+            settings: The Scrapy settings.
+            stats: The stats collector of the crawler.
+        """
+        super().__init__(reactor, settings)
+        self.stats = stats
+
+    @staticmethod
+    def _host(key: tuple) -> str:
+        _, host, port = key
+        return f"{host.decode()}:{port}"
+
+    def get_connection(self, key: tuple, uri, endpoint):
+        if key in self._pending_requests or key in self._connections:
+            self.stats.inc_value(f"images_h2/connections_reused/{self._host(key)}")
+        return super().get_connection(key, uri, endpoint)
+
+    def put_connection(self, conn, key: tuple):
+        self.stats.inc_value(f"images_h2/connections_opened/{self._host(key)}")
+        return super().put_connection(conn, key)
+
+    def _remove_connection(self, errors: list, key: tuple):
+        self.stats.inc_value(f"images_h2/connections_lost/{self._host(key)}")
+        return super()._remove_connection(errors, key)
@@ -0,0 +1,130 @@
+"""
+This module defines the download handler of the image requests: the images of the watches are multiplexed over a small
+pool of persistent HTTP/2 connections to the image CDN, while the product pages keep Scrapy's HTTP/1.1 handler.
+
+Image requests are marked by `WatchImagesPipeline` with the 'image' meta key, and sent to the 'images' download slot,
+whose concurrency and delay are set by `DOWNLOAD_SLOTS`, separately from the pages of the website.
+"""
+
+import itertools
+import time
+
+import scrapy
+from scrapy import signals
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+from twisted.internet.defer import DeferredList, maybeDeferred
+
+# Meta keys of the image requests
+IMAGE_REQUEST_META = {"image": True, "download_slot": "images"}
+
+
+class ImageDownloadHandler:
+    """
+    Download handler sending image requests over HTTP/2 and the other requests over HTTP/1.1.
+
+    Each HTTP/2 handler of the pool keeps one connection per host, on which its requests are multiplexed. Requests are
+    distributed round-robin over the pool, so that a slow stream or a connection reset does not stall every image.
+
+    The following stats are reported:
+        images_h2/request_count, images_h2/response_bytes: The totals of the image requests.
+        images_h2/requests_per_second, images_h2/bytes_per_second: The throughput, between the first image request
+            and the end of the crawl.
+        images_h2/connections_opened/<host>, images_h2/connections_reused/<host>, images_h2/connections_lost/<host>:
+            The connection events of the HTTP/2 connection pools, see `h2_pool.CountingH2ConnectionPool`.
+
+    Attributes:
+        num_connections: The number of HTTP/2 handlers of the pool, i.e. the number of connections per host.
+    """
+
+    lazy = False
+
+    def __init__(self, crawler: scrapy.crawler.Crawler, num_connections: int = 2):
+        """
+        Initialize the HTTP/1.1 handler and the pool of HTTP/2 handlers.
+
+        Args:
+            crawler: The Scrapy crawler instance.
+            num_connections: The number of HTTP/2 handlers of the pool.
+        """
+        # Imported here as they require the optional h2 package
+        from scrapy.core.downloader.handlers.http2 import H2DownloadHandler
+        from twisted.internet import reactor
+
+        from .h2_pool import CountingH2ConnectionPool
+
+        self.stats = crawler.stats
+        self.num_connections = num_connections
+        self.http11 = HTTP11DownloadHandler.from_crawler(crawler)
+        self.h2_handlers = [H2DownloadHandler.from_crawler(crawler) for _ in range(num_connections)]
+        for handler in self.h2_handlers:
+            # The handler has no setting for its pool, which is replaced before any request
+            handler._pool = CountingH2ConnectionPool(reactor, crawler.settings, crawler.stats)
+        self._round_robin = itertools.cycle(self.h2_handlers)
+        self._start = None
+        self._bytes = 0
+        self._requests = 0
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler: scrapy.crawler.Crawler):
+        """
+        Create a handler with settings from the Scrapy crawler.
+
+        If not set in the settings, the number of HTTP/2 connections per image host, IMAGES_H2_CONNECTIONS, is 2.
+
+        Args:
+            crawler: The Scrapy crawler instance.
+
+        Returns:
+            ImageDownloadHandler: An instance of the handler.
+        """
+        return cls(crawler, num_connections=crawler.settings.getint("IMAGES_H2_CONNECTIONS", 2))
+
+    def download_request(self, request: scrapy.Request, spider: scrapy.Spider):
+        """
+        Download a request, over HTTP/2 if it is an image request.
+
+        Args:
+            request: The request.
+            spider: The Scrapy spider instance.
+
+        Returns:
+            Deferred: The deferred response.
+        """
+        if not request.meta.get("image"):
+            return self.http11.download_request(request, spider)
+
+        if self._start is None:
+            self._start = time.monotonic()
+        deferred = next(self._round_robin).download_request(request, spider)
+        deferred.addCallback(self._response_downloaded, spider)
+        return deferred
+
+    def _response_downloaded(self, response: scrapy.http.Response, spider: scrapy.Spider):
+        self._requests += 1
+        self._bytes += len(response.body)
+        self.stats.inc_value("images_h2/request_count", spider=spider)
+        self.stats.inc_value("images_h2/response_bytes", len(response.body), spider=spider)
+        return response
+
+    def spider_closed(self, spider: scrapy.Spider):
+        """
+        Report the throughput of the image requests.
+
+        Args:
+            spider: The Scrapy spider instance.
+        """
+        if self._start is None:
+            return
+        elapsed = max(time.monotonic() - self._start, 1e-6)
+        self.stats.set_value("images_h2/requests_per_second", round(self._requests / elapsed, 2), spider=spider)
+        self.stats.set_value("images_h2/bytes_per_second", round(self._bytes / elapsed), spider=spider)
+
+    def close(self):
+        """
+        Close the connections of every handler.
+
+        Returns:
+            Deferred: Fired when every handler is closed.
+        """
+        return DeferredList([maybeDeferred(handler.close) for handler in [self.http11, *self.h2_handlers]])
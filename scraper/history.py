@@ -0,0 +1,188 @@
+"""
+This module defines the price and availability history of the watches, stored in a MongoDB time-series collection.
+
+Only changes are stored: a measurement is written when the price of a product differs from its last recorded price,
+when it appears, and when it disappears from the website. Each measurement holds the crawl time, the product (its
+identifier and brand, the metadata of the time-series buckets) and its price, so that MongoDB compresses the
+history into columnar buckets per product.
+
+The helpers at the end load the history into pandas, with a projection on the measurement fields, and compute price
+deltas with vectorized operations.
+"""
+
+import datetime
+from typing import Optional
+
+import pymongo
+
+
+class PriceHistory:
+    """
+    Change-only price history of the products of a website.
+
+    Attributes:
+        collection: The time-series collection.
+        latest: The last recorded (available, price) state of every product, by product identifier. The price of an
+            available product may be None, when it is not displayed.
+        brands: The brand of every product, by product identifier.
+    """
+
+    def __init__(self, db: pymongo.database.Database, collection_name: str = "price_history"):
+        """
+        Create the time-series collection if needed, and load the last recorded price of every product.
+
+        Args:
+            db: The MongoDB database.
+            collection_name: The name of the time-series collection.
+        """
+        if collection_name not in db.list_collection_names():
+            db.create_collection(
+                collection_name, timeseries={"timeField": "ts", "metaField": "product", "granularity": "hours"}
+            )
+        self.collection = db[collection_name]
+        self.latest = {}
+        self.brands = {}
+        states = self.collection.aggregate(
+            [
+                {"$sort": {"product.id": 1, "ts": 1}},
+                {
+                    "$group": {
+                        "_id": "$product.id",
+                        "brand": {"$last": "$product.brand"},
+                        "price": {"$last": "$price"},
+                        "available": {"$last": "$available"},
+                    }
+                },
+            ],
+            allowDiskUse=True,
+        )
+        for state in states:
+            self.latest[state["_id"]] = (state["available"], state["price"] if state["available"] else None)
+            self.brands[state["_id"]] = state["brand"]
+
+    def record(self, ts: datetime.datetime, product_id: str, brand: Optional[str], price: Optional[float]) -> bool:
+        """
+        Record the price of an available product, if it changed.
+
+        Args:
+            ts: The time of the crawl.
+            product_id: The product identifier.
+            brand: The brand of the product.
+            price: The price of the product.
+
+        Returns:
+            bool: Whether a measurement was written.
+        """
+        if self.latest.get(product_id) == (True, price):
+            return False
+        self.collection.insert_one(
+            {"ts": ts, "product": {"id": product_id, "brand": brand}, "price": price, "available": True}
+        )
+        self.latest[product_id] = (True, price)
+        self.brands[product_id] = brand
+        return True
+
+    def mark_unavailable(self, ts: datetime.datetime, seen: set) -> int:
+        """
+        Record the disappearance of the available products that were not seen by a crawl.
+
+        Args:
+            ts: The time of the crawl.
+            seen: The identifiers of the products seen by the crawl.
+
+        Returns:
+            int: The number of products marked as unavailable.
+        """
+        gone = [
+            product_id for product_id, (available, _) in self.latest.items() if available and product_id not in seen
+        ]
+        if gone:
+            self.collection.insert_many(
+                [
+                    {"ts": ts, "product": {"id": product_id, "brand": self.brands.get(product_id)}, "available": False}
+                    for product_id in gone
+                ]
+            )
+        for product_id in gone:
+            self.latest[product_id] = (False, None)
+        return len(gone)
+
+
+def load_price_history(
+    collection: pymongo.collection.Collection,
+    brand: Optional[str] = None,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+):
+    """
+    Load price measurements into a DataFrame.
+
+    Args:
+        collection: The time-series collection.
+        brand: Only load the products of this brand.
+        start: Only load the measurements from this time.
+        end: Only load the measurements before this time.
+
+    Returns:
+        pandas.DataFrame: The measurements, with columns ts, product_id, brand, price and available, sorted by
+        product and time. The price of an unavailable product is NaN.
+    """
+    import pandas as pd
+
+    query = {}
+    if brand is not None:
+        query["product.brand"] = brand
+    if start is not None or end is not None:
+        query["ts"] = {key: value for key, value in [("$gte", start), ("$lt", end)] if value is not None}
+    cursor = collection.find(query, {"_id": 0, "ts": 1, "product": 1, "price": 1, "available": 1}, batch_size=10000)
+    history = pd.DataFrame.from_records(
+        (
+            (
+                document["ts"],
+                document["product"]["id"],
+                document["product"].get("brand"),
+                document.get("price"),
+                document["available"],
+            )
+            for document in cursor
+        ),
+        columns=["ts", "product_id", "brand", "price", "available"],
+    )
+    history["price"] = history["price"].astype("float64")
+    return history.sort_values(["product_id", "ts"], ignore_index=True)
+
+
+def price_deltas(history):
+    """
+    Compute the price change of each measurement from the previous available price of its product.
+
+    Args:
+        history: The measurements, as loaded by `load_price_history`.
+
+    Returns:
+        pandas.DataFrame: The price changes, with columns ts, product_id, brand, price, delta and relative_delta.
+    """
+    available = history[history["available"]].sort_values(["product_id", "ts"])
+    deltas = available.assign(delta=available.groupby("product_id")["price"].diff())
+    deltas["relative_delta"] = deltas["delta"] / (deltas["price"] - deltas["delta"])
+    return deltas.dropna(subset=["delta"])[["ts", "product_id", "brand", "price", "delta", "relative_delta"]]
+
+
+def brand_price_changes(history, freq: str = "W"):
+    """
+    Aggregate the price changes per brand and period.
+
+    Args:
+        history: The measurements, as loaded by `load_price_history`.
+        freq: The pandas frequency of the periods, e.g. 'D', 'W' or 'M'.
+
+    Returns:
+        pandas.DataFrame: The number of changes, and the mean absolute and relative changes, indexed by brand and
+        period.
+    """
+    deltas = price_deltas(history).set_index("ts")
+    return (
+        deltas.groupby("brand")
+        .resample(freq)
+        .agg(changes=("delta", "count"), mean_delta=("delta", "mean"), mean_relative_delta=("relative_delta", "mean"))
+    )
@@ -0,0 +1,134 @@
+"""
+This module defines the persistent index of the images already downloaded into `IMAGES_STORE`.
+
+The index maps the URL of every stored image to its path and checksum in a SQLite database. A Bloom filter of the
+URLs is built in memory when the index is opened, so that the new images, the vast majority of the lookups of a first
+crawl, are answered without a database query, and the known ones with a single primary key lookup, instead of a
+filesystem stat per image.
+"""
+
+import hashlib
+import math
+import sqlite3
+from typing import Optional
+
+
+class BloomFilter:
+    """
+    Bloom filter of strings, with double hashing over a bit array.
+
+    Attributes:
+        num_bits: The size of the bit array.
+        num_hashes: The number of bits set per string.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        """
+        Initialize an empty filter.
+
+        Args:
+            capacity: The number of strings after which the false positive rate exceeds `error_rate`.
+            error_rate: The false positive rate at capacity.
+        """
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class KnownImagesIndex:
+    """
+    Persistent map of image URL to the path and checksum of the stored image.
+
+    The index only knows the images downloaded through it: if files are removed from `IMAGES_STORE`, the index must be
+    deleted too, it is then filled again as the images are downloaded.
+
+    Attributes:
+        path: The SQLite database file.
+        commit_every: The number of additions after which they are committed.
+    """
+
+    def __init__(self, path: str, commit_every: int = 1000):
+        """
+        Initialize the index, without opening it.
+
+        Args:
+            path: The SQLite database file, created if missing.
+            commit_every: The number of additions after which they are committed.
+        """
+        self.path = path
+        self.commit_every = commit_every
+        self.connection = None
+        self.bloom = None
+        self._pending = 0
+
+    def open(self) -> "KnownImagesIndex":
+        """
+        Open the database and build the Bloom filter of its URLs.
+
+        Returns:
+            KnownImagesIndex: The index itself.
+        """
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, path TEXT NOT NULL, checksum TEXT) WITHOUT ROWID"
+        )
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM images").fetchone()
+        # Room for the images of the next crawls before the false positive rate degrades
+        self.bloom = BloomFilter(capacity=max(1_000_000, 2 * count))
+        for (url,) in self.connection.execute("SELECT url FROM images"):
+            self.bloom.add(url)
+        return self
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def get(self, url: str) -> Optional[tuple]:
+        """
+        Look up an image.
+
+        Args:
+            url: The image URL.
+
+        Returns:
+            Optional[tuple]: The path and checksum of the stored image, or None if the image is unknown.
+        """
+        if url not in self.bloom:
+            return None
+        return self.connection.execute("SELECT path, checksum FROM images WHERE url = ?", (url,)).fetchone()
+
+    def add(self, url: str, path: str, checksum: Optional[str]):
+        """
+        Record a stored image.
+
+        Args:
+            url: The image URL.
+            path: The path of the image, relative to `IMAGES_STORE`.
+            checksum: The checksum of the image.
+        """
+        self.connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?)", (url, path, checksum))
+        self.bloom.add(url)
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.connection.commit()
+            self._pending = 0
+
+    def close(self):
+        """
+        Commit the pending additions and close the database.
+        """
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
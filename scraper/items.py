@@ -3,17 +3,29 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
 
-import scrapy
+import dataclasses
+from typing import Optional
 
-class WatchItem(scrapy.Item):
+from .schema import WatchRecord
+
+
+@dataclasses.dataclass(slots=True)
+class WatchItem:
     """
     Scrapy item for storing information about watches scraped from a website.
 
     Attributes:
+        url: The URL of the watch page.
         image_urls: A field to store a list of image URLs associated with the watch.
         images: A field to store the information of the downloaded watch images (populated by Scrapy's image pipeline).
+        thumbs: The information of the downloaded thumbnails, when they are fetched as an image variant.
         metadata: A field to store various metadata and specifications of the watch, such as price and features.
+        record: The typed specifications of the watch (populated by the schema pipeline from the metadata).
     """
-    image_urls = scrapy.Field()
-    images = scrapy.Field()
-    metadata = scrapy.Field()
+
+    url: Optional[str] = None
+    image_urls: list = dataclasses.field(default_factory=list)
+    images: list = dataclasses.field(default_factory=list)
+    thumbs: list = dataclasses.field(default_factory=list)
+    metadata: dict = dataclasses.field(default_factory=dict)
+    record: Optional[WatchRecord] = None
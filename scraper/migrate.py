@@ -0,0 +1,94 @@
+"""
+This module migrates the watches stored before the typed schema of `schema.WatchRecord`, whose specifications are
+top-level fields under their French title ('marque', 'modèle', 'fonctions', ...), to the typed schema. Their captions
+then match the captions of the watches scraped since, e.g. 'brand:rolex,model:submariner,chronograph' instead of
+"marque:rolex,modèle:submariner,fonctions:['chronographe']".
+
+LoRA weights trained on the old captions only follow prompts in the old format: evaluate them with
+`diffusion/validation_prompts_legacy.txt`, and retrain them on the migrated documents.
+
+Example:
+    python -m scraper.migrate --dry_run
+    python -m scraper.migrate
+"""
+
+import argparse
+from typing import Optional
+
+from .schema import SPEC_FIELDS, WatchRecord
+
+# Fields of the stored documents that are not specifications
+STORAGE_FIELDS = ["_id", "url", "image_urls", "image_paths", "thumb_paths"]
+# Top-level fields of the documents stored before the typed schema
+LEGACY_FIELDS = [*SPEC_FIELDS, "fonctions"]
+
+
+def migration_update(document: dict) -> Optional[dict]:
+    """
+    Build the update converting a document to the typed schema.
+
+    Args:
+        document: The stored document.
+
+    Returns:
+        Optional[dict]: The MongoDB update, setting the typed fields and removing the French ones, or None if the
+            document already follows the typed schema.
+    """
+    if not any(field in document for field in LEGACY_FIELDS):
+        return None
+    metadata = {key: value for key, value in document.items() if key not in STORAGE_FIELDS}
+    typed = WatchRecord.from_metadata(metadata).to_document()
+    update = {"$set": typed}
+    removed = {key: "" for key in metadata if key not in typed}
+    if removed:
+        update["$unset"] = removed
+    return update
+
+
+def migrate_collection(collection, dry_run: bool = False) -> int:
+    """
+    Migrate the documents of a collection stored before the typed schema.
+
+    Args:
+        collection: The watches collection.
+        dry_run: Whether to only count the documents to migrate.
+
+    Returns:
+        int: The number of documents to migrate, or migrated.
+    """
+    query = {"$or": [{field: {"$exists": True}} for field in LEGACY_FIELDS]}
+    count = 0
+    for document in collection.find(query):
+        update = migration_update(document)
+        if update is None:
+            continue
+        count += 1
+        if not dry_run:
+            collection.update_one({"_id": document["_id"]}, update)
+    return count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Migrate the stored watches to the typed schema.")
+    parser.add_argument("--mongo_uri", type=str, default="localhost", help="The MongoDB server URI.")
+    parser.add_argument("--mongo_port", type=int, default=27017, help="The MongoDB server port.")
+    parser.add_argument("--mongo_db", type=str, default="watch_scraping", help="The MongoDB database.")
+    parser.add_argument("--collection", type=str, default="watches", help="The MongoDB collection.")
+    parser.add_argument("--dry_run", action="store_true", help="Only count the documents to migrate.")
+    return parser.parse_args()
+
+
+def main():
+    import pymongo
+
+    args = parse_args()
+    client = pymongo.MongoClient(args.mongo_uri, args.mongo_port)
+    try:
+        count = migrate_collection(client[args.mongo_db][args.collection], dry_run=args.dry_run)
+    finally:
+        client.close()
+    print(f"{count} watches {'to migrate' if args.dry_run else 'migrated'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,211 @@
+import datetime
+import hashlib
+from io import BytesIO
+
 from itemadapter import ItemAdapter
 import scrapy
 import pymongo
+from scrapy import signals
+from PIL import Image
+from scrapy.pipelines.images import ImagesPipeline
+
+from .handlers import IMAGE_REQUEST_META
+from .history import PriceHistory
+from .image_index import KnownImagesIndex
+from .schema import INDEXED_FIELDS, WatchRecord
+from .search import FacetIndex
+from .variants import FORMAT_CONTENT_TYPES, FORMAT_EXTENSIONS, VariantUrls, parse_variants
+
+
+class WatchImagesPipeline(ImagesPipeline):
+    """
+    Scrapy images pipeline whose requests are downloaded by the HTTP/2 image handler, in their own download slot.
+
+    The images already stored are looked up in a persistent index (IMAGES_INDEX setting) before their requests are
+    scheduled: they are neither requested nor checked on the filesystem, and their stored path is reported in the
+    item as if they had been checked by the pipeline.
+
+    If IMAGE_VARIANTS is set, each image is requested once per variant, at the width and in the format of the
+    variant (see `variants.py`), and stored as encoded by the CDN, without local re-encoding or thumbnails. The
+    'full' variant fills the images of the item, the 'thumbs/small' variant its thumbnails.
+    """
+
+    def open_spider(self, spider: scrapy.Spider):
+        """
+        Open the index of the stored images when the spider starts.
+
+        Args:
+            spider: The Scrapy spider instance.
+        """
+        super().open_spider(spider)
+        settings = self.crawler.settings
+        self.known_images = KnownImagesIndex(settings.get("IMAGES_INDEX", "images/index.sqlite")).open()
+        self.variants = parse_variants(settings.getdict("IMAGE_VARIANTS"))
+        self.variant_urls = VariantUrls(settings.getdict("IMAGE_CDN_PARAMS"))
+        self.downloaded_bytes = {}
+        spider.logger.info(f"{len(self.known_images)} images already stored")
+
+    def close_spider(self, spider: scrapy.Spider):
+        """
+        Close the index of the stored images when the spider is finished, and report the bytes downloaded per item.
+
+        Args:
+            spider: The Scrapy spider instance.
+        """
+        self.known_images.close()
+        stats = self.crawler.stats
+        items = stats.get_value("images/items_downloaded", 0, spider=spider)
+        if items:
+            bytes_per_item = stats.get_value("images/item_bytes", 0, spider=spider) / items
+            stats.set_value("images/bytes_per_item", round(bytes_per_item), spider=spider)
+
+    def image_requests(self, url: str) -> list:
+        """
+        Create the requests of an image, one per variant if IMAGE_VARIANTS is set.
+
+        Args:
+            url: The URL of the image.
+
+        Returns:
+            list: The requests.
+        """
+        if not self.variants:
+            return [scrapy.Request(url)]
+        return [
+            scrapy.Request(
+                self.variant_urls.url(url, variant),
+                meta={
+                    "image_url": url,
+                    "variant": variant.name,
+                    "image_format": self.variant_urls.format(url, variant),
+                },
+            )
+            for variant in self.variants
+        ]
+
+    def get_media_requests(self, item: scrapy.Item, info):
+        """
+        Create the image requests of an item, marked as image requests, except for the images already stored.
+
+        Args:
+            item: The scraped item.
+            info: The media pipeline information of the spider.
+
+        Returns:
+            list: The image requests.
+        """
+        requests = []
+        for url in ItemAdapter(item).get(self.images_urls_field, []):
+            for request in self.image_requests(url):
+                if self.known_images.get(request.url) is not None:
+                    self.crawler.stats.inc_value("images/known_skipped", spider=info.spider)
+                    continue
+                request.meta.update(IMAGE_REQUEST_META)
+                requests.append(request)
+        return requests
+
+    def file_path(self, request: scrapy.Request, response=None, info=None, *, item=None) -> str:
+        """
+        Get the path of an image, relative to IMAGES_STORE.
+
+        The variants of an image are stored under the same name, the hash of the image URL, in the directory of the
+        variant, with the extension of the format returned by the CDN.
+
+        Returns:
+            str: The path.
+        """
+        variant = request.meta.get("variant")
+        if variant is None:
+            return super().file_path(request, response=response, info=info, item=item)
+        image_format = request.meta["image_format"]
+        if response is not None:
+            content_type = response.headers.get("Content-Type", b"").decode()
+            image_format = next(
+                (name for name, value in FORMAT_CONTENT_TYPES.items() if content_type.startswith(value)), image_format
+            )
+        digest = hashlib.sha1(request.meta["image_url"].encode()).hexdigest()
+        return f"{variant}/{digest}.{FORMAT_EXTENSIONS[image_format]}"
+
+    def get_images(self, response: scrapy.http.Response, request: scrapy.Request, info, *, item=None):
+        """
+        Get the images to store from a response: the response itself for a variant, as encoded by the CDN.
+
+        Yields:
+            tuple: The path, the image and the buffer to store.
+        """
+        self.downloaded_bytes[request.url] = len(response.body)
+        if request.meta.get("variant") is None:
+            yield from super().get_images(response, request, info, item=item)
+            return
+
+        content_type = response.headers.get("Content-Type", b"").decode() or None
+        if not self.variant_urls.check_content_type(request.url, request.meta["image_format"], content_type):
+            info.spider.logger.info(f"{content_type} returned for {request.url}, requesting JPEG from this host")
+        self.crawler.stats.inc_value(f"images/variant_bytes/{request.meta['variant']}", len(response.body))
+        path = self.file_path(request, response=response, info=info, item=item)
+        # Only the header is parsed, for the size of the image
+        yield path, Image.open(BytesIO(response.body)), BytesIO(response.body)
+
+    def item_completed(self, results: list, item: scrapy.Item, info):
+        """
+        Fill the images of an item, from the downloaded images and the index, in the order of its image URLs.
+
+        Args:
+            results: The (success, result) pairs of the image requests.
+            item: The scraped item.
+            info: The media pipeline information of the spider.
+
+        Returns:
+            scrapy.Item: The item, with its images, and its thumbnails if they are a variant.
+        """
+        downloaded = {result["url"]: result for ok, result in results if ok}
+        for result in downloaded.values():
+            self.known_images.add(result["url"], result["path"], result["checksum"])
+
+        item_bytes = sum(self.downloaded_bytes.pop(url, 0) for url in downloaded)
+        if downloaded:
+            self.crawler.stats.inc_value("images/items_downloaded", spider=info.spider)
+            self.crawler.stats.inc_value("images/item_bytes", item_bytes, spider=info.spider)
+
+        adapter = ItemAdapter(item)
+        images, thumbs = [], []
+        for url in adapter[self.images_urls_field]:
+            for request in self.image_requests(url):
+                variant = request.meta.get("variant", "full")
+                if variant not in ("full", "thumbs/small"):
+                    continue
+                if request.url in downloaded:
+                    result = downloaded[request.url]
+                elif (known := self.known_images.get(request.url)) is not None:
+                    result = {"url": request.url, "path": known[0], "checksum": known[1], "status": "uptodate"}
+                else:
+                    continue
+                (images if variant == "full" else thumbs).append(result)
+        adapter[self.images_result_field] = images
+        if thumbs:
+            adapter["thumbs"] = thumbs
+        return item
+
+
+class WatchSchemaPipeline:
+    """
+    Scrapy item pipeline normalizing the scraped specifications of a watch into its typed record.
+    """
+
+    def process_item(self, item: scrapy.Item, spider: scrapy.Spider):
+        """
+        Set the record of the item from its metadata.
+
+        Args:
+            item: The scraped item.
+            spider: The Scrapy spider instance.
+
+        Returns:
+            scrapy.Item: The item, with its record.
+        """
+        adapter = ItemAdapter(item)
+        adapter["record"] = WatchRecord.from_metadata(adapter["metadata"])
+        return item
 
 
 class ScraperPipeline:
@@ -51,13 +256,18 @@ class ScraperPipeline:
 
     def open_spider(self, spider: scrapy.Spider):
         """
-        Initialize the MongoDB client and database connection when the spider starts.
+        Initialize the MongoDB client and database connection when the spider starts, and create the indexes of the
+        collection: on the image paths, used to find existing watches, and on the typed fields used as filters.
 
         Args:
             spider: The Scrapy spider instance.
         """
         self.client = pymongo.MongoClient(self.mongo_uri, self.mongo_port)
         self.db = self.client[self.mongo_db]
+        collection = self.db[self.collection_name]
+        for field in ["image_paths", *INDEXED_FIELDS]:
+            # Creating an existing index is a no-op
+            collection.create_index(field)
 
     def close_spider(self, spider: scrapy.Spider):
         """
@@ -80,37 +290,213 @@ class ScraperPipeline:
             scrapy.Item: The processed item.
 
         The item is processed in order to include image paths and metadata to be inserted into the MongoDB collection.
+        The typed record of the item is stored instead of its raw metadata when the schema pipeline is enabled.
 
         Example:
             Original item:
             {
+                'url': 'https://example.com/watch',
                 'image_urls': ['https://example.com/image1.jpg', 'https://example.com/image2.jpg'],
                 'images': [
                     {'url': https://example.com/image1.jpg, 'path': 'full/path/to/image1.jpg', 'checksum': 'a1b2c3', 'status': 'downloaded'},
                     {'url': https://example.com/image2.jpg, 'path': 'full/path/to/image2.jpg', 'checksum': 'x4y5z6', 'status': 'downloaded'}
                 ],
-                'metadata': {'price': 1000, 'brand': 'Example Watch', 'model': '12345'}
+                'metadata': {'price': 1000, 'marque': 'example watch', 'modèle': '12345', 'fonctions': ['date']},
+                'record': WatchRecord(brand='example watch', model='12345', price=1000.0, functions={'date': True})
             }
 
             Processed item:
             {
+                'url': 'https://example.com/watch',
                 'image_urls': ['https://example.com/image1.jpg', 'https://example.com/image2.jpg'],
                 'image_paths': ['full/path/to/image1.jpg', 'full/path/to/image2.jpg'],
-                'price': 1000,
-                'brand': 'Example Watch',
-                'model': '12345'
+                'brand': 'example watch',
+                'model': '12345',
+                'price': 1000.0,
+                'functions': {'date': True}
             }
         """
         # Reformat the item data to include image paths and metadata
+        adapter = ItemAdapter(item)
+        record = adapter.get("record")
         item = {
-            "image_urls": item["image_urls"],
-            "image_paths": [img["path"] for img in item["images"]],
-            "thumb_paths": [img["path"].replace("full", "thumbs/small") for img in item["images"]],
-            **item["metadata"],
+            "url": adapter["url"],
+            "image_urls": adapter["image_urls"],
+            "image_paths": [img["path"] for img in adapter["images"]],
+            "thumb_paths": [img["path"] for img in adapter["thumbs"]]
+            or [img["path"].replace("full", "thumbs/small") for img in adapter["images"]],
+            **(record.to_document() if record is not None else adapter["metadata"]),
         }
 
         # Insert the item into the MongoDB collection if it doesn't already exist
         if not self.db[self.collection_name].find_one({"image_paths": {"$in": item["image_paths"]}}):
-            self.db[self.collection_name].insert_one(ItemAdapter(item).asdict())
+            # The document is inserted as is, so that the item gets its `_id`, as for the search index
+            self.db[self.collection_name].insert_one(item)
+
+        return item
+
+
+class PriceHistoryPipeline:
+    """
+    Scrapy item pipeline recording the changes of price and availability of the watches in a time-series collection.
 
+    The products are identified by their SKU, or their page URL. The products that were available and were not seen
+    by a crawl are marked as unavailable when the crawl finishes, unless it was interrupted or only replayed the failed
+    requests.
+
+    Attributes:
+        collection_name: The name of the MongoDB time-series collection.
+        mongo_uri: The MongoDB server URI.
+        mongo_port: The MongoDB server port.
+        mongo_db: The name of the MongoDB database where data will be stored.
+    """
+
+    collection_name = "price_history"
+
+    def __init__(self, mongo_uri: str, mongo_port: int, mongo_db: str, stats):
+        """
+        Initialize the pipeline with MongoDB connection information.
+
+        Args:
+            mongo_uri: The MongoDB server URI.
+            mongo_port: The MongoDB server port.
+            mongo_db: The name of the MongoDB database where data will be stored.
+            stats: The stats collector of the crawler.
+        """
+        self.mongo_uri = mongo_uri
+        self.mongo_port = mongo_port
+        self.mongo_db = mongo_db
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler: scrapy.crawler.Crawler):
+        """
+        Create a pipeline instance with settings from the Scrapy crawler, as ScraperPipeline.
+
+        Args:
+            crawler: The Scrapy crawler instance.
+
+        Returns:
+            PriceHistoryPipeline: An instance of the pipeline with MongoDB connection settings.
+        """
+        pipeline = cls(
+            mongo_uri=crawler.settings.get("MONGO_URI"),
+            mongo_port=crawler.settings.get("MONGO_PORT", 27017),
+            mongo_db=crawler.settings.get("MONGO_DATABASE", "items"),
+            stats=crawler.stats,
+        )
+        # The close reason is only known by the signal, not by `close_spider`
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def open_spider(self, spider: scrapy.Spider):
+        """
+        Load the last recorded state of every product when the spider starts.
+
+        Args:
+            spider: The Scrapy spider instance.
+        """
+        self.client = pymongo.MongoClient(self.mongo_uri, self.mongo_port)
+        self.history = PriceHistory(self.client[self.mongo_db], self.collection_name)
+        self.crawl_time = datetime.datetime.now(datetime.timezone.utc)
+        self.seen = set()
+
+    def spider_closed(self, spider: scrapy.Spider, reason: str):
+        """
+        Mark the products that disappeared as unavailable, if the crawl visited the whole catalogue and finished, and
+        close the MongoDB client.
+
+        Args:
+            spider: The Scrapy spider instance.
+            reason: The reason why the spider was closed.
+        """
+        # A retry pass only sees the products of the failed requests
+        if reason == "finished" and not getattr(spider, "is_retry_pass", False):
+            unavailable = self.history.mark_unavailable(self.crawl_time, self.seen)
+            self.stats.set_value("price_history/unavailable", unavailable, spider=spider)
+        self.client.close()
+
+    def process_item(self, item, spider: scrapy.Spider):
+        """
+        Record the price of the item if it changed.
+
+        Args:
+            item: The item, as stored by ScraperPipeline.
+            spider: The Scrapy spider instance.
+
+        Returns:
+            The item, unchanged.
+        """
+        adapter = ItemAdapter(item)
+        product_id = adapter.get("sku") or adapter.get("url")
+        if product_id is not None:
+            self.seen.add(product_id)
+            if self.history.record(self.crawl_time, product_id, adapter.get("brand"), adapter.get("price")):
+                self.stats.inc_value("price_history/changes", spider=spider)
+        return item
+
+
+class SearchIndexPipeline:
+    """
+    Scrapy item pipeline appending the newly stored watches to the delta log of the faceted search index.
+
+    Attributes:
+        index_dir: The directory of the index.
+        flush_every: The number of watches after which they are appended to the log.
+    """
+
+    def __init__(self, index_dir: str, flush_every: int = 100):
+        """
+        Initialize the pipeline.
+
+        Args:
+            index_dir: The directory of the index.
+            flush_every: The number of watches after which they are appended to the log.
+        """
+        self.index_dir = index_dir
+        self.flush_every = flush_every
+        self.pending = []
+
+    @classmethod
+    def from_crawler(cls, crawler: scrapy.crawler.Crawler):
+        """
+        Create a pipeline instance with settings from the Scrapy crawler.
+
+        If not set in the settings, the directory of the index, SEARCH_INDEX_DIR, is 'search_index'.
+
+        Args:
+            crawler: The Scrapy crawler instance.
+
+        Returns:
+            SearchIndexPipeline: An instance of the pipeline.
+        """
+        return cls(index_dir=crawler.settings.get("SEARCH_INDEX_DIR", "search_index"))
+
+    def close_spider(self, spider: scrapy.Spider):
+        """
+        Append the pending watches when the spider is finished.
+
+        Args:
+            spider: The Scrapy spider instance.
+        """
+        FacetIndex.append(self.index_dir, self.pending)
+        self.pending = []
+
+    def process_item(self, item, spider: scrapy.Spider):
+        """
+        Queue the item for the index if it was stored by ScraperPipeline, i.e. if it has an `_id`.
+
+        Args:
+            item: The item, as stored by ScraperPipeline.
+            spider: The Scrapy spider instance.
+
+        Returns:
+            The item, unchanged.
+        """
+        adapter = ItemAdapter(item)
+        if adapter.get("_id") is not None:
+            self.pending.append(adapter.asdict())
+            if len(self.pending) >= self.flush_every:
+                FacetIndex.append(self.index_dir, self.pending)
+                self.pending = []
         return item
@@ -0,0 +1,328 @@
+"""
+This module defines the typed schema of the watches stored in MongoDB, and the normalization of the specifications
+scraped from the product pages into it.
+
+The spider stores every specification as a lowercased free-text string under the French title displayed by the
+website. `WatchRecord.from_metadata` maps the known titles to typed fields: numbers converted to a single unit,
+enumerations for materials and movements, and booleans for the watch functions. The specifications it does not know,
+or whose value can't be parsed, are kept as-is in the `specs` overflow map, so that no information is lost.
+"""
+
+import dataclasses
+import enum
+import re
+import unicodedata
+from typing import Callable, Optional
+
+
+class Material(str, enum.Enum):
+    """
+    Material of a case or a bracelet.
+    """
+
+    STEEL = "steel"
+    STEEL_GOLD = "steel_gold"
+    YELLOW_GOLD = "yellow_gold"
+    ROSE_GOLD = "rose_gold"
+    WHITE_GOLD = "white_gold"
+    GOLD = "gold"
+    PLATINUM = "platinum"
+    TITANIUM = "titanium"
+    CERAMIC = "ceramic"
+    CARBON = "carbon"
+    BRONZE = "bronze"
+    SILVER = "silver"
+    LEATHER = "leather"
+    RUBBER = "rubber"
+    TEXTILE = "textile"
+
+
+class Movement(str, enum.Enum):
+    """
+    Movement of a watch.
+    """
+
+    AUTOMATIC = "automatic"
+    MANUAL = "manual"
+    QUARTZ = "quartz"
+
+
+# French terms of each enumeration value, ordered from the most to the least specific: the first match wins
+MATERIAL_TERMS = [
+    ("acier/or", Material.STEEL_GOLD),
+    ("acier et or", Material.STEEL_GOLD),
+    ("or jaune", Material.YELLOW_GOLD),
+    ("or rose", Material.ROSE_GOLD),
+    ("or rouge", Material.ROSE_GOLD),
+    ("or blanc", Material.WHITE_GOLD),
+    ("or gris", Material.WHITE_GOLD),
+    ("acier", Material.STEEL),
+    ("platine", Material.PLATINUM),
+    ("titane", Material.TITANIUM),
+    ("céramique", Material.CERAMIC),
+    ("carbone", Material.CARBON),
+    ("bronze", Material.BRONZE),
+    ("argent", Material.SILVER),
+    ("or", Material.GOLD),
+    ("cuir", Material.LEATHER),
+    ("alligator", Material.LEATHER),
+    ("caoutchouc", Material.RUBBER),
+    ("textile", Material.TEXTILE),
+    ("nato", Material.TEXTILE),
+]
+MOVEMENT_TERMS = [
+    ("automatique", Movement.AUTOMATIC),
+    ("manuel", Movement.MANUAL),
+    ("quartz", Movement.QUARTZ),
+    ("pile", Movement.QUARTZ),
+]
+
+# Names of the usual watch functions, the other functions are named after their slugified French label
+FUNCTION_NAMES = {
+    "chronographe": "chronograph",
+    "date": "date",
+    "jour": "day",
+    "jour et date": "day_date",
+    "gmt": "gmt",
+    "fuseau horaire": "gmt",
+    "phase de lune": "moon_phase",
+    "réserve de marche": "power_reserve",
+    "tourbillon": "tourbillon",
+    "calendrier perpétuel": "perpetual_calendar",
+    "calendrier annuel": "annual_calendar",
+    "lunette tournante": "rotating_bezel",
+    "aiguilles luminescentes": "luminous_hands",
+    "index luminescents": "luminous_indices",
+    "petite seconde": "small_seconds",
+    "répétition minutes": "minute_repeater",
+    "alarme": "alarm",
+    "tachymètre": "tachymeter",
+    "fonction flyback": "flyback",
+}
+
+NUMBER = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def slugify(text: str) -> str:
+    """
+    Convert a French label into an ASCII snake_case key, usable as a MongoDB field name.
+
+    Args:
+        text: The label.
+
+    Returns:
+        str: The key, e.g. 'aiguilles luminescentes' becomes 'aiguilles_luminescentes'.
+    """
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]+", "_", text.lower()).strip("_")
+
+
+def parse_text(value: str) -> Optional[str]:
+    return value.strip() or None
+
+
+def parse_number(value: str) -> Optional[float]:
+    """
+    Parse the first number of a text, with a dot or a comma as decimal separator.
+
+    Args:
+        value: The text, e.g. '40,5 mm'.
+
+    Returns:
+        Optional[float]: The number, or None if the text has none.
+    """
+    match = NUMBER.search(value.replace(" ", "").replace("\xa0", ""))
+    return float(match.group().replace(",", ".")) if match else None
+
+
+def parse_length_mm(value: str) -> Optional[float]:
+    number = parse_number(value)
+    if number is None:
+        return None
+    return number * 10 if re.search(r"\bcm\b", value) else number
+
+
+def parse_year(value: str) -> Optional[int]:
+    match = re.search(r"\b(1[89]\d{2}|20\d{2})\b", value)
+    return int(match.group()) if match else None
+
+
+def parse_water_resistance_m(value: str) -> Optional[int]:
+    """
+    Parse a water resistance into meters, 1 ATM or 1 bar being 10 meters.
+
+    Args:
+        value: The text, e.g. '300 m' or '10 atm'.
+
+    Returns:
+        Optional[int]: The water resistance in meters, or None if the text has no number.
+    """
+    number = parse_number(value)
+    if number is None:
+        return None
+    return round(number * 10) if re.search(r"\b(atm|bar)\b", value) else round(number)
+
+
+def parse_power_reserve_h(value: str) -> Optional[float]:
+    number = parse_number(value)
+    if number is None:
+        return None
+    return number * 24 if re.search(r"\bjours?\b", value) else number
+
+
+def parse_price(value) -> Optional[float]:
+    """
+    Parse a price, either already converted by the spider or as displayed, e.g. '12 350 €'.
+
+    Args:
+        value: The price.
+
+    Returns:
+        Optional[float]: The price, or None if it can't be parsed.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    return parse_number(value)
+
+
+def enum_parser(terms: list) -> Callable[[str], Optional[enum.Enum]]:
+    """
+    Create a parser matching whole French terms in a text.
+
+    Args:
+        terms: The (term, value) pairs, the first matching term wins.
+
+    Returns:
+        Callable: The parser, returning None if no term matches.
+    """
+    patterns = [(re.compile(rf"\b{re.escape(term)}\b"), value) for term, value in terms]
+
+    def parse(value: str):
+        return next((member for pattern, member in patterns if pattern.search(value)), None)
+
+    return parse
+
+
+# Known specification titles of the website, as lowercased by the spider, and their field and parser
+SPEC_FIELDS = {
+    "marque": ("brand", parse_text),
+    "modèle": ("model", parse_text),
+    "référence": ("reference", parse_text),
+    "numéro de référence": ("reference", parse_text),
+    "sku": ("sku", parse_text),
+    "année": ("year", parse_year),
+    "année de fabrication": ("year", parse_year),
+    "état": ("condition", parse_text),
+    "sexe": ("gender", parse_text),
+    "genre": ("gender", parse_text),
+    "diamètre": ("case_diameter_mm", parse_length_mm),
+    "diamètre du boîtier": ("case_diameter_mm", parse_length_mm),
+    "taille du boîtier": ("case_diameter_mm", parse_length_mm),
+    "matériau du boîtier": ("case_material", enum_parser(MATERIAL_TERMS)),
+    "boîtier": ("case_material", enum_parser(MATERIAL_TERMS)),
+    "matériau du bracelet": ("bracelet_material", enum_parser(MATERIAL_TERMS)),
+    "bracelet": ("bracelet_material", enum_parser(MATERIAL_TERMS)),
+    "mouvement": ("movement", enum_parser(MOVEMENT_TERMS)),
+    "calibre": ("caliber", parse_text),
+    "étanchéité": ("water_resistance_m", parse_water_resistance_m),
+    "réserve de marche": ("power_reserve_h", parse_power_reserve_h),
+    "couleur du cadran": ("dial_color", parse_text),
+    "cadran": ("dial_color", parse_text),
+    "verre": ("crystal", parse_text),
+}
+
+# Fields worth a MongoDB index, for the filters of the dataset queries
+INDEXED_FIELDS = ["brand", "case_diameter_mm", "year", "price"]
+
+
+@dataclasses.dataclass(slots=True)
+class WatchRecord:
+    """
+    Typed and normalized specifications of a watch.
+
+    Attributes:
+        brand: The brand.
+        model: The model.
+        reference: The reference number.
+        sku: The product identifier of the website.
+        year: The production year.
+        condition: The condition, e.g. 'neuve'.
+        gender: The gender, e.g. 'homme'.
+        case_diameter_mm: The case diameter, in millimeters.
+        case_material: The case material.
+        bracelet_material: The bracelet material.
+        movement: The movement.
+        caliber: The caliber.
+        water_resistance_m: The water resistance, in meters.
+        power_reserve_h: The power reserve, in hours.
+        dial_color: The dial color.
+        crystal: The crystal, e.g. 'saphir'.
+        price: The price, in euros.
+        functions: The functions of the watch, e.g. {'chronograph': True, 'date': True}.
+        specs: The specifications that are not typed fields, under their French title.
+    """
+
+    brand: Optional[str] = None
+    model: Optional[str] = None
+    reference: Optional[str] = None
+    sku: Optional[str] = None
+    year: Optional[int] = None
+    condition: Optional[str] = None
+    gender: Optional[str] = None
+    case_diameter_mm: Optional[float] = None
+    case_material: Optional[Material] = None
+    bracelet_material: Optional[Material] = None
+    movement: Optional[Movement] = None
+    caliber: Optional[str] = None
+    water_resistance_m: Optional[int] = None
+    power_reserve_h: Optional[float] = None
+    dial_color: Optional[str] = None
+    crystal: Optional[str] = None
+    price: Optional[float] = None
+    functions: dict = dataclasses.field(default_factory=dict)
+    specs: dict = dataclasses.field(default_factory=dict)
+
+    @classmethod
+    def from_metadata(cls, metadata: dict) -> "WatchRecord":
+        """
+        Normalize the metadata scraped by the spider.
+
+        Args:
+            metadata: The specifications under their lowercased French title, the list of functions under
+                'fonctions' and the price under 'price'.
+
+        Returns:
+            WatchRecord: The record. Unknown specifications, and known ones whose value can't be parsed, are kept in
+            `specs`.
+        """
+        record = cls()
+        for title, value in metadata.items():
+            if title == "fonctions":
+                record.functions.update({FUNCTION_NAMES.get(label, slugify(label)): True for label in value if label})
+            elif title == "price":
+                record.price = parse_price(value)
+            elif title in SPEC_FIELDS and getattr(record, SPEC_FIELDS[title][0]) is None:
+                field, parse = SPEC_FIELDS[title]
+                parsed = parse(value)
+                if parsed is None:
+                    record.specs[title] = value
+                else:
+                    setattr(record, field, parsed)
+            else:
+                record.specs[title] = value
+        return record
+
+    def to_document(self) -> dict:
+        """
+        Convert the record into a MongoDB document, without the missing fields.
+
+        Returns:
+            dict: The document, with enumerations stored as their string value.
+        """
+        document = {}
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            if value is None or value == {}:
+                continue
+            document[field.name] = value.value if isinstance(value, enum.Enum) else value
+        return document
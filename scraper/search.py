@@ -0,0 +1,452 @@
+"""
+This module defines an in-memory faceted search index over the watches, to explore the catalogue and pick training
+subsets and validation prompts.
+
+The index is built from the watches collection, or from a Parquet export of it, into a directory of NumPy arrays that
+are memory-mapped when loaded:
+
+- for each categorical facet (brand, materials, movement, functions, ...), the sorted list of its values and an
+  inverted index: the ids of the watches having each value, concatenated, with the offset of each value,
+- for each numeric field (price, year, case diameter, ...), its values sorted, with the ids of the watches in the same
+  order, so that a range is two binary searches.
+
+Filters are combined as boolean masks over the watches, and facet counts are a single `np.add.reduceat` over the
+inverted index. New watches are appended to a delta log by `SearchIndexPipeline` as they are stored, and indexed in
+memory when the index is loaded, until the next full build, which starts a new log.
+
+Example:
+    python -m scraper.search build --output_dir search_index
+    python -m scraper.search query --index_dir search_index --filter brand=rolex --range price=5000:10000 \\
+        --facet case_material
+"""
+
+import argparse
+import json
+import numbers
+import os
+import shutil
+from collections import defaultdict
+from typing import Iterable, Optional
+
+import numpy as np
+
+# Fields of the typed schema indexed as facets and as numeric ranges
+FACET_FIELDS = [
+    "brand",
+    "model",
+    "condition",
+    "gender",
+    "case_material",
+    "bracelet_material",
+    "movement",
+    "dial_color",
+    "functions",
+]
+NUMERIC_FIELDS = ["price", "year", "case_diameter_mm", "water_resistance_m", "power_reserve_h"]
+
+DELTA_FILE = "delta.jsonl"
+# Delta log rotated at the start of a build, removed once the build is complete
+ROTATED_DELTA_FILE = "delta.jsonl.build"
+
+
+def facet_values(document: dict, facet: str) -> list:
+    """
+    Get the values of a facet of a watch: the true keys of a sub-document of booleans, the items of a list, or the
+    value itself.
+
+    Args:
+        document: The watch document.
+        facet: The facet.
+
+    Returns:
+        list: The values, as strings.
+    """
+    value = document.get(facet)
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return [key for key, flag in value.items() if flag]
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [str(item) for item in value]
+    return [str(value)]
+
+
+def project(document: dict) -> dict:
+    """
+    Keep only the indexed fields of a watch.
+
+    Args:
+        document: The watch document, with its MongoDB `_id`.
+
+    Returns:
+        dict: The indexed fields, with the facets as lists of values and `_id` as a string.
+    """
+    projected = {"_id": str(document["_id"])}
+    for facet in FACET_FIELDS:
+        values = facet_values(document, facet)
+        if values:
+            projected[facet] = values
+    for field in NUMERIC_FIELDS:
+        value = document.get(field)
+        if isinstance(value, numbers.Real) and not isinstance(value, (bool, np.bool_)) and not np.isnan(value):
+            projected[field] = float(value)
+    return projected
+
+
+class Segment:
+    """
+    Immutable index of a set of watches.
+
+    Attributes:
+        keys: The MongoDB `_id` of each watch, as strings. The position of a watch in `keys` is its id in the index.
+        facets: The (values, offsets, postings) of each facet: the ids of the watches having `values[i]` are
+            `postings[offsets[i]:offsets[i + 1]]`.
+        numeric: The (sorted_values, ids) of each numeric field, the ids of the watches in the order of their values.
+    """
+
+    def __init__(self, keys: np.ndarray, facets: dict, numeric: dict):
+        self.keys = keys
+        self.facets = facets
+        self.numeric = numeric
+        self.value_ids = {
+            facet: {value: i for i, value in enumerate(values)} for facet, (values, _, _) in facets.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, documents: Iterable[dict]) -> "Segment":
+        """
+        Index watches.
+
+        Args:
+            documents: The watch documents, with their `_id`, full or projected.
+
+        Returns:
+            Segment: The segment.
+        """
+        keys = []
+        postings = {facet: defaultdict(list) for facet in FACET_FIELDS}
+        numeric = {field: ([], []) for field in NUMERIC_FIELDS}
+        for doc_id, document in enumerate(map(project, documents)):
+            keys.append(document["_id"])
+            for facet in FACET_FIELDS:
+                for value in document.get(facet, []):
+                    postings[facet][value].append(doc_id)
+            for field in NUMERIC_FIELDS:
+                if field in document:
+                    numeric[field][0].append(document[field])
+                    numeric[field][1].append(doc_id)
+
+        facets = {}
+        for facet, value_postings in postings.items():
+            values = sorted(value_postings)
+            lengths = [len(value_postings[value]) for value in values]
+            offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+            flat = [doc_id for value in values for doc_id in value_postings[value]]
+            facets[facet] = (values, offsets, np.asarray(flat, dtype=np.int32))
+        sorted_numeric = {}
+        for field, (values, ids) in numeric.items():
+            values, ids = np.asarray(values, dtype=np.float64), np.asarray(ids, dtype=np.int32)
+            order = np.argsort(values, kind="stable")
+            sorted_numeric[field] = (values[order], ids[order])
+        return cls(np.asarray(keys, dtype=str), facets, sorted_numeric)
+
+    def save(self, path: str):
+        """
+        Save the segment as a directory of arrays.
+
+        Args:
+            path: The directory.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "keys.npy"), self.keys)
+        for facet, (_, offsets, postings) in self.facets.items():
+            np.save(os.path.join(path, f"facet.{facet}.offsets.npy"), offsets)
+            np.save(os.path.join(path, f"facet.{facet}.postings.npy"), postings)
+        for field, (values, ids) in self.numeric.items():
+            np.save(os.path.join(path, f"numeric.{field}.values.npy"), values)
+            np.save(os.path.join(path, f"numeric.{field}.ids.npy"), ids)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"facets": {facet: values for facet, (values, _, _) in self.facets.items()}}, f)
+
+    @classmethod
+    def load(cls, path: str) -> "Segment":
+        """
+        Load a segment, with its arrays memory-mapped.
+
+        Args:
+            path: The directory of the segment.
+
+        Returns:
+            Segment: The segment.
+        """
+
+        def load_array(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        facets = {
+            facet: (values, load_array(f"facet.{facet}.offsets.npy"), load_array(f"facet.{facet}.postings.npy"))
+            for facet, values in meta["facets"].items()
+        }
+        numeric = {
+            field: (load_array(f"numeric.{field}.values.npy"), load_array(f"numeric.{field}.ids.npy"))
+            for field in NUMERIC_FIELDS
+        }
+        return cls(load_array("keys.npy"), facets, numeric)
+
+    def mask(self, filters: dict, ranges: dict) -> np.ndarray:
+        """
+        Select the watches matching filters.
+
+        Args:
+            filters: The accepted values of facets, e.g. {'brand': ['rolex', 'omega'], 'functions': 'chronograph'}.
+                A watch matches a facet if it has any of its values, and must match every facet.
+            ranges: The inclusive (low, high) bounds of numeric fields, None for no bound, e.g. {'year': (2015, None)}.
+
+        Returns:
+            np.ndarray: The boolean mask of the matching watches.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for facet, accepted in filters.items():
+            if facet not in self.facets:
+                raise ValueError(f"Unknown facet {facet}, choose between {FACET_FIELDS}")
+            _, offsets, postings = self.facets[facet]
+            facet_mask = np.zeros(len(self), dtype=bool)
+            for value in [accepted] if isinstance(accepted, str) else accepted:
+                i = self.value_ids[facet].get(value)
+                if i is not None:
+                    facet_mask[postings[offsets[i] : offsets[i + 1]]] = True
+            mask &= facet_mask
+        for field, (low, high) in ranges.items():
+            if field not in self.numeric:
+                raise ValueError(f"Unknown numeric field {field}, choose between {NUMERIC_FIELDS}")
+            values, ids = self.numeric[field]
+            start = 0 if low is None else np.searchsorted(values, low, side="left")
+            stop = len(values) if high is None else np.searchsorted(values, high, side="right")
+            range_mask = np.zeros(len(self), dtype=bool)
+            range_mask[ids[start:stop]] = True
+            mask &= range_mask
+        return mask
+
+    def facet_counts(self, facet: str, mask: np.ndarray) -> dict:
+        """
+        Count the selected watches having each value of a facet.
+
+        Args:
+            facet: The facet.
+            mask: The boolean mask of the selected watches.
+
+        Returns:
+            dict: The number of selected watches per value, without the values of no selected watch.
+        """
+        values, offsets, postings = self.facets[facet]
+        if not values:
+            return {}
+        counts = np.add.reduceat(mask[postings].astype(np.int64), offsets[:-1])
+        return {values[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+
+
+class FacetIndex:
+    """
+    Faceted search index of the watches: a segment built from the whole collection, and a segment of the watches
+    stored since, read from the delta log.
+
+    Attributes:
+        path: The directory of the index.
+        segments: The segments.
+    """
+
+    def __init__(self, path: str):
+        """
+        Load an index.
+
+        Args:
+            path: The directory of the index.
+        """
+        self.path = path
+        self.segments = []
+        base_path = os.path.join(path, "base")
+        base_keys = set()
+        if os.path.isdir(base_path):
+            base = Segment.load(base_path)
+            self.segments.append(base)
+            base_keys = set(base.keys.tolist())
+        # The rotated log is only left by an interrupted build, and is older than the current one
+        documents = {}
+        for delta_file in [ROTATED_DELTA_FILE, DELTA_FILE]:
+            delta_path = os.path.join(path, delta_file)
+            if os.path.exists(delta_path):
+                with open(delta_path) as f:
+                    for line in f:
+                        document = json.loads(line)
+                        if document["_id"] not in base_keys:
+                            documents[document["_id"]] = document
+        if documents:
+            self.segments.append(Segment.build(documents.values()))
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self.segments)
+
+    @classmethod
+    def build(cls, documents: Iterable[dict], path: str) -> "FacetIndex":
+        """
+        Build an index from every watch, replacing the index and the delta log in the directory.
+
+        The delta log is rotated before the documents are read, so the watches appended while the index is built are
+        kept in the new log. They are indexed again when the index is loaded if the documents do not include them.
+
+        Args:
+            documents: The watch documents, with their `_id`, read lazily (e.g. a pymongo cursor) so that they
+                include every watch appended to the log before the build.
+            path: The directory of the index.
+
+        Returns:
+            FacetIndex: The index.
+        """
+        os.makedirs(path, exist_ok=True)
+        delta_path, rotated_path = os.path.join(path, DELTA_FILE), os.path.join(path, ROTATED_DELTA_FILE)
+        if os.path.exists(delta_path):
+            if os.path.exists(rotated_path):
+                # Left by an interrupted build, its watches are read with the documents as well
+                os.remove(rotated_path)
+            os.replace(delta_path, rotated_path)
+        tmp_path = os.path.join(path, "base.tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        Segment.build(documents).save(tmp_path)
+        shutil.rmtree(os.path.join(path, "base"), ignore_errors=True)
+        os.replace(tmp_path, os.path.join(path, "base"))
+        if os.path.exists(rotated_path):
+            os.remove(rotated_path)
+        return cls(path)
+
+    @staticmethod
+    def append(path: str, documents: Iterable[dict]):
+        """
+        Append watches to the delta log of an index, without loading it.
+
+        Args:
+            path: The directory of the index.
+            documents: The watch documents, with their `_id`.
+        """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, DELTA_FILE), "a") as f:
+            for document in documents:
+                f.write(json.dumps(project(document)) + "\n")
+
+    def search(self, filters: Optional[dict] = None, ranges: Optional[dict] = None) -> list:
+        """
+        Find the watches matching filters.
+
+        Args:
+            filters: The accepted values of facets, see `Segment.mask`.
+            ranges: The inclusive bounds of numeric fields, see `Segment.mask`.
+
+        Returns:
+            list: The MongoDB `_id` of the matching watches, as strings.
+        """
+        return [
+            key
+            for segment in self.segments
+            for key in segment.keys[segment.mask(filters or {}, ranges or {})].tolist()
+        ]
+
+    def count(self, filters: Optional[dict] = None, ranges: Optional[dict] = None) -> int:
+        """
+        Count the watches matching filters.
+
+        Args:
+            filters: The accepted values of facets, see `Segment.mask`.
+            ranges: The inclusive bounds of numeric fields, see `Segment.mask`.
+
+        Returns:
+            int: The number of matching watches.
+        """
+        return sum(int(segment.mask(filters or {}, ranges or {}).sum()) for segment in self.segments)
+
+    def facet_counts(self, facet: str, filters: Optional[dict] = None, ranges: Optional[dict] = None) -> dict:
+        """
+        Count the watches matching filters having each value of a facet.
+
+        Args:
+            facet: The facet.
+            filters: The accepted values of facets, see `Segment.mask`.
+            ranges: The inclusive bounds of numeric fields, see `Segment.mask`.
+
+        Returns:
+            dict: The number of matching watches per value, by decreasing count.
+        """
+        counts = defaultdict(int)
+        for segment in self.segments:
+            for value, count in segment.facet_counts(facet, segment.mask(filters or {}, ranges or {})).items():
+                counts[value] += count
+        return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+
+def parse_range(text: str) -> tuple:
+    field, bounds = text.split("=", 1)
+    low, high = bounds.split(":", 1)
+    return field, (float(low) if low else None, float(high) if high else None)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build and query the faceted search index of the watches.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Build the index from the MongoDB collection or a Parquet export.")
+    build.add_argument("--output_dir", type=str, required=True, help="Directory of the index.")
+    build.add_argument("--parquet", type=str, default=None, help="Parquet export of the collection, read instead.")
+    build.add_argument("--mongo_uri", type=str, default="localhost", help="The MongoDB server URI.")
+    build.add_argument("--mongo_port", type=int, default=27017, help="The MongoDB server port.")
+    build.add_argument("--mongo_db", type=str, default="watch_scraping", help="The MongoDB database.")
+    build.add_argument("--collection", type=str, default="watches", help="The MongoDB collection.")
+
+    query = subparsers.add_parser("query", help="Count the watches matching filters.")
+    query.add_argument("--index_dir", type=str, required=True, help="Directory of the index.")
+    query.add_argument(
+        "--filter", action="append", default=[], help="Facet filter FACET=VALUE, repeat for several values."
+    )
+    query.add_argument("--range", action="append", default=[], help="Numeric range FIELD=LOW:HIGH, bounds optional.")
+    query.add_argument("--facet", action="append", default=[], help="Facet whose value counts are printed.")
+    query.add_argument("--output", type=str, default=None, help="File to write the `_id` of the matching watches to.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "build":
+        if args.parquet is not None:
+            import pandas as pd
+
+            documents = pd.read_parquet(args.parquet).to_dict("records")
+        else:
+            import pymongo
+
+            client = pymongo.MongoClient(args.mongo_uri, args.mongo_port)
+            projection = {field: 1 for field in FACET_FIELDS + NUMERIC_FIELDS}
+            documents = client[args.mongo_db][args.collection].find({}, projection, batch_size=10000)
+        index = FacetIndex.build(documents, args.output_dir)
+        print(f"Indexed {len(index)} watches in {args.output_dir}")
+        return
+
+    index = FacetIndex(args.index_dir)
+    filters = defaultdict(list)
+    for text in args.filter:
+        facet, value = text.split("=", 1)
+        filters[facet].append(value)
+    ranges = dict(map(parse_range, args.range))
+    print(f"{index.count(filters, ranges)} / {len(index)} watches")
+    for facet in args.facet:
+        print(f"{facet}:")
+        for value, count in index.facet_counts(facet, filters, ranges).items():
+            print(f"    {value}: {count}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(index.search(filters, ranges), f)
+
+
+if __name__ == "__main__":
+    main()
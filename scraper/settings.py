@@ -56,15 +56,21 @@ DOWNLOAD_DELAY = 0.5
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-# }
+EXTENSIONS = {
+    "scraper.failures.FailedRequestsExtension": 500,
+}
+
+# Store of the failed requests, replayed with `scrapy crawl chronext -a retry_failed=1`
+FAILED_REQUESTS_DB = "failed_requests.sqlite"
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
-    "scrapy.pipelines.images.ImagesPipeline": 1,
+    "scraper.pipelines.WatchImagesPipeline": 1,
+    "scraper.pipelines.WatchSchemaPipeline": 200,
     "scraper.pipelines.ScraperPipeline": 300,
+    "scraper.pipelines.SearchIndexPipeline": 350,
+    "scraper.pipelines.PriceHistoryPipeline": 400,
 }
 
 # Configure images handling
@@ -72,6 +78,28 @@ IMAGES_STORE = "images/"
 IMAGES_THUMBS = {
     "small": (100, 100),
 }
+# Variants of the images requested from the image CDN, by directory in IMAGES_STORE: the training images ('full', as
+# large as the largest training resolution) and the thumbnails, encoded by the CDN instead of locally. The training
+# images stay JPEG: WebP would be smaller, but it has no reduced-scale decoding, which the dataloader workers use for
+# the resolutions up to half the width (see diffusion/image_decoding.py)
+IMAGE_VARIANTS = {
+    "full": {"width": 768, "format": "jpeg"},
+    "thumbs/small": {"width": 100, "format": "webp"},
+}
+# Query parameters of the width and of the format of the image CDN
+IMAGE_CDN_PARAMS = {"width": "w", "format": "fm"}
+# Index of the stored images, to skip their requests (delete it if images are removed from IMAGES_STORE)
+IMAGES_INDEX = "images/index.sqlite"
+
+# Download images over a pool of HTTP/2 connections to the image host (requires the h2 package), in their own
+# download slot, without the delay between the pages of the website
+DOWNLOAD_HANDLERS = {
+    "https": "scraper.handlers.ImageDownloadHandler",
+}
+IMAGES_H2_CONNECTIONS = 2
+DOWNLOAD_SLOTS = {
+    "images": {"concurrency": 16, "delay": 0},
+}
 
 
 # Enable and configure the AutoThrottle extension (disabled by default)
@@ -100,6 +128,9 @@ REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 FEED_EXPORT_ENCODING = "utf-8"
 
+# Directory of the faceted search index (built with `python -m scraper.search build`)
+SEARCH_INDEX_DIR = "search_index"
+
 # Set database infos
 MONGO_URI = "localhost"
 MONGO_DATABASE = "watch_scraping"
@@ -1,6 +1,7 @@
 from typing import Iterable
 import scrapy
 from .. import items
+from ..failures import FailureStore, request_failed
 import re
 
 
@@ -11,6 +12,10 @@ class ChronextSpider(scrapy.Spider):
 
     name = "chronext"
 
+    # Replay only the requests stored by the FailedRequestsExtension, with `-a retry_failed=1`
+    retry_failed = False
+    retry_priority = 10
+
     # Trim to keep only digits in a text. Usefull to parse price.
     trim = re.compile(r"[^\d.,]+")  
 
@@ -27,11 +32,55 @@ class ChronextSpider(scrapy.Spider):
         """
         Generate initial requests to begin the scraping process.
 
+        In retry mode, only the failed requests of the previous crawls are generated, with a higher priority.
+
         Returns:
             Iterable[scrapy.Request]: An iterable of Scrapy Request objects to start the scraping process.
         """
+        if self.is_retry_pass:
+            yield from self.failed_requests()
+            return
+
         for i in range(self.n_pages + 1):
-            yield scrapy.Request(self.url.format(i * self.watches_per_page))
+            yield scrapy.Request(self.url.format(i * self.watches_per_page), errback=self.request_failed)
+
+    @property
+    def is_retry_pass(self) -> bool:
+        """
+        Whether the crawl only replays the failed requests, instead of visiting the whole catalogue.
+        """
+        return self.retry_failed not in (False, "0", "")
+
+    def failed_requests(self) -> Iterable[scrapy.Request]:
+        """
+        Generate the requests stored by the FailedRequestsExtension.
+
+        Returns:
+            Iterable[scrapy.Request]: The requests, to their original callback.
+        """
+        store = FailureStore(self.settings.get("FAILED_REQUESTS_DB", "failed_requests.sqlite"))
+        entries = list(store.entries())
+        store.close()
+        self.logger.info(f"Replaying {len(entries)} failed requests")
+        for entry in entries:
+            yield scrapy.Request(
+                entry["url"],
+                method=entry["method"],
+                callback=getattr(self, entry["callback"]) if entry["callback"] else None,
+                errback=self.request_failed,
+                priority=self.retry_priority,
+                dont_filter=True,
+            )
+
+    def request_failed(self, failure):
+        """
+        Report a failed download (timeout, DNS error, HTTP error after retries, ...) to the FailedRequestsExtension.
+
+        Args:
+            failure: The failure, with its request.
+        """
+        self.logger.warning(f"Request failed: {failure.request.url} ({failure.type.__name__})")
+        self.crawler.signals.send_catch_log(request_failed, failure=failure, spider=self)
 
     def parse(self, response: scrapy.http.Response):
         """
@@ -44,7 +93,7 @@ class ChronextSpider(scrapy.Spider):
             scrapy.Request: Requests to follow watches specification pages.
         """
         watch_page_links = response.css("div.product-list a:first-of-type")
-        yield from response.follow_all(watch_page_links, self.parse_watch_page)
+        yield from response.follow_all(watch_page_links, self.parse_watch_page, errback=self.request_failed)
 
     def parse_watch_page(self, response: scrapy.http.Response):
         """
@@ -57,7 +106,9 @@ class ChronextSpider(scrapy.Spider):
             items.WatchItem: Watch information with image URLs and metadata.
         """
 
-        # Parse images urls and adapt them to get desired resolution
+        # Parse images urls and adapt them to get desired resolution. With IMAGE_VARIANTS, the width is set again by
+        # the images pipeline, but the URLs are kept as before so that the `full/<sha1(url)>` paths of the stored
+        # images stay the same, for the `image_paths` deduplication of ScraperPipeline
         image_urls = [
             img.attrib["src"].replace("w=570", f"w={self.desired_img_width}")
             for img in response.css("div.product-stage__image-wrapper img")
@@ -89,7 +140,12 @@ class ChronextSpider(scrapy.Spider):
                 metadata[specification_title] = specification_value
 
         # Parse price by keeping only digits
-        price_str = response.css("div.price::text").get()
-        metadata["price"] = float(self.trim.sub("", price_str))
-
-        yield items.WatchItem(image_urls=image_urls, metadata=metadata)
+        price_str = self.trim.sub("", response.css("div.price::text").get(default=""))
+        if price_str:
+            metadata["price"] = float(price_str)
+        else:
+            # Price on request: the watch is stored without price, instead of failing on every retry of the page
+            self.logger.info(f"No price on {response.url}")
+            self.crawler.stats.inc_value("chronext/missing_price", spider=self)
+
+        yield items.WatchItem(url=response.url, image_urls=image_urls, metadata=metadata)
@@ -0,0 +1,126 @@
+"""
+This module defines the image variants requested from the image CDN: instead of one large JPEG per image, resized
+and re-encoded locally into thumbnails, each consumer gets the width and format it needs, encoded by the CDN.
+
+The variants are set by the IMAGE_VARIANTS setting, by name. The name is the directory of the variant in
+IMAGES_STORE, so that the 'full' variant (the training images) and the 'thumbs/small' variant keep the layout of
+Scrapy's images pipeline. The CDN query parameters of the width and of the format are set by IMAGE_CDN_PARAMS.
+
+Hosts that ignore a format parameter (the content type of their response is not the requested one) are remembered
+for the rest of the crawl, and their next images are requested as JPEG.
+"""
+
+import dataclasses
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+# File extension and content type of each format
+FORMAT_EXTENSIONS = {"jpeg": "jpg", "webp": "webp", "avif": "avif"}
+FORMAT_CONTENT_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp", "avif": "image/avif"}
+
+DEFAULT_CDN_PARAMS = {"width": "w", "format": "fm"}
+
+
+@dataclasses.dataclass(slots=True)
+class ImageVariant:
+    """
+    Variant of the images requested from the CDN.
+
+    Attributes:
+        name: The name of the variant, its directory in IMAGES_STORE, e.g. 'full' or 'thumbs/small'.
+        width: The width requested, in pixels.
+        format: The format requested, among FORMAT_EXTENSIONS. AVIF images can only be opened by Pillow 11.2 or more.
+    """
+
+    name: str
+    width: int
+    format: str = "jpeg"
+
+    def __post_init__(self):
+        if self.format not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Unknown image format {self.format}, choose between {list(FORMAT_EXTENSIONS)}")
+
+
+def parse_variants(setting: dict) -> list:
+    """
+    Parse the IMAGE_VARIANTS setting.
+
+    Args:
+        setting: The width and format of each variant, by name, e.g. {'full': {'width': 768, 'format': 'jpeg'}}.
+
+    Returns:
+        list: The ImageVariant of each variant.
+    """
+    variants = [ImageVariant(name, **options) for name, options in setting.items()]
+    if variants and "full" not in setting:
+        raise ValueError("IMAGE_VARIANTS must define the 'full' variant, stored as the images of the watches")
+    return variants
+
+
+class VariantUrls:
+    """
+    Build the CDN URLs of the variants, falling back to JPEG on the hosts that ignore a format.
+
+    Attributes:
+        params: The query parameter of the width and of the format.
+        unsupported: The formats ignored by each host.
+    """
+
+    def __init__(self, params: Optional[dict] = None):
+        self.params = {**DEFAULT_CDN_PARAMS, **(params or {})}
+        self.unsupported = {}
+
+    def format(self, url: str, variant: ImageVariant) -> str:
+        """
+        Get the format requested for a variant of an image.
+
+        Args:
+            url: The URL of the image.
+            variant: The variant.
+
+        Returns:
+            str: The format of the variant, or 'jpeg' if the host ignores it.
+        """
+        if variant.format in self.unsupported.get(urlparse(url).netloc, ()):
+            return "jpeg"
+        return variant.format
+
+    def url(self, url: str, variant: ImageVariant) -> str:
+        """
+        Build the URL of a variant of an image, replacing the width and format parameters of the image URL.
+
+        Args:
+            url: The URL of the image, e.g. 'https://cdn.example.com/watch.jpg?w=570'.
+            variant: The variant.
+
+        Returns:
+            str: The URL of the variant, e.g. 'https://cdn.example.com/watch.jpg?w=768&fm=webp'.
+        """
+        parts = urlparse(url)
+        query = {key: value for key, value in parse_qsl(parts.query) if key not in self.params.values()}
+        query[self.params["width"]] = str(variant.width)
+        image_format = self.format(url, variant)
+        if image_format != "jpeg":
+            query[self.params["format"]] = image_format
+        return urlunparse(parts._replace(query=urlencode(query)))
+
+    def check_content_type(self, url: str, image_format: str, content_type: Optional[str]) -> bool:
+        """
+        Check that a host returned the requested format, and remember it otherwise.
+
+        Args:
+            url: The URL of the variant.
+            image_format: The format requested.
+            content_type: The content type of the response.
+
+        Returns:
+            bool: Whether the response has the requested format.
+        """
+        if (
+            image_format == "jpeg"
+            or content_type is None
+            or content_type.startswith(FORMAT_CONTENT_TYPES[image_format])
+        ):
+            return True
+        self.unsupported.setdefault(urlparse(url).netloc, set()).add(image_format)
+        return False
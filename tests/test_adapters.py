@@ -0,0 +1,83 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("safetensors")
+
+from safetensors.torch import save_file  # noqa: E402
+
+from adapters import AdapterRegistry  # noqa: E402
+
+
+class LoRACompatibleLinear(torch.nn.Module):
+    # Fusion of the LoRA layers of diffusers 0.23: fusing drops the LoRA layer, unfusing only restores the weight
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.ones(1)
+        self.lora_layer = None
+        self.original_weight = None
+
+    def set_lora_layer(self, lora_layer):
+        self.lora_layer = lora_layer
+
+    def fuse(self, scale):
+        if self.lora_layer is not None:
+            self.original_weight = self.weight
+            self.weight = self.weight + scale * self.lora_layer
+            self.lora_layer = None
+
+    def unfuse(self):
+        if self.original_weight is not None:
+            self.weight, self.original_weight = self.original_weight, None
+
+    def effective_weight(self, scale):
+        return float(self.weight + (scale * self.lora_layer if self.lora_layer is not None else 0))
+
+
+class TinyUNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = LoRACompatibleLinear()
+
+    def load_attn_procs(self, state_dict):
+        self.linear.set_lora_layer(state_dict["lora"])
+
+    def fuse_lora(self, lora_scale=1.0):
+        self.linear.fuse(lora_scale)
+
+    def unfuse_lora(self):
+        self.linear.unfuse()
+
+
+@pytest.fixture
+def registry(tmp_path):
+    registry = AdapterRegistry(TinyUNet())
+    for name, value in [("a", 2.0), ("b", 4.0)]:
+        save_file({"lora": torch.tensor([value])}, str(tmp_path / f"{name}.safetensors"))
+        registry.register(name, str(tmp_path / f"{name}.safetensors"))
+    return registry
+
+
+def effective_weight(registry):
+    kwargs = registry.cross_attention_kwargs()
+    return registry.unet.linear.effective_weight(kwargs["scale"] if kwargs else 1.0)
+
+
+def test_fuse_then_unfuse(registry):
+    registry.activate("a", fuse=True)
+    assert registry.cross_attention_kwargs() is None
+    assert effective_weight(registry) == 3.0
+    registry.activate("a", fuse=False)
+    assert effective_weight(registry) == 3.0
+    registry.activate("b", scale=0.5, fuse=True)
+    assert effective_weight(registry) == 3.0
+    registry.activate(None)
+    assert effective_weight(registry) == 1.0
+
+
+def test_rescale_while_fused(registry):
+    registry.activate("a", fuse=True)
+    registry.activate("a", scale=0.5, fuse=True)
+    assert effective_weight(registry) == 2.0
+    registry.activate("a", scale=0.25)
+    assert registry.cross_attention_kwargs() == {"scale": 0.25}
+    assert effective_weight(registry) == 1.5
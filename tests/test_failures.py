@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip("scrapy")
+
+from scrapy.http import HtmlResponse, Request  # noqa: E402
+from scrapy.spidermiddlewares.httperror import HttpError  # noqa: E402
+from scrapy.statscollectors import MemoryStatsCollector  # noqa: E402
+from scrapy.utils.test import get_crawler  # noqa: E402
+from twisted.python.failure import Failure  # noqa: E402
+
+from scraper.failures import FailedRequestsExtension, FailureStore  # noqa: E402
+from scraper.spiders.chronext_spider import ChronextSpider  # noqa: E402
+
+WATCH_PAGE = """
+<div class="specification__wrapper">
+    <div class="specification__title"><span>Marque</span></div>
+    <div class="specification__value"><span>Rolex</span></div>
+</div>
+{price}
+"""
+
+
+@pytest.fixture
+def spider():
+    crawler = get_crawler(ChronextSpider)
+    crawler.stats = MemoryStatsCollector(crawler)
+    return ChronextSpider.from_crawler(crawler)
+
+
+def watch_page(spider, url, status=200, price=""):
+    request = Request(url, callback=spider.parse_watch_page)
+    body = WATCH_PAGE.format(price=price).encode()
+    return request, HtmlResponse(url, status=status, body=body, request=request)
+
+
+def test_failure_store(tmp_path, spider):
+    extension = FailedRequestsExtension(FailureStore(str(tmp_path / "failures.sqlite")), spider.crawler.stats)
+    store = extension.store
+
+    # Download failure, then callback error of the replayed request
+    request, response = watch_page(spider, "https://www.chronext.fr/rolex-1", status=503)
+    failure = Failure(HttpError(response))
+    failure.request = request
+    extension.request_failed(failure, spider)
+    extension.response_received(response, request, spider)
+    assert [(entry["url"], entry["callback"], entry["status"]) for entry in store.entries()] == [
+        (request.url, "parse_watch_page", 503)
+    ]
+    assert store.snapshot(request.url) == response.body
+
+    request, response = watch_page(spider, "https://www.chronext.fr/rolex-1")
+    extension.response_received(response, request, spider)
+    assert len(store) == 0
+    extension.spider_error(Failure(ValueError("boom")), response, spider)
+    [entry] = store.entries()
+    assert entry["reason"] == "ValueError: boom"
+    assert entry["attempts"] == 1
+
+    # A successful response removes the request
+    extension.response_received(response, request, spider)
+    assert len(store) == 0
+    extension.spider_closed(spider)
+    assert spider.crawler.stats.get_value("failed_requests/stored") == 0
+    assert spider.crawler.stats.get_value("failed_requests/callback") == 1
+
+
+def test_watch_page_without_price(spider):
+    _, response = watch_page(spider, "https://www.chronext.fr/rolex-2")
+    [item] = spider.parse_watch_page(response)
+    assert item.metadata == {"marque": "rolex"}
+    assert spider.crawler.stats.get_value("chronext/missing_price") == 1
+
+    _, response = watch_page(spider, "https://www.chronext.fr/rolex-3", price='<div class="price">12350 €</div>')
+    [item] = spider.parse_watch_page(response)
+    assert item.metadata["price"] == 12350.0
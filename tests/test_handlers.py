@@ -0,0 +1,121 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("scrapy")
+pytest.importorskip("h2")
+pytest.importorskip("OpenSSL")
+
+import scrapy  # noqa: E402
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.primitives import hashes  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec  # noqa: E402
+from cryptography.x509.oid import NameOID  # noqa: E402
+from h2.config import H2Configuration  # noqa: E402
+from h2.connection import H2Connection  # noqa: E402
+from h2.events import RequestReceived  # noqa: E402
+from OpenSSL import crypto  # noqa: E402
+from scrapy.utils.test import get_crawler  # noqa: E402
+from twisted.internet import defer, protocol, ssl, task  # noqa: E402
+
+from scraper.handlers import IMAGE_REQUEST_META, ImageDownloadHandler  # noqa: E402
+
+IMAGE_BYTES = b"\xff\xd8" + b"\x00" * 1000
+
+
+class H2ImageServer(protocol.Protocol):
+    """
+    Minimal HTTP/2 server answering every request with an image. The connection is closed with a GOAWAY frame after
+    the response to /goaway, like a CDN edge closing a connection.
+    """
+
+    def connectionMade(self):
+        self.connection = H2Connection(H2Configuration(client_side=False, header_encoding="utf-8"))
+        self.connection.initiate_connection()
+        self.transport.write(self.connection.data_to_send())
+
+    def dataReceived(self, data: bytes):
+        goaway = False
+        for event in self.connection.receive_data(data):
+            if isinstance(event, RequestReceived):
+                self.connection.send_headers(
+                    event.stream_id,
+                    [(":status", "200"), ("content-type", "image/jpeg"), ("content-length", str(len(IMAGE_BYTES)))],
+                )
+                self.connection.send_data(event.stream_id, IMAGE_BYTES, end_stream=True)
+                goaway = goaway or dict(event.headers)[":path"] == "/goaway"
+        if goaway:
+            self.connection.close_connection()
+        self.transport.write(self.connection.data_to_send())
+        if goaway:
+            self.transport.loseConnection()
+
+
+def tls_options() -> ssl.CertificateOptions:
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    return ssl.CertificateOptions(
+        privateKey=crypto.PKey.from_cryptography_key(key),
+        certificate=crypto.X509.from_cryptography(certificate),
+        acceptableProtocols=[b"h2"],
+    )
+
+
+def test_h2_connection_events():
+    from twisted.internet import reactor
+
+    factory = protocol.Factory.forProtocol(H2ImageServer)
+    port = reactor.listenSSL(0, factory, tls_options(), interface="127.0.0.1")
+    host = f"127.0.0.1:{port.getHost().port}"
+    base_url = f"https://{host}"
+    crawler = get_crawler(settings_dict={"TWISTED_REACTOR": None})
+    spider = scrapy.Spider(name="images")
+    handler = ImageDownloadHandler(crawler, num_connections=1)
+    results = {}
+
+    @defer.inlineCallbacks
+    def scenario():
+        try:
+            for path in ["/1.jpg", "/2.jpg", "/goaway"]:
+                response = yield handler.download_request(
+                    scrapy.Request(base_url + path, meta=IMAGE_REQUEST_META), spider
+                )
+                results[path] = response
+            # Let the client handle the GOAWAY frame and the closed connection
+            yield task.deferLater(reactor, 0.2, lambda: None)
+            results["/3.jpg"] = yield handler.download_request(
+                scrapy.Request(base_url + "/3.jpg", meta=IMAGE_REQUEST_META), spider
+            )
+        except Exception as e:
+            results["error"] = e
+        finally:
+            yield handler.close()
+            yield port.stopListening()
+            reactor.stop()
+
+    reactor.callWhenRunning(scenario)
+    timeout = reactor.callLater(30, reactor.stop)
+    reactor.run()
+    if timeout.active():
+        timeout.cancel()
+
+    assert "error" not in results, results.get("error")
+    assert all(response.body == IMAGE_BYTES for response in results.values())
+    assert results["/1.jpg"].protocol == "h2"
+    stats = crawler.stats.get_stats()
+    assert stats[f"images_h2/connections_opened/{host}"] == 2
+    assert stats[f"images_h2/connections_reused/{host}"] == 2
+    # The connection closed by the GOAWAY frame, and the one closed with the handler
+    assert stats[f"images_h2/connections_lost/{host}"] == 2
+    assert stats["images_h2/request_count"] == 4
@@ -0,0 +1,27 @@
+import datetime
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from scraper.history import PriceHistory  # noqa: E402
+
+
+def test_price_history_without_price():
+    db = mongomock.MongoClient().db
+    # mongomock has no time-series collections
+    db.create_collection("price_history")
+    history = PriceHistory(db)
+    crawls = [datetime.datetime(2026, 1, day) for day in range(1, 6)]
+
+    # An available product without a displayed price is still available
+    assert history.record(crawls[0], "a", "rolex", None)
+    assert not history.record(crawls[1], "a", "rolex", None)
+    assert history.mark_unavailable(crawls[1], {"a"}) == 0
+    assert history.mark_unavailable(crawls[2], set()) == 1
+    assert history.mark_unavailable(crawls[3], set()) == 0
+    assert history.record(crawls[4], "a", "rolex", None)
+    assert history.record(crawls[4], "a", "rolex", 9500.0)
+
+    assert [document["available"] for document in db.price_history.find()] == [True, False, True, True]
+    assert PriceHistory(db).latest == {"a": (True, 9500.0)}
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from inference import ImageWriterPool, WatchGenerator  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def generator(tiny_model_dir):
+    return WatchGenerator(tiny_model_dir, device="cpu", num_inference_steps=2, batch_size=4)
+
+
+def test_generate_is_deterministic_per_seed(generator):
+    prompts = [("brand:Rolex,chronograph", 0), ("brand:Omega", 1), ("brand:Rolex,chronograph", 0)]
+    results = list(generator.generate(prompts))
+    assert [i for i, _ in results] == [0, 1, 2]
+    images = [image for _, image in results]
+    assert images[0].size == (8, 8)
+    # An image only depends on its prompt and seed, not on the rest of its batch
+    assert images[0].tobytes() == images[2].tobytes()
+    assert images[0].tobytes() != images[1].tobytes()
+
+
+def test_generate_halves_batch_size_on_out_of_memory(generator, monkeypatch):
+    generate_batch = generator.generate_batch
+    batch_sizes = []
+
+    def limited_generate_batch(prompts, seeds, **kwargs):
+        batch_sizes.append(len(prompts))
+        if len(prompts) > 1:
+            raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+        return generate_batch(prompts, seeds, **kwargs)
+
+    monkeypatch.setattr(generator, "generate_batch", limited_generate_batch)
+    monkeypatch.setattr(generator, "batch_size", 4)
+    results = list(generator.generate([(f"watch {i}", i) for i in range(3)]))
+    assert [i for i, _ in results] == [0, 1, 2]
+    assert generator.batch_size == 1
+    assert batch_sizes == [3, 2, 1, 1, 1]
+
+
+def test_generate_raises_out_of_memory_at_batch_size_one(generator, monkeypatch):
+    def out_of_memory(prompts, seeds, **kwargs):
+        raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+
+    monkeypatch.setattr(generator, "generate_batch", out_of_memory)
+    monkeypatch.setattr(generator, "batch_size", 1)
+    with pytest.raises(torch.cuda.OutOfMemoryError):
+        list(generator.generate([("watch", 0)]))
+
+
+def test_image_writer_pool(tmp_path):
+    from PIL import Image
+
+    writer = ImageWriterPool(str(tmp_path / "images"), num_workers=2, image_format="png")
+    for i in range(5):
+        writer.submit(Image.new("RGB", (4, 4), (i, 0, 0)), f"{i:06d}")
+    writer.close()
+    assert sorted(os.listdir(tmp_path / "images")) == [f"{i:06d}.png" for i in range(5)]
+    with Image.open(tmp_path / "images" / "000003.png") as image:
+        assert image.getpixel((0, 0)) == (3, 0, 0)
+
+
+def test_image_writer_pool_raises_write_errors(tmp_path):
+    from PIL import Image
+
+    writer = ImageWriterPool(str(tmp_path), image_format="unknown")
+    writer.submit(Image.new("RGB", (4, 4)), "image")
+    with pytest.raises((KeyError, ValueError)):
+        writer.close()
@@ -0,0 +1,47 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from scraper.migrate import migrate_collection, migration_update  # noqa: E402
+
+
+def test_migration_update():
+    document = {
+        "_id": 1,
+        "image_paths": ["full/a.jpg"],
+        "price": 12500.0,
+        "marque": "omega",
+        "matériau du boîtier": "acier",
+        "fonctions": ["chronographe"],
+        "lunette": "tachymètre",
+    }
+    update = migration_update(document)
+    assert update["$set"] == {
+        "brand": "omega",
+        "case_material": "steel",
+        "price": 12500.0,
+        "functions": {"chronograph": True},
+        "specs": {"lunette": "tachymètre"},
+    }
+    assert set(update["$unset"]) == {"marque", "matériau du boîtier", "fonctions", "lunette"}
+    assert migration_update({"_id": 2, "brand": "omega", "functions": {"date": True}}) is None
+
+
+def test_migrate_collection():
+    collection = mongomock.MongoClient().db.watches
+    collection.insert_many(
+        [
+            {"_id": 1, "image_paths": ["full/a.jpg"], "marque": "rolex", "fonctions": ["date"]},
+            {"_id": 2, "image_paths": ["full/b.jpg"], "brand": "tudor"},
+        ]
+    )
+    assert migrate_collection(collection, dry_run=True) == 1
+    assert collection.find_one({"_id": 1})["marque"] == "rolex"
+    assert migrate_collection(collection) == 1
+    assert collection.find_one({"_id": 1}) == {
+        "_id": 1,
+        "image_paths": ["full/a.jpg"],
+        "brand": "rolex",
+        "functions": {"date": True},
+    }
+    assert migrate_collection(collection) == 0
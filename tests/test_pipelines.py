@@ -0,0 +1,30 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+pytest.importorskip("scrapy")
+
+from scrapy.statscollectors import MemoryStatsCollector  # noqa: E402
+from scrapy.utils.test import get_crawler  # noqa: E402
+
+from scraper import pipelines  # noqa: E402
+from scraper.spiders.chronext_spider import ChronextSpider  # noqa: E402
+
+
+@pytest.mark.parametrize("retry_failed, unavailable", [(False, 1), ("1", 0)])
+def test_price_history_retry_pass(monkeypatch, retry_failed, unavailable):
+    client = mongomock.MongoClient()
+    # mongomock has no time-series collections
+    client.items.create_collection("price_history")
+    client.items.price_history.insert_one(
+        {"ts": 0, "product": {"id": "a", "brand": "rolex"}, "price": 9500.0, "available": True}
+    )
+    monkeypatch.setattr(pipelines.pymongo, "MongoClient", lambda *args, **kwargs: client)
+    spider = ChronextSpider(retry_failed=retry_failed)
+    pipeline = pipelines.PriceHistoryPipeline(None, 27017, "items", MemoryStatsCollector(get_crawler()))
+
+    # The crawl does not see the product, because it was not in the catalogue or not in the failed requests
+    pipeline.open_spider(spider)
+    pipeline.process_item({"sku": "b", "brand": "omega", "price": 4200.0}, spider)
+    pipeline.spider_closed(spider, "finished")
+
+    assert client.items.price_history.count_documents({"available": False}) == unavailable
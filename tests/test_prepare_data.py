@@ -0,0 +1,94 @@
+import io
+import json
+import os
+import sys
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+pymongo = pytest.importorskip("pymongo")
+pq = pytest.importorskip("pyarrow.parquet")
+Image = pytest.importorskip("PIL.Image")
+
+import prepare_data  # noqa: E402
+from options import INDEX_NAME  # noqa: E402
+from watches_dataset import format_caption  # noqa: E402
+
+
+def insert_watches(collection, image_dir, num_watches):
+    os.makedirs(os.path.join(image_dir, "full"), exist_ok=True)
+    for i in range(num_watches):
+        image_paths = []
+        for j in range(2):
+            image_path = f"full/{i}-{j}.jpg"
+            Image.new("RGB", (24, 16), (i * 10 % 256, j * 100, 50)).save(os.path.join(image_dir, image_path))
+            image_paths.append(image_path)
+        collection.insert_one({"url": f"https://example.com/{i}", "image_paths": image_paths, "brand": f"brand{i}"})
+
+
+@pytest.mark.parametrize("num_ranges", [1, 3, 4, 20])
+def test_compute_id_ranges(num_ranges):
+    collection = mongomock.MongoClient().db.watches
+    collection.insert_many([{"n": i} for i in range(10)])
+    queries = prepare_data.compute_id_ranges(collection, num_ranges)
+    assert len(queries) == min(num_ranges, 10)
+
+    # Every watch is in exactly one range, and the ranges are balanced
+    counts = [collection.count_documents(query) for query in queries]
+    assert sum(counts) == 10
+    assert max(counts) - min(counts) <= 1
+    for watch in collection.find():
+        assert sum(collection.count_documents({"$and": [query, {"_id": watch["_id"]}]}) for query in queries) == 1
+
+    # Watches inserted afterwards are left out of the pinned ranges
+    collection.insert_one({"n": 10})
+    assert sum(collection.count_documents(query) for query in queries) == 10
+    assert prepare_data.compute_id_ranges(mongomock.MongoClient().db.empty, num_ranges) == []
+
+
+def test_id_ranges_file(tmp_path):
+    collection = mongomock.MongoClient().db.watches
+    collection.insert_many([{"n": i} for i in range(5)])
+    queries = prepare_data.compute_id_ranges(collection, 2)
+    prepare_data.save_id_ranges(queries, str(tmp_path))
+    assert prepare_data.load_id_ranges(str(tmp_path)) == queries
+    with pytest.raises(TimeoutError):
+        prepare_data.load_id_ranges(str(tmp_path / "missing"), timeout=0)
+
+
+def test_prepare_data(tmp_path, monkeypatch):
+    client = mongomock.MongoClient()
+    collection = client.watch_scraping.watches
+    image_dir, output_dir = str(tmp_path / "images"), str(tmp_path / "shards")
+    insert_watches(collection, image_dir, 7)
+    # The forked workers get a copy of the collection
+    monkeypatch.setattr(pymongo, "MongoClient", lambda *args, **kwargs: client)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "prepare_data.py",
+            *["--output_dir", output_dir, "--image_dir", image_dir, "--resolution", "8"],
+            *["--samples_per_shard", "3", "--num_workers", "2", "--rank", "0", "--world_size", "1"],
+        ],
+    )
+    prepare_data.main()
+
+    assert sorted(os.listdir(output_dir)) == [INDEX_NAME, "part-00000", "part-00001", prepare_data.RANGES_NAME]
+    with open(os.path.join(output_dir, INDEX_NAME)) as f:
+        manifest = json.load(f)
+    assert manifest["parts"] == 2
+    assert manifest["num_samples"] == 14
+
+    # The parts hold every image once, resized to the resolution
+    texts = []
+    for shard in manifest["shards"]:
+        table = pq.read_table(os.path.join(output_dir, shard["path"]))
+        assert table.num_rows == shard["num_samples"]
+        texts.extend(table.column("text").to_pylist())
+        for image_bytes in table.column("image").to_pylist():
+            assert Image.open(io.BytesIO(image_bytes)).size == (12, 8)
+    assert sorted(texts) == sorted(format_caption(watch) for watch in collection.find() for _ in range(2))
+
+    # Merging again gives the same manifest
+    assert prepare_data.merge_manifests(output_dir, 2) == manifest
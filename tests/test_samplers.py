@@ -0,0 +1,64 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from checkpointing import load_extra_state, save_extra_state  # noqa: E402
+from samplers import ResumableRandomSampler  # noqa: E402
+
+
+def test_resume_mid_epoch():
+    sampler = ResumableRandomSampler(20, seed=3)
+    sampler.set_epoch(2)
+    epoch = list(sampler)
+    sampler.set_position(8)
+
+    resumed = ResumableRandomSampler(20, seed=0)
+    resumed.load_state_dict(sampler.state_dict())
+    # Accelerate sets the epoch again when the dataloader is iterated
+    resumed.set_epoch(2)
+    assert list(resumed) == epoch[8:]
+
+    resumed.set_epoch(3)
+    sampler.set_epoch(3)
+    assert list(resumed) == list(sampler)
+
+
+def make_dataloader(accelerate, seed: int = 7):
+    accelerator = accelerate.Accelerator(cpu=True)
+    sampler = ResumableRandomSampler(24, seed=seed)
+    dataloader = torch.utils.data.DataLoader(torch.arange(24), sampler=sampler, batch_size=2)
+    dataloader = accelerator.prepare(dataloader)
+    return accelerator, sampler, dataloader
+
+
+def test_resume_with_accelerate(tmp_path):
+    accelerate = pytest.importorskip("accelerate")
+
+    accelerator, sampler, dataloader = make_dataloader(accelerate)
+    for epoch in range(2):
+        dataloader.set_epoch(epoch)
+        batches = [batch.tolist() for batch in dataloader]
+    consumed = 5
+    sampler.set_position(consumed * 2)
+    accelerator.save_state(str(tmp_path))
+    save_extra_state(str(tmp_path), {"sampler": sampler.state_dict()})
+
+    # The resumed run starts its dataloader counter at 0, and loads the sampler state saved in epoch 1
+    accelerator, sampler, dataloader = make_dataloader(accelerate, seed=0)
+    accelerator.load_state(str(tmp_path))
+    sampler.load_state_dict(load_extra_state(str(tmp_path))["sampler"])
+    dataloader.set_epoch(1)
+    sampler.seek(sampler.position)
+    assert [batch.tolist() for batch in dataloader] == batches[consumed:]
+
+
+def test_resume_without_sampler_state(tmp_path):
+    accelerate = pytest.importorskip("accelerate")
+
+    # Checkpoints written before the sampler states were saved have no extra state, and still load
+    accelerator, _, _ = make_dataloader(accelerate)
+    accelerator.save_state(str(tmp_path))
+    save_extra_state(str(tmp_path), None)
+    accelerator, _, _ = make_dataloader(accelerate)
+    accelerator.load_state(str(tmp_path))
+    assert load_extra_state(str(tmp_path)) == {}
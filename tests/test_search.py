@@ -0,0 +1,30 @@
+import os
+
+from scraper.search import DELTA_FILE, ROTATED_DELTA_FILE, FacetIndex
+
+
+def watch(i, brand):
+    return {"_id": f"w{i}", "brand": brand, "price": 1000.0 * i, "functions": {"date": i % 2 == 0}}
+
+
+def test_append_during_build(tmp_path):
+    path = str(tmp_path)
+    FacetIndex.append(path, [watch(0, "rolex")])
+
+    def collection():
+        # Watches read from the collection, while the crawler keeps appending new ones to the log
+        yield watch(0, "rolex")
+        FacetIndex.append(path, [watch(1, "omega"), watch(2, "tudor")])
+        yield watch(1, "omega")
+
+    index = FacetIndex.build(collection(), path)
+    assert not os.path.exists(os.path.join(path, ROTATED_DELTA_FILE))
+    assert os.path.exists(os.path.join(path, DELTA_FILE))
+    assert len(index) == 3
+    assert sorted(index.search()) == ["w0", "w1", "w2"]
+    assert index.facet_counts("brand") == {"rolex": 1, "omega": 1, "tudor": 1}
+    assert index.search({"functions": "date"}, {"price": (1500, None)}) == ["w2"]
+
+    index = FacetIndex.build([watch(0, "rolex"), watch(1, "omega"), watch(2, "tudor")], path)
+    assert not os.path.exists(os.path.join(path, DELTA_FILE))
+    assert len(index) == 3
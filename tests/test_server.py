@@ -0,0 +1,91 @@
+import base64
+import http.client
+import io
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from inference import WatchGenerator  # noqa: E402
+from server import GenerationHandler, MicroBatcher  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def server(tiny_model_dir):
+    generator = WatchGenerator(tiny_model_dir, device="cpu", num_inference_steps=2, batch_size=4)
+    GenerationHandler.batcher = MicroBatcher(generator, max_batch_size=4, max_wait_ms=20)
+    GenerationHandler.max_images = 4
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), GenerationHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_address
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(address, body) -> tuple:
+    connection = http.client.HTTPConnection(*address, timeout=60)
+    connection.request("POST", "/generate", body=json.dumps(body), headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    return response.status, data
+
+
+def test_generate_streams_images(server):
+    from PIL import Image
+
+    status, data = post(server, {"prompt": "brand:Rolex,chronograph", "num_images": 2, "seed": 5})
+    assert status == 200
+    lines = [json.loads(line) for line in data.splitlines()]
+    assert sorted((line["index"], line["seed"]) for line in lines) == [(0, 5), (1, 6)]
+    with Image.open(io.BytesIO(base64.b64decode(lines[0]["image"]))) as image:
+        assert image.size == (8, 8)
+
+
+def test_concurrent_requests(server):
+    results = [None] * 3
+
+    def request(i):
+        results[i] = post(server, {"prompt": f"watch {i}", "num_images": 2, "seed": i})
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+    assert [status for status, _ in results] == [200] * 3
+    assert all(len(data.splitlines()) == 2 for _, data in results)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        ["brand:Rolex"],
+        {"num_images": 1},
+        {"prompt": ["brand:Rolex"]},
+        {"prompt": "brand:Rolex", "num_images": 0},
+        {"prompt": "brand:Rolex", "num_images": -1},
+        {"prompt": "brand:Rolex", "num_images": 5},
+        {"prompt": "brand:Rolex", "adapter": "unknown"},
+    ],
+)
+def test_invalid_requests_are_rejected(server, body):
+    status, data = post(server, body)
+    assert status == 400
+    assert "error" in json.loads(data)
+
+
+def test_metrics(server):
+    connection = http.client.HTTPConnection(*server, timeout=10)
+    connection.request("GET", "/metrics")
+    response = connection.getresponse()
+    metrics = json.loads(response.read())
+    connection.close()
+    assert response.status == 200
+    assert metrics["queue_depth"] == 0
+    assert {"requests", "images", "active_adapter"} <= set(metrics)
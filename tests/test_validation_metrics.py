@@ -0,0 +1,20 @@
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torchvision")
+pytest.importorskip("transformers")
+
+from validation_metrics import kernel_inception_distance  # noqa: E402
+
+
+def test_kernel_inception_distance():
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(20, 8))
+    assert abs(kernel_inception_distance(features[:10], features[10:], num_subsets=3)) < 1
+    assert kernel_inception_distance(features, features + 5, num_subsets=3) > 1
+
+    # A single image in a set has no unbiased estimate
+    assert math.isnan(kernel_inception_distance(features[:1], features[10:]))
+    assert math.isnan(kernel_inception_distance(features[:10], features[10:11]))
@@ -0,0 +1,46 @@
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from scraper.variants import ImageVariant, VariantUrls, parse_variants
+
+IMAGE_URL = "https://img.chronext.com/watch.jpg?w=1000&q=80"
+
+
+def query(url):
+    return {key: value[0] for key, value in parse_qs(urlparse(url).query).items()}
+
+
+def test_variant_url():
+    urls = VariantUrls()
+    full, small = parse_variants({"full": {"width": 768}, "thumbs/small": {"width": 100, "format": "webp"}})
+    assert query(urls.url(IMAGE_URL, full)) == {"w": "768", "q": "80"}
+    assert query(urls.url(IMAGE_URL, small)) == {"w": "100", "q": "80", "fm": "webp"}
+    assert urlparse(urls.url(IMAGE_URL, small)).path == "/watch.jpg"
+
+    # Custom query parameters of the CDN
+    urls = VariantUrls({"width": "width", "format": "format"})
+    assert query(urls.url(IMAGE_URL, small)) == {"w": "1000", "q": "80", "width": "100", "format": "webp"}
+
+
+def test_content_type_fallback():
+    urls = VariantUrls()
+    small = ImageVariant("thumbs/small", 100, "webp")
+    assert urls.check_content_type(urls.url(IMAGE_URL, small), "webp", "image/webp")
+    assert urls.check_content_type(urls.url(IMAGE_URL, small), "webp", None)
+    assert urls.format(IMAGE_URL, small) == "webp"
+
+    # The host ignored the format: its next images are requested as JPEG, the other hosts are unaffected
+    assert not urls.check_content_type(urls.url(IMAGE_URL, small), "webp", "image/jpeg")
+    assert urls.format(IMAGE_URL, small) == "jpeg"
+    assert query(urls.url(IMAGE_URL, small)) == {"w": "100", "q": "80"}
+    assert urls.format("https://cdn.example.com/watch.jpg", small) == "webp"
+    assert urls.check_content_type(urls.url(IMAGE_URL, small), "jpeg", "image/jpeg")
+
+
+def test_parse_variants():
+    assert parse_variants({}) == []
+    with pytest.raises(ValueError):
+        parse_variants({"thumbs/small": {"width": 100}})
+    with pytest.raises(ValueError):
+        ImageVariant("full", 768, "gif")